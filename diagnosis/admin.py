@@ -1,7 +1,7 @@
 from django.contrib import admin
 from .models import (
     PreDiagnosisReport, DiagnosisImage, UserDescription,
-    DiagnosisQuestion, DiagnosisAnswer, Doctor
+    DiagnosisQuestion, DiagnosisAnswer, Doctor, TCMPattern, TCMPatternSynonym
 )
 
 # Register your models here.
@@ -48,3 +48,13 @@ class DoctorAdmin(admin.ModelAdmin):
     list_filter = ('title', 'hospital', 'department')
     search_fields = ('name', 'hospital', 'specialty', 'tcm_patterns')
     ordering = ('-rating', '-patients_count')
+
+class TCMPatternSynonymInline(admin.TabularInline):
+    model = TCMPatternSynonym
+    extra = 1
+
+@admin.register(TCMPattern)
+class TCMPatternAdmin(admin.ModelAdmin):
+    list_display = ('name', 'created_at')
+    search_fields = ('name', 'synonyms__name')
+    inlines = [TCMPatternSynonymInline]
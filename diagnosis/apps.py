@@ -1,6 +1,46 @@
+import os
+import sys
+import logging
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
+
+logger = logging.getLogger('diagnosis')
+
+
+def _is_serving_process():
+    """判断当前进程是否为处理请求的服务进程（跳过 migrate 等管理命令）"""
+    if not sys.argv or os.path.basename(sys.argv[0]) != 'manage.py':
+        # gunicorn / uvicorn 等服务器进程
+        return True
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command != 'runserver':
+        return False
+    # runserver 的自动重载父进程不处理请求
+    return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+
+
+def _warm_up_stt():
+    try:
+        from .services.stt import model_registry
+        model_registry.warm_up()
+    except Exception as e:
+        logger.error(f'语音模型预加载失败: {str(e)}')
 
 
 class DiagnosisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'diagnosis'
+
+    def ready(self):
+        # 注册信号：用户自述转为文字后预生成问题
+        from . import signals  # noqa: F401
+
+        if getattr(settings, 'STT_WARMUP', False) and _is_serving_process():
+            # 后台预加载语音模型，首个请求会等待加载完成而不会重复加载
+            threading.Thread(
+                target=_warm_up_stt,
+                name='stt-warmup',
+                daemon=True
+            ).start()
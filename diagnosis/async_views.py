@@ -0,0 +1,351 @@
+import json
+import time
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from .models import PreDiagnosisReport
+from .serializers import DiagnosisQuestionSerializer
+from .services import llm_cache
+from .services.llm_async import CompletionStream
+from .services.ai_service import AIService
+from .services.report_service import ReportGenerationService, generation_timeout
+from .services.doctor_recommendation import DoctorRecommendationService, parse_page_params
+from .tasks import (
+    await_question_generation, claim_report_generation, create_questions, report_generation_in_progress,
+)
+
+# 获取logger实例
+logger = logging.getLogger('diagnosis')
+
+ai_service = AIService()
+report_service = ReportGenerationService()
+
+# 报告字段 -> (是否为治疗方案, 调用类型)
+REPORT_PARTS = {
+    'report_content': (False, 'report'),
+    'treatment_plan': (True, 'treatment'),
+}
+
+
+def _json(data, status: int = 200) -> JsonResponse:
+    return JsonResponse(data, status=status, safe=False, json_dumps_params={'ensure_ascii': False})
+
+
+def _request_data(request) -> dict:
+    """读取 JSON 请求体，兼容表单提交"""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST.dict()
+
+
+def _generating_response(report: PreDiagnosisReport) -> JsonResponse:
+    """报告正在由后台任务或其他请求生成时的响应"""
+    return _json({
+        'message': '报告正在生成中，请稍后查询',
+        'status': 'generating',
+        'report_content': report.report_content,
+        'treatment_plan': report.treatment_plan,
+    }, status=202)
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+async def _load_report(pk: int):
+    """读取报告及其问答，返回 (报告, 问答对)；报告不存在时返回 (None, None)"""
+    try:
+        report = await PreDiagnosisReport.objects.select_related('description').aget(pk=pk)
+    except PreDiagnosisReport.DoesNotExist:
+        return None, None
+    questions = [q async for q in report.questions.select_related('answer')]
+    qa_pairs = None
+    if questions and all(hasattr(q, 'answer') for q in questions):
+        qa_pairs = [{'question': q.content, 'answer': q.answer.content} for q in questions]
+    return report, qa_pairs
+
+
+async def _generate_part(queue: asyncio.Queue, field: str, prompt: str, call_type: str):
+    """流式生成一部分内容，把增量和结束/出错事件放入队列"""
+    try:
+        cached = await sync_to_async(llm_cache.lookup, thread_sensitive=False)(prompt, call_type)
+        if cached is not None:
+            await queue.put((field, 'delta', cached.text))
+            await queue.put((field, 'done', cached.text))
+            return
+
+        stream = CompletionStream(prompt, call_type=call_type)
+        async for delta in stream:
+            await queue.put((field, 'delta', delta))
+        await sync_to_async(llm_cache.store, thread_sensitive=False)(prompt, call_type, stream.result)
+        await queue.put((field, 'done', stream.result.text))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f'Failed to stream {field}: {str(e)}')
+        await queue.put((field, 'error', str(e)))
+
+
+async def _save_results(report: PreDiagnosisReport, results: dict) -> list:
+    """保存已完成的部分，返回需要重试的字段"""
+    retry_required = report.apply_generated_parts(results.get('report_content'), results.get('treatment_plan'))
+    await report.asave(update_fields=['report_content', 'treatment_plan', 'status', 'error_message', 'updated_at'])
+    return retry_required
+
+
+async def _report_event_stream(report: PreDiagnosisReport, qa_pairs: list):
+    # 在生成器内领取报告：客户端在首次迭代前断开时生成器不会运行，不会留下无人释放的生成中标记
+    if not await sync_to_async(claim_report_generation)(report.id):
+        yield _sse('generating', {
+            'status': 'generating',
+            'report_content': report.report_content,
+            'treatment_plan': report.treatment_plan,
+        })
+        return
+
+    description = report.description.text_content
+    parts = [field for field in REPORT_PARTS if not getattr(report, field)]
+    queue: asyncio.Queue = asyncio.Queue()
+    tasks = []
+    results = {}
+    try:
+        # 先发送一个事件，客户端立即收到响应头和首个字节
+        yield _sse('start', {'report_id': report.id, 'parts': parts})
+
+        for field in parts:
+            treatment, call_type = REPORT_PARTS[field]
+            prompt = report_service._build_prompt(description, qa_pairs, treatment)
+            tasks.append(asyncio.create_task(_generate_part(queue, field, prompt, call_type)))
+
+        deadline = time.monotonic() + generation_timeout
+        pending = len(tasks)
+        while pending:
+            try:
+                field, kind, payload = await asyncio.wait_for(queue.get(), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                logger.error(f'Streaming report {report.id} exceeded the {generation_timeout:g}s deadline')
+                break
+            if kind == 'delta':
+                yield _sse('delta', {'part': field, 'text': payload})
+                continue
+            pending -= 1
+            if kind == 'done':
+                results[field] = payload
+                yield _sse('part_done', {'part': field})
+            else:
+                yield _sse('part_error', {'part': field, 'error': payload})
+    finally:
+        # 客户端断开或超时：停止未完成的生成，已完成的部分照常保存（同时释放生成中标记）
+        for task in tasks:
+            task.cancel()
+        retry_required = await _save_results(report, results)
+        logger.info(f'Streamed report {report.id}: generated {list(results)}, retry required {retry_required}')
+
+    yield _sse('done', {
+        'status': report.status,
+        'report_content': report.report_content,
+        'treatment_plan': report.treatment_plan,
+        'retry_required': retry_required,
+    })
+
+
+@csrf_exempt
+async def stream_report(request, pk):
+    """
+    流式生成预诊报告（Server-Sent Events）
+
+    诊断报告和治疗方案并发生成，模型的增量输出以 delta 事件实时转发，
+    生成结束后保存报告。需在 ASGI 服务器下运行，生成期间不占用同步 worker 线程。
+
+    事件：
+    - start: {"report_id": 1, "parts": ["report_content", "treatment_plan"]}
+    - delta: {"part": "report_content", "text": "..."}
+    - part_done / part_error: {"part": "...", "error": "..."}
+    - done: {"status": "completed", "report_content": "...", "treatment_plan": "...", "retry_required": []}
+    - generating: 开始迭代时报告已由其他请求领取，不再生成，字段与 202 响应相同
+    """
+    if request.method != 'POST':
+        return _json({'error': 'Method not allowed'}, status=405)
+
+    report, qa_pairs = await _load_report(pk)
+    if report is None:
+        return _json({'error': '报告不存在'}, status=404)
+    if not report.has_description:
+        return _json({'error': 'PreDiagnosisReport has no description.'}, status=400)
+    if qa_pairs is None:
+        return _json({'error': '尚未完成问题问答环节'}, status=400)
+    if report_generation_in_progress(report):
+        return _generating_response(report)
+
+    # 领取在生成器开始迭代时进行，此前的检查只是为了在常见情况下直接返回 202
+    response = StreamingHttpResponse(
+        _report_event_stream(report, qa_pairs),
+        content_type='text/event-stream; charset=utf-8',
+    )
+    response['Cache-Control'] = 'no-cache'
+    # 关闭 nginx 等反向代理的响应缓冲
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@csrf_exempt
+async def generate_questions(request):
+    """DiagnosisQuestionViewSet.generate_questions 的异步版本"""
+    if request.method != 'POST':
+        return _json({'error': 'Method not allowed'}, status=405)
+
+    report_id = _request_data(request).get('report_id')
+    if not report_id:
+        logger.warning('No report ID provided')
+        return _json({'error': '请提供报告ID'}, status=400)
+
+    try:
+        report = await PreDiagnosisReport.objects.select_related('description').aget(id=report_id)
+
+        # 检查是否有用户描述
+        if not report.has_description:
+            logger.warning(f'Report {report_id} has no description or text content')
+            return _json({'error': '报告尚未添加症状描述或症状描述未处理完成'}, status=400)
+
+        # 等待进行中的问题预生成（本进程或 stt_worker）
+        try:
+            await await_question_generation(report.id)
+        except Exception as e:
+            logger.warning(f'Waiting for pre-generated questions of report {report_id} failed: {str(e)}')
+
+        # 检查是否有问题
+        existing = [q async for q in report.questions.select_related('answer')]
+        if existing:
+            logger.warning(f'Report {report_id} already has questions')
+            data = await sync_to_async(lambda: DiagnosisQuestionSerializer(existing, many=True).data)()
+            return _json(data)
+
+        # 生成问题
+        questions = await ai_service.agenerate_questions(report.description.text_content)
+
+        # 创建问题记录（后台预生成同时完成时返回已保存的问题）
+        created_questions, created = await sync_to_async(create_questions)(report, questions)
+        if not created:
+            data = await sync_to_async(lambda: DiagnosisQuestionSerializer(created_questions, many=True).data)()
+            return _json(data)
+
+        # 更新报告状态
+        report.status = 'processing'
+        await report.asave(update_fields=['status', 'updated_at'])
+
+        logger.info(f'Successfully generated {len(questions)} questions for report {report.id}')
+        data = await sync_to_async(lambda: DiagnosisQuestionSerializer(created_questions, many=True).data)()
+        return _json(data, status=201)
+
+    except PreDiagnosisReport.DoesNotExist:
+        logger.error(f'Report not found: {report_id}')
+        return _json({'error': '报告不存在'}, status=404)
+    except Exception as e:
+        logger.error(f'Error generating questions: {str(e)}')
+        return _json({'error': f'生成问题失败: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+async def generate_report(request, pk):
+    """PreDiagnosisReportViewSet.generate_report 的异步版本"""
+    if request.method != 'POST':
+        return _json({'error': 'Method not allowed'}, status=405)
+
+    report, qa_pairs = await _load_report(pk)
+    if report is None:
+        return _json({'error': '报告不存在'}, status=404)
+    if not report.has_description:
+        return _json({'error': 'PreDiagnosisReport has no description.'}, status=400)
+    if qa_pairs is None:
+        return _json({'error': '尚未完成问题问答环节'}, status=400)
+
+    try:
+        # 检查报告是否已经生成
+        if report.report_content and report.status == 'completed':
+            logger.info(f'Report {report.id} already has content, skipping generation')
+            return _json({
+                'message': '报告已生成',
+                'report_content': report.report_content,
+                'treatment_plan': report.treatment_plan,
+            })
+
+        # 回答完毕后报告已在后台生成，或有其他请求正在生成
+        if not await sync_to_async(claim_report_generation)(report.id):
+            return _generating_response(report)
+
+        # 并发生成诊断报告和治疗方案，上次已生成的部分不再重复生成
+        results = await report_service.agenerate_report_and_treatment(
+            report.description.text_content,
+            qa_pairs,
+            report=not report.report_content,
+            treatment=not report.treatment_plan,
+        )
+        retry_required = await _save_results(report, {
+            'report_content': results.get('report'),
+            'treatment_plan': results.get('treatment'),
+        })
+        if retry_required:
+            logger.error(f'Report {report.id} partially generated, retry required: {retry_required}')
+
+        if len(retry_required) == 2:
+            return _json({'error': '生成报告失败，请重试', 'retry_required': retry_required}, status=500)
+
+        return _json({
+            'message': '报告生成成功' if not retry_required else '报告部分生成成功，请重试未完成的部分',
+            'report_content': report.report_content,
+            'treatment_plan': report.treatment_plan,
+            'retry_required': retry_required,
+        })
+
+    except Exception as e:
+        logger.error(f'Failed to generate report: {str(e)}')
+        report.error_message = str(e)
+        report.status = 'error'
+        await report.asave(update_fields=['status', 'error_message', 'updated_at'])
+        return _json({'error': f'生成报告失败: {str(e)}'}, status=500)
+
+
+@csrf_exempt
+async def recommend(request):
+    """DoctorViewSet.recommend 的异步版本"""
+    if request.method != 'POST':
+        return _json({'error': 'Method not allowed'}, status=405)
+
+    try:
+        data = _request_data(request)
+        report_id = data.get('report_id')
+        if not report_id:
+            return _json({'error': '请提供报告ID'}, status=400)
+
+        try:
+            k, offset, min_score = parse_page_params(data)
+        except ValueError as e:
+            return _json({'error': str(e)}, status=400)
+
+        try:
+            report = await PreDiagnosisReport.objects.aget(id=report_id)
+        except PreDiagnosisReport.DoesNotExist:
+            return _json({'error': '报告不存在'}, status=404)
+
+        if not report.report_content:
+            return _json({'error': '报告尚未生成，无法推荐医生'}, status=400)
+
+        # 获取推荐
+        page = await DoctorRecommendationService().arecommend(report, k, offset, min_score)
+
+        return _json({
+            'report_id': report_id,
+            'recommendations': page.recommendations,
+            'total': page.total,
+            'next_offset': page.next_offset
+        })
+
+    except Exception as e:
+        logger.error(f'Error recommending doctors: {str(e)}')
+        return _json({'error': '推荐医生时发生错误'}, status=500)
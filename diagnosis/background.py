@@ -0,0 +1,34 @@
+import os
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.db import close_old_connections
+
+logger = logging.getLogger('diagnosis')
+
+# 进程内后台任务的线程数（报告预生成等等待大模型的任务）
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("BACKGROUND_TASK_WORKERS", 4)),
+    thread_name_prefix="background-task",
+)
+
+
+def _run(fn, *args, **kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    except Exception as e:
+        logger.error(f'后台任务 {fn.__name__} 失败: {str(e)}')
+        raise
+    finally:
+        # 后台线程不经过请求周期，需要自行释放数据库连接
+        close_old_connections()
+
+
+def submit(fn, *args, **kwargs) -> Future:
+    """
+    在进程内线程池中执行任务，立即返回
+
+    适用于等待外部服务、可以在进程重启时丢失的任务（丢失后由下一次请求重新触发）；
+    语音转文字等耗费 CPU 的任务应提交到 stt_queue。
+    """
+    return _executor.submit(_run, fn, *args, **kwargs)
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from django.core.management.base import BaseCommand
+from diagnosis.services import llm_cache, llm_gateway, llm_router
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', 0), _StubHandler)
+
+    def reset_peak(self):
+        with self.lock:
+            self.peak_in_flight = 0
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """固定延迟后返回百炼格式的三个问题"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with server.lock:
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            body = json.dumps({
+                'output': {'text': '症状持续多久了？\n是否伴有发热？\n睡眠情况如何？'},
+                'usage': {'input_tokens': 120, 'output_tokens': 30},
+            }, ensure_ascii=False).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _summarize(mode, concurrency, latencies, errors, wall_seconds, peak):
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'completed': len(latencies),
+        'errors': errors,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(latencies) / wall_seconds, 2) if wall_seconds else None,
+        'latency_p50': round(float(np.percentile(latencies, 50)), 3) if latencies else None,
+        'latency_p95': round(float(np.percentile(latencies, 95)), 3) if latencies else None,
+        'peak_upstream_in_flight': peak,
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        '对比单进程下同步线程池（WSGI 部署方式）和异步事件循环（ASGI 异步视图）能同时处理的大模型请求数。'
+        '大模型由本地固定延迟的模拟服务代替，结果只反映本机的并发能力。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='10,50,100,200', help='并发请求数列表（逗号分隔）')
+        parser.add_argument('--latency', type=float, default=2.0, help='模拟大模型的响应延迟（秒）')
+        parser.add_argument('--threads', type=int, default=16, help='同步模式的 worker 线程数（对应 WSGI 每进程线程数）')
+        parser.add_argument('--provider-concurrency', type=int, default=1000,
+                            help='每个服务商的并发上限，默认放开以测量服务端本身的能力')
+        parser.add_argument('--output', help='JSON 结果输出文件')
+
+    def handle(self, *args, **options):
+        # AIService 需要配置 API Key；请求只会发到本地模拟服务
+        os.environ.setdefault('DASHSCOPE_API_KEY', 'bench')
+        os.environ.setdefault('VOLCANO_API_KEY', 'bench')
+        from diagnosis.services.ai_service import AIService
+
+        server = _StubServer(options['latency'])
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}/'
+
+        # 所有服务商指向模拟服务；关闭缓存和对冲，避免干扰并发能力的测量
+        for name, config in list(llm_gateway.PROVIDERS.items()):
+            llm_gateway.PROVIDERS[name] = config._replace(url=url, max_concurrency=options['provider_concurrency'])
+        llm_router.llm_gateway = llm_gateway.LLMGateway(llm_gateway.PROVIDERS)
+        llm_router.llm_router.providers = llm_router.llm_router.providers[:1]
+        llm_cache.disabled_call_types.add('questions')
+
+        ai_service = AIService()
+        levels = [int(c) for c in options['concurrency'].split(',') if c.strip()]
+        rows = []
+        try:
+            for concurrency in levels:
+                rows.append(self._run_sync(ai_service, server, concurrency, options['threads']))
+                rows.append(asyncio.run(self._run_async(ai_service, server, concurrency)))
+                for row in rows[-2:]:
+                    self.stderr.write(
+                        f"{row['mode']:>5} concurrency={row['concurrency']:<4} "
+                        f"throughput={row['throughput_rps']} rps p50={row['latency_p50']}s "
+                        f"p95={row['latency_p95']}s upstream in flight={row['peak_upstream_in_flight']} "
+                        f"errors={row['errors']}"
+                    )
+        finally:
+            server.shutdown()
+
+        report = {
+            'config': {
+                'latency': options['latency'],
+                'threads': options['threads'],
+                'provider_concurrency': options['provider_concurrency'],
+                'cpu_count': os.cpu_count(),
+            },
+            'results': rows,
+        }
+        payload = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(payload)
+        else:
+            self.stdout.write(payload)
+
+    def _run_sync(self, ai_service, server, concurrency, threads):
+        """同步模式：固定大小的线程池处理全部请求，与 WSGI worker 线程一一对应"""
+        server.reset_peak()
+        latencies, errors = [], 0
+        started = time.perf_counter()
+
+        def one(i):
+            ai_service.generate_questions(f'压测描述 {i}')
+            return time.perf_counter() - started
+
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(one, i) for i in range(concurrency)]
+            for future in futures:
+                try:
+                    latencies.append(future.result())
+                except Exception:
+                    errors += 1
+        return _summarize('sync', concurrency, latencies, errors, time.perf_counter() - started,
+                          server.peak_in_flight)
+
+    async def _run_async(self, ai_service, server, concurrency):
+        """异步模式：单个事件循环同时处理全部请求"""
+        server.reset_peak()
+        started = time.perf_counter()
+
+        async def one(i):
+            await ai_service.agenerate_questions(f'压测描述 {i}')
+            return time.perf_counter() - started
+
+        results = await asyncio.gather(*(one(i) for i in range(concurrency)), return_exceptions=True)
+        latencies = [r for r in results if not isinstance(r, BaseException)]
+        return _summarize('async', concurrency, latencies, len(results) - len(latencies),
+                          time.perf_counter() - started, server.peak_in_flight)
@@ -0,0 +1,306 @@
+import re
+import json
+import math
+import time
+import random
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from django.core.management.base import BaseCommand, CommandError
+from diagnosis.services.report_service import REPORT_MARKER, TREATMENT_MARKER
+
+# 证型取自 doctor_recommendation 的常见证型，保证下游推荐能匹配到医生
+PATTERNS = ['气虚证', '阳虚证', '阴虚证', '痰湿证', '血瘀证', '肝郁证', '脾胃气虚', '肝郁气滞', '肾阳虚', '肾阴虚']
+
+QUESTIONS = [
+    '症状持续多长时间了？',
+    '是否伴有发热、怕冷或出汗？',
+    '最近的睡眠、食欲和大小便情况如何？',
+    '症状在一天中什么时候最明显？',
+    '情绪或劳累后症状是否加重？',
+]
+
+REPORT_TEMPLATE = """**辨证论治**
+
+患者自述：{description}
+
+- 八纲辨证：证属里证、虚证，寒热不显。
+- 病因病机：劳倦内伤，脏腑功能失调，气血运行不畅。
+- 证型：{pattern}。
+
+结合问诊记录，目前未见需要紧急就医的危险信号；如症状持续加重，请及时到医院就诊。"""
+
+TREATMENT_TEMPLATE = """1. 推荐方剂：针对{pattern}，可在医生指导下选用相应方剂加减，请勿自行用药。
+2. 针灸建议：可选足三里、关元、气海等穴位，需由专业医师操作。
+3. 生活调理：规律作息，避免熬夜和过度劳累，适度运动。
+4. 饮食指导：饮食清淡，少食生冷油腻，可适量食用山药、红枣。
+5. 注意事项：孕妇及慢性病患者用药前请咨询医生。"""
+
+_DESCRIPTION = re.compile(r'患者(?:自述|描述)[：:]\s*(.*?)(?:\n\s*\n|$)', re.S)
+
+
+def parse_latency(spec: str):
+    """
+    解析延迟分布，返回采样函数（秒）
+
+    支持：2（固定）、fixed:2、uniform:1,3、normal:均值,标准差、
+    lognormal:中位数,sigma、exp:均值
+    """
+    kind, _, args = spec.partition(':')
+    if not args:
+        kind, args = 'fixed', kind
+    try:
+        values = [float(v) for v in args.split(',')]
+    except ValueError:
+        raise CommandError(f'无法解析延迟分布: {spec}')
+    expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2, 'exp': 1}
+    if expected.get(kind) != len(values):
+        raise CommandError(f'无法解析延迟分布: {spec}')
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0.0)
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+
+
+def classify(prompt: str) -> str:
+    """按提示词判断调用类型，与 ai_service / report_service 的提示词对应"""
+    if REPORT_MARKER in prompt and TREATMENT_MARKER in prompt:
+        return 'report_treatment'
+    if '医疗问题' in prompt:
+        return 'questions'
+    if '治疗方案' in prompt and '诊断报告' not in prompt:
+        return 'treatment'
+    return 'report'
+
+
+def render(call_type: str, prompt: str) -> str:
+    """按调用类型返回模板文本，证型按患者描述固定选取，同一描述的结果一致"""
+    match = _DESCRIPTION.search(prompt)
+    description = match.group(1).strip() if match else ''
+    seed = sum(map(ord, description))
+    if call_type == 'questions':
+        return '\n'.join(QUESTIONS[(seed + i) % len(QUESTIONS)] for i in range(3))
+    pattern = PATTERNS[seed % len(PATTERNS)]
+    report = REPORT_TEMPLATE.format(description=description or '（无）', pattern=pattern)
+    treatment = TREATMENT_TEMPLATE.format(pattern=pattern)
+    if call_type == 'report_treatment':
+        return f'{REPORT_MARKER}\n{report}\n{TREATMENT_MARKER}\n{treatment}'
+    return treatment if call_type == 'treatment' else report
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, latencies: dict, error_rate: float, rate_limit_rate: float,
+                 retry_after: float, chunk_chars: int, seed: int = None):
+        self.latencies = latencies
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.chunk_chars = chunk_chars
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        super().__init__(address, StandinHandler)
+
+    def decide(self, call_type: str) -> tuple:
+        """返回 (状态码, 延迟)；随机数生成器不是线程安全的，需加锁"""
+        with self.lock:
+            roll = self.rng.random()
+            if roll < self.rate_limit_rate:
+                return 429, 0.0
+            if roll < self.rate_limit_rate + self.error_rate:
+                return 500, self.latencies[call_type](self.rng) / 2
+            return 200, self.latencies[call_type](self.rng)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'requests': sum(self.counts.values()),
+                'by_outcome': {f'{fmt} {call_type} {status}': n for (fmt, call_type, status), n in sorted(self.counts.items())},
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+            }
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    模拟百炼和火山引擎的文本生成接口
+
+    请求体包含 input.messages 的按百炼格式处理，包含 messages 的按火山引擎格式处理；
+    请求头 X-DashScope-SSE: enable、Accept: text/event-stream 或 stream=true 时以 SSE 返回。
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.rstrip('/') != '/stats':
+            return self._send_json(404, {'message': 'not found'})
+        self._send_json(200, self.server.stats())
+
+    def do_POST(self):
+        server = self.server
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        except ValueError:
+            return self._send_json(400, {'code': 'InvalidParameter', 'message': 'invalid json'})
+        dashscope = 'input' in body
+        messages = (body.get('input') or {}).get('messages') if dashscope else body.get('messages')
+        if not messages:
+            return self._send_json(400, {'code': 'InvalidParameter', 'message': 'messages is required'})
+        prompt = messages[-1].get('content', '')
+        stream = (
+            self.headers.get('X-DashScope-SSE') == 'enable'
+            or 'text/event-stream' in (self.headers.get('Accept') or '')
+            or bool(body.get('stream'))
+        )
+        fmt = 'dashscope' if dashscope else 'volcano'
+        call_type = classify(prompt)
+        status, latency = server.decide(call_type)
+
+        with server.lock:
+            server.counts[(fmt, call_type, status)] += 1
+            server.in_flight += 1
+            server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+        try:
+            if status == 429:
+                return self._send_json(429, {'code': 'Throttling', 'message': 'Requests rate limit exceeded'},
+                                       {'Retry-After': f'{server.retry_after:g}'})
+            if status != 200:
+                time.sleep(latency)
+                return self._send_json(status, {'code': 'InternalError', 'message': 'simulated error'})
+
+            text = render(call_type, prompt)
+            usage = self._usage(dashscope, len(prompt), len(text))
+            if stream:
+                self._stream(dashscope, text, usage, latency)
+            else:
+                time.sleep(latency)
+                self._send_json(200, {'output': {'text': text, 'finish_reason': 'stop'}, 'usage': usage,
+                                      'request_id': self._request_id()})
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _stream(self, dashscope: bool, text: str, usage: dict, latency: float):
+        """首段在总延迟的 20% 后输出，其余分段在剩余时间内均匀输出"""
+        size = self.server.chunk_chars
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or ['']
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        time.sleep(latency * 0.2)
+        interval = latency * 0.8 / len(chunks)
+        request_id = self._request_id()
+        for i, chunk in enumerate(chunks):
+            if i:
+                time.sleep(interval)
+            last = i == len(chunks) - 1
+            if dashscope:
+                event = {'output': {'text': chunk, 'finish_reason': 'stop' if last else 'null'},
+                         'usage': usage, 'request_id': request_id}
+                frame = f'id:{i + 1}\nevent:result\ndata:{json.dumps(event, ensure_ascii=False)}\n\n'
+            else:
+                event = {'choices': [{'index': 0, 'delta': {'content': chunk},
+                                      'finish_reason': 'stop' if last else None}]}
+                if last:
+                    event['usage'] = usage
+                frame = f'data: {json.dumps(event, ensure_ascii=False)}\n\n'
+            self.wfile.write(frame.encode('utf-8'))
+            self.wfile.flush()
+        if not dashscope:
+            self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+    @staticmethod
+    def _usage(dashscope: bool, input_tokens: int, output_tokens: int) -> dict:
+        # 中文约一字一个 token
+        if dashscope:
+            return {'input_tokens': input_tokens, 'output_tokens': output_tokens,
+                    'total_tokens': input_tokens + output_tokens}
+        return {'prompt_tokens': input_tokens, 'completion_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens}
+
+    def _request_id(self) -> str:
+        with self.server.lock:
+            return f'standin-{self.server.rng.getrandbits(64):016x}'
+
+    def _send_json(self, status: int, data: dict, headers: dict = None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        '启动本地模拟大模型服务，兼容百炼和火山引擎的请求/响应格式（含 SSE 流式输出），'
+        '按调用类型返回模板化的中医文本，并可配置延迟分布、错误率和 429 比例，用于离线压测整个诊断流程。'
+        '将 DASHSCOPE_URL / VOLCANO_URL 指向本服务即可。'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8900)
+        parser.add_argument(
+            '--latency', action='append', default=[],
+            help='延迟分布，如 2、uniform:1,3、normal:2,0.5、lognormal:2,0.5（中位数,sigma）、exp:2；'
+                 '可加调用类型前缀单独设置，如 report=lognormal:20,0.3（可重复）',
+        )
+        parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='返回 429 的比例')
+        parser.add_argument('--retry-after', type=float, default=1.0, help='429 响应的 Retry-After（秒）')
+        parser.add_argument('--chunk-chars', type=int, default=20, help='流式输出每段的字数')
+        parser.add_argument('--seed', type=int, help='随机种子，固定后延迟和错误序列可复现')
+
+    def handle(self, *args, **options):
+        if not 0 <= options['error_rate'] + options['rate_limit_rate'] <= 1:
+            raise CommandError('--error-rate 与 --rate-limit-rate 之和须在 0 到 1 之间')
+
+        default = parse_latency('1')
+        overrides = {}
+        for spec in options['latency']:
+            call_type, sep, dist = spec.partition('=')
+            if sep:
+                overrides[call_type.strip()] = parse_latency(dist.strip())
+            else:
+                default = parse_latency(spec.strip())
+        latencies = {
+            call_type: overrides.get(call_type, default)
+            for call_type in ('questions', 'report', 'treatment', 'report_treatment')
+        }
+
+        server = StandinServer(
+            (options['host'], options['port']), latencies, options['error_rate'],
+            options['rate_limit_rate'], options['retry_after'], max(options['chunk_chars'], 1), options['seed'],
+        )
+        base = f"http://{options['host']}:{server.server_port}"
+        self.stdout.write(
+            f'模拟大模型服务已启动: {base}\n'
+            f'  DASHSCOPE_URL={base}/api/v1/services/aigc/text-generation/generation\n'
+            f'  VOLCANO_URL={base}/v1/text_generation\n'
+            f'  统计: GET {base}/stats'
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(json.dumps(server.stats(), ensure_ascii=False, indent=2))
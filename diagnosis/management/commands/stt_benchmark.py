@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import platform
+import resource
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from funasr.utils.postprocess_utils import rich_transcription_postprocess
+from diagnosis.services import audio_decode, stt
+from diagnosis.services.stt_batcher import BatchScheduler
+from .stt_onnx_parity import _collect_files
+
+DEFAULT_DURATIONS = '5,15,30,60,120,300'
+
+
+def _percentile(values, q):
+    return round(float(np.percentile(values, q)), 4) if values else None
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 计，macOS 以字节计
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+
+def _generate_clip(path: str, seconds: float, seed: int):
+    """生成带音节包络的带限噪声，用于测量吞吐（不用于评估准确率）"""
+    rng = np.random.default_rng(seed)
+    samples = int(seconds * stt.SAMPLE_RATE)
+    t = np.arange(samples) / stt.SAMPLE_RATE
+    noise = np.convolve(rng.standard_normal(samples), np.ones(8) / 8, mode='same')
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None) * (np.sin(2 * np.pi * 0.2 * t) > -0.5)
+    pcm = (noise * envelope * 0.3 * 32767).astype('<i2')
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(stt.SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+
+
+def _summarize(results, wall_seconds):
+    latencies = [r['latency_s'] for r in results]
+    audio_seconds = sum(r['audio_s'] for r in results)
+    return {
+        'clips': len(results),
+        'audio_seconds': round(audio_seconds, 2),
+        'decode_seconds': round(sum(r['decode_s'] for r in results), 4),
+        'inference_seconds': round(sum(r['inference_s'] for r in results), 4),
+        'rtf_mean': round(float(np.mean([r['rtf'] for r in results])), 4) if results else None,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p95': _percentile(latencies, 95),
+        'wall_seconds': round(wall_seconds, 4),
+        'throughput_audio_seconds_per_second': round(audio_seconds / wall_seconds, 3) if wall_seconds else None,
+        'throughput_clips_per_second': round(len(results) / wall_seconds, 3) if wall_seconds else None,
+    }
+
+
+class Command(BaseCommand):
+    help = '语音识别性能基准：测量解码/推理耗时、实时率（RTF）、延迟分位数、峰值内存和并发吞吐'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', nargs='*', default=[], help='音频文件或目录，不指定时生成合成音频')
+        parser.add_argument('--durations', default=DEFAULT_DURATIONS, help='生成音频的时长列表（秒，逗号分隔）')
+        parser.add_argument('--repeat', type=int, default=1, help='每条音频重复次数')
+        parser.add_argument('--concurrency', type=int, default=1, help='并发调用方数量')
+        parser.add_argument('--batching', action='store_true', help='并发调用经过批处理调度器')
+        parser.add_argument('--batch-size', type=int, default=stt.batch_size, help='generate 的 batch_size')
+        parser.add_argument('--ncpu', type=int, default=stt.cpu_num, help='CPU 推理线程数')
+        parser.add_argument('--device', default=stt.device_type, help='推理设备')
+        parser.add_argument('--backend', default=stt.stt_backend, choices=['torch', 'onnx'], help='推理后端')
+        parser.add_argument('--no-vad', action='store_true', help='不使用 VAD')
+        parser.add_argument('--decode-cache', action='store_true', help='允许复用已解码的 PCM 缓存')
+        parser.add_argument('--warmup', type=int, default=1, help='正式计时前的预热次数')
+        parser.add_argument('--output', help='JSON 结果输出文件，默认输出到标准输出')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp(prefix='ctd_stt_bench_')
+        try:
+            report = self._run(options, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        payload = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(payload)
+            self.stderr.write(f'结果已写入 {options["output"]}')
+        else:
+            self.stdout.write(payload)
+
+    def _run(self, options, workdir):
+        if options['corpus']:
+            files = _collect_files(options['corpus'])
+            if not files:
+                raise CommandError('语料目录中没有音频文件')
+        else:
+            durations = [float(d) for d in options['durations'].split(',') if d.strip()]
+            files = []
+            for i, seconds in enumerate(durations):
+                path = os.path.join(workdir, f'synthetic_{int(seconds)}s.wav')
+                _generate_clip(path, seconds, seed=i)
+                files.append(path)
+
+        audio_decode.pcm_cache_dir = os.path.join(workdir, 'pcm')
+
+        vad = not options['no_vad']
+        started = time.perf_counter()
+        model = stt.initialize_model(
+            vad=vad, device=options['device'], ncpu=options['ncpu'], backend=options['backend']
+        )
+        load_seconds = time.perf_counter() - started
+
+        generate_kwargs = {
+            'language': stt.language,
+            'use_itn': stt.use_itn,
+            'merge_vad': True,
+            'batch_size': options['batch_size'],
+        }
+        scheduler = BatchScheduler(lambda: model, generate_kwargs) if options['batching'] else None
+        model_lock = threading.Lock()
+
+        def run_one(path):
+            submitted = time.perf_counter()
+            # 默认每次都真实解码，测得的是未命中缓存时的耗时
+            data = stt.load_audio(path, use_cache=options['decode_cache'])
+            decoded = time.perf_counter()
+            if data is None:
+                raise CommandError(f'无法解码 {path}')
+
+            if scheduler is not None:
+                raw = scheduler.transcribe(np.array(data))
+            else:
+                # 单个模型实例，未启用批处理时并发调用方依次推理
+                with model_lock:
+                    raw = model.generate(input=np.array(data), cache={}, **generate_kwargs)[0]['text']
+            text = rich_transcription_postprocess(raw)
+            finished = time.perf_counter()
+
+            audio_seconds = len(data) / stt.SAMPLE_RATE
+            return {
+                'file': os.path.basename(path),
+                'audio_s': round(audio_seconds, 3),
+                'decode_s': round(decoded - submitted, 4),
+                'inference_s': round(finished - decoded, 4),
+                'latency_s': round(finished - submitted, 4),
+                'rtf': round((finished - submitted) / audio_seconds, 4) if audio_seconds else None,
+                'chars': len(text),
+            }
+
+        for _ in range(options['warmup']):
+            run_one(files[0])
+
+        jobs = [path for path in files for _ in range(options['repeat'])]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, options['concurrency'])) as executor:
+            results = list(executor.map(run_one, jobs))
+        wall_seconds = time.perf_counter() - started
+
+        by_file = {}
+        for result in results:
+            by_file.setdefault(result['file'], []).append(result)
+
+        return {
+            'config': {
+                'backend': options['backend'],
+                'device': options['device'],
+                'ncpu': options['ncpu'],
+                'vad': vad,
+                'batch_size': options['batch_size'],
+                'batching': options['batching'],
+                'concurrency': options['concurrency'],
+                'repeat': options['repeat'],
+                'decode_cache': options['decode_cache'],
+                'corpus': 'synthetic' if not options['corpus'] else options['corpus'],
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'numpy': np.__version__,
+            },
+            'model_load_seconds': round(load_seconds, 3),
+            'peak_rss_mb': _peak_rss_mb(),
+            'summary': _summarize(results, wall_seconds),
+            'per_file': {
+                name: _summarize(items, sum(r['latency_s'] for r in items)) for name, items in by_file.items()
+            },
+            'batching': scheduler.stats() if scheduler is not None else None,
+            'results': results,
+        }
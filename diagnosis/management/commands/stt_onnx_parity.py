@@ -0,0 +1,100 @@
+import os
+import time
+import editdistance
+from django.core.management.base import BaseCommand, CommandError
+from funasr.utils.postprocess_utils import rich_transcription_postprocess
+from diagnosis.services import stt
+from diagnosis.services.audio_decode import AudioDecodeError, decode_audio
+
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.m4a', '.aac', '.flac', '.ogg', '.amr', '.pcm', '.webm')
+
+
+def _collect_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(
+                    os.path.join(root, name) for name in sorted(names)
+                    if name.lower().endswith(AUDIO_EXTENSIONS)
+                )
+        else:
+            files.append(path)
+    return files
+
+
+def _cer(reference: str, hypothesis: str) -> float:
+    """字错误率"""
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    return editdistance.eval(reference, hypothesis) / len(reference)
+
+
+class Command(BaseCommand):
+    help = '对比 PyTorch 与 ONNX（量化）推理后端的识别结果一致性和速度'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='音频文件或目录')
+        parser.add_argument('--threshold', type=float, default=0.02, help='允许的平均字错误率（CER）')
+        parser.add_argument('--ncpu', type=int, default=stt.cpu_num, help='CPU 推理线程数')
+        parser.add_argument('--no-vad', action='store_true', help='不使用 VAD 切分')
+
+    def handle(self, *args, **options):
+        files = _collect_files(options['paths'])
+        if not files:
+            raise CommandError('没有找到音频文件')
+
+        vad = not options['no_vad']
+        ncpu = options['ncpu']
+        torch_model = stt.initialize_model(vad=vad, device='cpu', ncpu=ncpu, backend='torch')
+        onnx_model = stt.initialize_model(vad=vad, device='cpu', ncpu=ncpu, backend='onnx')
+
+        total_cer = 0.0
+        torch_seconds = onnx_seconds = audio_seconds = 0.0
+        compared = 0
+        for path in files:
+            try:
+                data = decode_audio(path)
+            except AudioDecodeError as e:
+                self.stderr.write(f'跳过 {path}: {str(e)}')
+                continue
+
+            texts = []
+            for model in (torch_model, onnx_model):
+                started = time.perf_counter()
+                res = model.generate(
+                    input=data,
+                    cache={},
+                    language=stt.language,
+                    use_itn=stt.use_itn,
+                    merge_vad=True,
+                    batch_size=stt.batch_size,
+                )
+                texts.append((rich_transcription_postprocess(res[0]['text']), time.perf_counter() - started))
+
+            (torch_text, torch_time), (onnx_text, onnx_time) = texts
+            cer = _cer(torch_text, onnx_text)
+            total_cer += cer
+            torch_seconds += torch_time
+            onnx_seconds += onnx_time
+            audio_seconds += len(data) / stt.SAMPLE_RATE
+            compared += 1
+
+            self.stdout.write(f'{path}\n  CER={cer:.4f} torch={torch_time:.2f}s onnx={onnx_time:.2f}s')
+            if cer > 0:
+                self.stdout.write(f'  torch: {torch_text}\n  onnx:  {onnx_text}')
+
+        if not compared:
+            raise CommandError('没有可解码的音频文件')
+
+        mean_cer = total_cer / compared
+        audio_seconds = max(audio_seconds, 1e-6)
+        onnx_seconds = max(onnx_seconds, 1e-6)
+        self.stdout.write(
+            f'\n文件数: {compared}, 音频总时长: {audio_seconds:.1f}s\n'
+            f'平均 CER: {mean_cer:.4f}\n'
+            f'RTF torch: {torch_seconds / audio_seconds:.4f}, onnx: {onnx_seconds / audio_seconds:.4f}, '
+            f'加速比: {torch_seconds / onnx_seconds:.2f}x'
+        )
+        if mean_cer > options['threshold']:
+            raise CommandError(f'平均 CER {mean_cer:.4f} 超过阈值 {options["threshold"]}')
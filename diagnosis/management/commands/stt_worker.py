@@ -0,0 +1,108 @@
+import os
+import time
+import signal
+import logging
+import multiprocessing
+import redis
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from diagnosis.services import stt_queue
+from diagnosis.services.stt import model_registry
+from diagnosis.tasks import mark_audio_failed, process_audio_task
+
+logger = logging.getLogger('diagnosis')
+
+# 每隔多少次轮询检查一次过期租约
+REQUEUE_EVERY = 6
+
+
+def run_worker(index: int, poll_timeout: int):
+    """单个工作进程：预加载模型后循环消费任务队列"""
+    stopping = False
+
+    def _stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    client = stt_queue.worker_client()
+    model_registry.warm_up()
+    logger.info(f'语音识别工作进程 {index}（pid {os.getpid()}）已就绪')
+
+    polls = 0
+    while not stopping:
+        try:
+            if polls % REQUEUE_EVERY == 0:
+                requeued = stt_queue.requeue_expired(
+                    client, on_dead=lambda job: mark_audio_failed(int(job['description_id']), job.get('error', ''))
+                )
+                if requeued:
+                    logger.warning(f'语音识别工作进程 {index} 重新投递了 {requeued} 个租约过期的任务')
+            polls += 1
+
+            job = stt_queue.reserve(client, timeout=poll_timeout)
+            if job is None:
+                continue
+
+            close_old_connections()
+            logger.info(f'语音识别工作进程 {index} 开始处理任务 {job["id"]}（自述 {job["description_id"]}）')
+            final_attempt = job['attempts'] >= stt_queue.max_attempts
+            if process_audio_task(job['description_id'], final_attempt):
+                stt_queue.ack(client, job['id'])
+            elif stt_queue.fail(client, job['id'], 'transcription failed'):
+                # 异常导致的失败不会更新状态，进入死信队列后统一标记
+                mark_audio_failed(job['description_id'], '语音识别失败')
+        except redis.RedisError as e:
+            logger.error(f'语音识别工作进程 {index} Redis 出错: {str(e)}')
+            # 等待 Redis 恢复
+            time.sleep(poll_timeout)
+
+    logger.info(f'语音识别工作进程 {index} 已停止')
+
+
+class Command(BaseCommand):
+    help = '启动语音转文字工作进程，从 Redis 任务队列中消费转写任务'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=int(os.getenv('STT_WORKERS', 1)),
+            help='工作进程数量，每个进程持有一份预加载的模型'
+        )
+        parser.add_argument(
+            '--poll-timeout', type=int, default=5,
+            help='阻塞读取队列的超时时间（秒）'
+        )
+
+    def handle(self, *args, **options):
+        if not stt_queue.is_available():
+            raise CommandError('REDIS_URL 未配置，无法启动语音转文字工作进程')
+
+        workers = max(1, options['workers'])
+        poll_timeout = options['poll_timeout']
+
+        if workers == 1:
+            run_worker(0, poll_timeout)
+            return
+
+        # 子进程不能复用父进程的数据库连接
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(i, poll_timeout), name=f'stt-worker-{i}')
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        self.stdout.write(f'Started {workers} STT workers')
+
+        def _shutdown(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, _shutdown)
+        signal.signal(signal.SIGINT, _shutdown)
+
+        for process in processes:
+            process.join()
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def mark_processed_completed(apps, schema_editor):
+    UserDescription = apps.get_model('diagnosis', 'UserDescription')
+    UserDescription.objects.filter(processed=True).update(status='completed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diagnosis', '0004_add_sample_doctors'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userdescription',
+            name='status',
+            field=models.CharField(choices=[('pending', '待处理'), ('processing', '处理中'), ('completed', '已完成'), ('error', '错误')], default='pending', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='userdescription',
+            name='error_message',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='userdescription',
+            name='job_id',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+        migrations.RunPython(mark_processed_completed, migrations.RunPython.noop),
+    ]
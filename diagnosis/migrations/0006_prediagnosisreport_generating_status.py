@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diagnosis', '0005_userdescription_status'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='prediagnosisreport',
+            name='status',
+            field=models.CharField(choices=[('pending', '待处理'), ('processing', '处理中'), ('generating', '报告生成中'), ('completed', '已完成'), ('error', '错误')], default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('diagnosis', '0006_prediagnosisreport_generating_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TCMPattern',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='证型')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+            ],
+            options={
+                'verbose_name': '证型',
+                'verbose_name_plural': '证型',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TCMPatternSynonym',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='同义词')),
+                ('pattern', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='synonyms', to='diagnosis.tcmpattern', verbose_name='证型')),
+            ],
+            options={
+                'verbose_name': '证型同义词',
+                'verbose_name_plural': '证型同义词',
+                'ordering': ['pattern', 'name'],
+            },
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations
+
+# 原 extract_patterns 中的常见证型
+COMMON_PATTERNS = [
+    '气虚证', '阳虚证', '阴虚证', '痰湿证', '血瘀证', '肝郁证',
+    '脾胃气虚', '肝郁气滞', '肾阳虚', '肾阴虚'
+]
+
+# 证型 -> 同义词或别称。医生填写的证型如果是某个证型的同义词，则归入该证型
+SYNONYMS = {
+    '气虚证': ['气虚'],
+    '阳虚证': ['阳虚'],
+    '阴虚证': ['阴虚'],
+    '痰湿证': ['痰湿'],
+    '血瘀证': ['血瘀', '瘀血'],
+    '肝郁证': ['肝郁', '肝气郁结'],
+    '肝郁气滞': ['肝气郁滞'],
+    '脾胃气虚': ['脾胃气虚证'],
+    '肾阳虚': ['肾阳虚证', '肾阳不足'],
+    '肾阴虚': ['肾阴虚证', '肾阴不足'],
+    '痰湿阻肺': ['痰湿蕴肺'],
+    '肺阴亏虚': ['肺阴虚'],
+    '肝阳上亢': ['肝阳上亢证'],
+    '肝胃不和': ['肝胃不和证'],
+    '气滞血瘀': ['血瘀气滞', '气滞血瘀证'],
+    '气阴两虚': ['气阴两虚证'],
+    '肝肾阴虚': ['肝肾阴亏'],
+}
+
+
+def seed_patterns(apps, schema_editor):
+    Doctor = apps.get_model('diagnosis', 'Doctor')
+    TCMPattern = apps.get_model('diagnosis', 'TCMPattern')
+    TCMPatternSynonym = apps.get_model('diagnosis', 'TCMPatternSynonym')
+
+    synonyms = {synonym for values in SYNONYMS.values() for synonym in values}
+    names = list(COMMON_PATTERNS) + list(SYNONYMS)
+    for tcm_patterns in Doctor.objects.values_list('tcm_patterns', flat=True):
+        names.extend(p.strip() for p in tcm_patterns.split(',') if p.strip())
+
+    for name in dict.fromkeys(names):
+        if name not in synonyms:
+            TCMPattern.objects.get_or_create(name=name)
+    for name, values in SYNONYMS.items():
+        pattern = TCMPattern.objects.get(name=name)
+        for synonym in values:
+            TCMPatternSynonym.objects.get_or_create(name=synonym, defaults={'pattern': pattern})
+
+
+def remove_patterns(apps, schema_editor):
+    apps.get_model('diagnosis', 'TCMPattern').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('diagnosis', '0007_tcmpattern_tcmpatternsynonym'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_patterns, remove_patterns),
+    ]
@@ -9,6 +9,7 @@ class PreDiagnosisReport(models.Model):
     STATUS_CHOICES = [
         ('pending', '待处理'),
         ('processing', '处理中'),
+        ('generating', '报告生成中'),
         ('completed', '已完成'),
         ('error', '错误')
     ]
@@ -62,6 +63,23 @@ class PreDiagnosisReport(models.Model):
             return 'waiting_for_report'
         return 'completed'
 
+    def apply_generated_parts(self, report_content=None, treatment_plan=None):
+        """写入生成结果并更新状态（不保存），返回仍需重新生成的字段"""
+        if report_content:
+            self.report_content = report_content
+        if treatment_plan:
+            self.treatment_plan = treatment_plan
+        retry_required = [
+            field for field in ('report_content', 'treatment_plan') if not getattr(self, field)
+        ]
+        if retry_required:
+            self.status = 'error'
+            self.error_message = f'以下内容生成失败，请重试: {", ".join(retry_required)}'
+        else:
+            self.status = 'completed'
+            self.error_message = ''
+        return retry_required
+
     class Meta:
         ordering = ['-created_at']
 
@@ -96,6 +114,13 @@ class DiagnosisImage(models.Model):
 
 class UserDescription(models.Model):
     """用户自述"""
+    STATUS_CHOICES = [
+        ('pending', '待处理'),
+        ('processing', '处理中'),
+        ('completed', '已完成'),
+        ('error', '错误')
+    ]
+
     report = models.OneToOneField(
         PreDiagnosisReport,
         on_delete=models.CASCADE,
@@ -106,6 +131,15 @@ class UserDescription(models.Model):
     uploaded_at = models.DateTimeField(auto_now_add=True)
     processed = models.BooleanField(default=False)
 
+    # 语音转文字状态
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='pending'
+    )
+    error_message = models.TextField(blank=True)
+    job_id = models.CharField(max_length=32, blank=True)
+
     class Meta:
         ordering = ['uploaded_at']
 
@@ -184,7 +218,40 @@ class Doctor(models.Model):
         }
         return weights.get(self.title, 0.5)
 
+    @property
+    def rating_score(self):
+        """评分分数 (0-1)：评分占 70%，接诊量占 30%（假设 5000 是一个较好的接诊量基准）"""
+        return (self.rating / 5.0 * 0.7) + (min(self.patients_count / 5000, 1.0) * 0.3)
+
     @property
     def pattern_list(self):
         """获取证型列表"""
         return [p.strip() for p in self.tcm_patterns.split(',') if p.strip()]
+
+
+class TCMPattern(models.Model):
+    """中医证型词典，用于从报告中提取证型并统一医生的擅长证型"""
+    name = models.CharField('证型', max_length=50, unique=True)
+    created_at = models.DateTimeField('创建时间', auto_now_add=True)
+
+    class Meta:
+        ordering = ['name']
+        verbose_name = '证型'
+        verbose_name_plural = '证型'
+
+    def __str__(self):
+        return self.name
+
+
+class TCMPatternSynonym(models.Model):
+    """证型的同义词或别称，提取时统一为对应的证型"""
+    pattern = models.ForeignKey(TCMPattern, on_delete=models.CASCADE, related_name='synonyms', verbose_name='证型')
+    name = models.CharField('同义词', max_length=50, unique=True)
+
+    class Meta:
+        ordering = ['pattern', 'name']
+        verbose_name = '证型同义词'
+        verbose_name_plural = '证型同义词'
+
+    def __str__(self):
+        return f"{self.name} -> {self.pattern.name}"
@@ -13,8 +13,11 @@ class DiagnosisImageSerializer(serializers.ModelSerializer):
 class UserDescriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserDescription
-        fields = ['id', 'report', 'audio', 'text_content', 'uploaded_at', 'processed']
-        read_only_fields = ['text_content', 'uploaded_at', 'processed']
+        fields = [
+            'id', 'report', 'audio', 'text_content', 'uploaded_at', 'processed',
+            'status', 'error_message', 'job_id'
+        ]
+        read_only_fields = ['text_content', 'uploaded_at', 'processed', 'status', 'error_message', 'job_id']
 
 class DiagnosisAnswerSerializer(serializers.ModelSerializer):
     class Meta:
@@ -1,20 +1,21 @@
 import logging
-import requests
 import os
 from dotenv import load_dotenv
+from .llm_cache import cached_llm_call
+from .llm_async import acall
 
 # 加载环境变量
 load_dotenv()
 
 logger = logging.getLogger('diagnosis')
 
+# 用户自述转为文字后是否在后台预生成问题
+pregeneration_enabled = os.getenv("QUESTION_PREGENERATION", "true").lower() not in ("0", "false", "no", "off")
+
 class AIService:
     def __init__(self):
-        # DashScope配置
-        self.dashscope_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        # 服务商地址、模型、连接池和路由由 llm_gateway / llm_router 统一管理
         self.dashscope_api_key = os.getenv('DASHSCOPE_API_KEY')
-        # 火山引擎配置
-        self.volcano_url = "https://open.volcengineapi.com/v1/text_generation"
         self.volcano_api_key = os.getenv('VOLCANO_API_KEY')
         
         if not self.dashscope_api_key:
@@ -22,68 +23,34 @@ class AIService:
         if not self.volcano_api_key:
             raise ValueError("VOLCANO_API_KEY environment variable is not set")
 
-    def _call_dashscope(self, prompt):
-        """调用阿里百炼API"""
-        headers = {
-            "Authorization": f"Bearer {self.dashscope_api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            self.dashscope_url,
-            headers=headers,
-            json={
-                "model": "qwen-max",
-                "input": {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ]
-                },
-                "parameters": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "result_format": "text"
-                }
-            }
-        )
+    def _build_prompt(self, user_description):
+        """构建生成问题的提示词"""
+        return f"""基于以下患者症状描述，生成3个最相关的医疗问题，以帮助进一步了解病情：
         
-        if response.status_code != 200:
-            raise Exception(f"百炼API调用失败: {response.text}")
-            
-        return response.json()["output"]["text"].strip()
-
-    def _call_volcano(self, prompt):
-        """调用火山引擎API"""
-        headers = {
-            "Authorization": f"Bearer {self.volcano_api_key}",
-            "Content-Type": "application/json"
-        }
+        患者描述：{user_description}
         
-        response = requests.post(
-            self.volcano_url,
-            headers=headers,
-            json={
-                "model": "chatglm3-6b",  # 使用ChatGLM3作为备选模型
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                "parameters": {
-                    "temperature": 0.7,
-                    "top_p": 0.9
-                }
-            }
-        )
+        请生成3个问题，每个问题应该：
+        1. 针对性强，直接关联症状
+        2. 有助于进一步诊断
+        3. 简洁明了，易于回答
         
-        if response.status_code != 200:
-            raise Exception(f"火山引擎API调用失败: {response.text}")
-            
-        return response.json()["output"]["text"].strip()
+        注意：请直接返回3个问题，每个问题占一行，不要有编号或其他额外内容。"""
+
+    @staticmethod
+    def _split_questions(response_text):
+        """每行一个问题，取前三个"""
+        return [q.strip() for q in response_text.split('\n') if q.strip()][:3]
+
+    def _is_complete(self, response_text):
+        """回复能解析出三个问题时才写入缓存，否则重试时会一直读到同一个无效回复"""
+        return len(self._split_questions(response_text)) == 3
+
+    def _parse_questions(self, response_text):
+        """处理响应：每行一个问题，取前三个"""
+        questions = self._split_questions(response_text)
+        if len(questions) != 3:
+            raise ValueError("未能生成足够的问题")
+        return questions
 
     def generate_questions(self, user_description):
         """
@@ -95,33 +62,24 @@ class AIService:
         Returns:
             list: 包含三个问题的列表
         """
-        # 构建提示词
-        prompt = f"""基于以下患者症状描述，生成3个最相关的医疗问题，以帮助进一步了解病情：
-        
-        患者描述：{user_description}
-        
-        请生成3个问题，每个问题应该：
-        1. 针对性强，直接关联症状
-        2. 有助于进一步诊断
-        3. 简洁明了，易于回答
-        
-        注意：请直接返回3个问题，每个问题占一行，不要有编号或其他额外内容。"""
+        prompt = self._build_prompt(user_description)
 
         try:
-            # 首先尝试调用百炼API
-            try:
-                response_text = self._call_dashscope(prompt)
-            except Exception as e:
-                logger.warning(f"百炼API调用失败，尝试使用火山引擎: {str(e)}")
-                response_text = self._call_volcano(prompt)
+            # 相同提示词优先读缓存；否则优先百炼，慢于其 p95 时对冲到火山引擎，失败或熔断时直接切换
+            response_text = cached_llm_call(prompt, call_type="questions", cacheable=self._is_complete).text
+            return self._parse_questions(response_text)
+
+        except Exception as e:
+            logger.error(f'Failed to generate questions: {str(e)}')
+            raise
 
-            # 处理响应
-            questions = [q.strip() for q in response_text.split('\n') if q.strip()][:3]
-            
-            if len(questions) != 3:
-                raise ValueError("未能生成足够的问题")
+    async def agenerate_questions(self, user_description):
+        """generate_questions 的异步版本，等待大模型期间不占用线程"""
+        prompt = self._build_prompt(user_description)
 
-            return questions
+        try:
+            response_text = (await acall(prompt, call_type="questions", cacheable=self._is_complete)).text
+            return self._parse_questions(response_text)
 
         except Exception as e:
             logger.error(f'Failed to generate questions: {str(e)}')
@@ -0,0 +1,223 @@
+import os
+import time
+import wave
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+import ffmpeg
+import numpy as np
+
+logger = logging.getLogger('diagnosis')
+
+SAMPLE_RATE = 16000
+
+# 允许的最长音频时长（秒）
+max_audio_seconds = float(os.getenv("STT_MAX_AUDIO_SECONDS", 600))
+
+# 解码后的 PCM 以内存映射文件形式缓存在该目录，重试和重新识别时无需再次解码
+pcm_cache_dir = os.getenv("STT_PCM_CACHE_DIR", os.path.join(tempfile.gettempdir(), "ctd_pcm"))
+
+# PCM 缓存文件的保留时间（秒）
+pcm_cache_ttl = float(os.getenv("STT_PCM_CACHE_TTL", 3600))
+
+# 每次从解码器读取的字节数
+READ_CHUNK_BYTES = 1 << 20
+
+_last_eviction = 0.0
+_eviction_lock = threading.Lock()
+
+
+class AudioDecodeError(ValueError):
+    """音频无法解码"""
+
+
+class AudioTooLongError(AudioDecodeError):
+    """音频超过允许的最长时长"""
+
+
+def _file_digest(file_path: str) -> str:
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(READ_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _evict_expired():
+    """清理过期的 PCM 缓存文件（每分钟最多扫描一次）"""
+    global _last_eviction
+    now = time.time()
+    if now - _last_eviction < 60 or not _eviction_lock.acquire(blocking=False):
+        return
+    try:
+        _last_eviction = now
+        for entry in os.scandir(pcm_cache_dir):
+            try:
+                if now - entry.stat().st_mtime > pcm_cache_ttl:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+    except OSError:
+        pass
+    finally:
+        _eviction_lock.release()
+
+
+class _PcmWriter:
+    """把解码出的 PCM 分块写入预分配的内存映射缓冲区，超过上限即报错"""
+
+    def __init__(self, path: str, max_samples: int):
+        self.path = path
+        self.max_samples = max_samples
+        # 稀疏文件，只有实际写入的页才占用磁盘和内存
+        self.buffer = np.memmap(path, dtype=np.float32, mode="w+", shape=(max(max_samples, 1),))
+        self.length = 0
+
+    def write(self, samples: np.ndarray):
+        end = self.length + len(samples)
+        if end > self.max_samples:
+            raise AudioTooLongError(f"音频时长超过 {self.max_samples // SAMPLE_RATE} 秒")
+        self.buffer[self.length:end] = samples
+        self.length = end
+
+    def close(self) -> int:
+        self.buffer.flush()
+        del self.buffer
+        os.truncate(self.path, self.length * 4)
+        return self.length
+
+
+def _decode_wav(file_path: str, writer: _PcmWriter, sr: int) -> bool:
+    """进程内解码 PCM 编码的 WAV，采样率不匹配或格式不支持时返回 False"""
+    try:
+        reader = wave.open(file_path, "rb")
+    except (wave.Error, EOFError):
+        return False
+
+    with reader:
+        width = reader.getsampwidth()
+        channels = reader.getnchannels()
+        if reader.getframerate() != sr or width not in (1, 2, 4):
+            return False
+
+        frames_per_chunk = max(READ_CHUNK_BYTES // (width * channels), 1)
+        while True:
+            data = reader.readframes(frames_per_chunk)
+            if not data:
+                break
+            if width == 1:
+                samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+            elif width == 2:
+                samples = np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768.0
+            else:
+                samples = np.frombuffer(data, dtype="<i4").astype(np.float32) / 2147483648.0
+            if channels > 1:
+                samples = samples.reshape(-1, channels).mean(axis=1)
+            writer.write(samples)
+    return True
+
+
+def _decode_raw_pcm(file_path: str, writer: _PcmWriter):
+    """进程内读取裸 PCM（约定为目标采样率下的单声道 s16le）"""
+    with open(file_path, "rb") as f:
+        remainder = b""
+        for block in iter(lambda: f.read(READ_CHUNK_BYTES), b""):
+            data = remainder + block
+            usable = len(data) - len(data) % 2
+            remainder = data[usable:]
+            writer.write(np.frombuffer(data[:usable], dtype="<i2").astype(np.float32) / 32768.0)
+
+
+def _decode_ffmpeg(file_path: str, writer: _PcmWriter, sr: int):
+    """
+    通过 ffmpeg 管道分块读取解码结果，避免一次性读入整段音频
+
+    stderr 写入临时文件而不是管道：读取 stdout 期间无人读取 stderr 管道，输出较多时 ffmpeg 会阻塞。
+    任何异常（超长、写入失败、请求取消）都会结束 ffmpeg 进程。
+    """
+    args = (
+        ffmpeg.input(file_path)
+        .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
+        .global_args("-loglevel", "error", "-nostdin")
+        .compile()
+    )
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr)
+        try:
+            remainder = b""
+            for block in iter(lambda: process.stdout.read(READ_CHUNK_BYTES), b""):
+                data = remainder + block
+                usable = len(data) - len(data) % 4
+                remainder = data[usable:]
+                writer.write(np.frombuffer(data[:usable], dtype="<f4"))
+            returncode = process.wait()
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+            process.stdout.close()
+
+        if returncode != 0:
+            stderr.seek(0)
+            raise AudioDecodeError(stderr.read().decode(errors="ignore").strip() or "ffmpeg 解码失败")
+
+
+def decode_audio(file_path: str, sr: int = SAMPLE_RATE, max_seconds: float = max_audio_seconds,
+                 use_cache: bool = True) -> np.ndarray:
+    """
+    解码音频文件为 16kHz 单声道 float32 PCM
+
+    WAV（PCM 编码且采样率匹配）和裸 PCM 在进程内解码，其他格式通过 ffmpeg 管道分块读取。
+    解码结果写入按文件内容寻址的内存映射文件，同一音频再次识别时直接映射，不再解码。
+
+    Args:
+        file_path: 音频文件路径
+        sr: 采样率
+        max_seconds: 允许的最长音频时长（秒）
+        use_cache: 是否读写 PCM 缓存，为 False 时总是重新解码且不留下缓存文件
+
+    Returns:
+        np.ndarray: 只读映射的音频数据（写入时复制，不影响缓存文件）
+
+    Raises:
+        AudioDecodeError: 音频无法解码
+        AudioTooLongError: 音频超过最长时长
+    """
+    os.makedirs(pcm_cache_dir, exist_ok=True)
+    try:
+        cache_path = os.path.join(pcm_cache_dir, f"{_file_digest(file_path)}_{sr}_{int(max_seconds)}.f32")
+    except OSError as e:
+        raise AudioDecodeError(f"无法读取音频文件: {str(e)}")
+
+    if not use_cache or not os.path.exists(cache_path):
+        _evict_expired()
+        part_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.part"
+        writer = _PcmWriter(part_path, int(max_seconds * sr))
+        try:
+            if os.path.splitext(file_path)[1].lower() == ".pcm":
+                _decode_raw_pcm(file_path, writer)
+            elif not _decode_wav(file_path, writer, sr):
+                _decode_ffmpeg(file_path, writer, sr)
+            writer.close()
+            if not use_cache:
+                if writer.length == 0:
+                    return np.zeros(0, dtype=np.float32)
+                # 映射建立后即可删除文件，映射在数组释放前一直有效
+                return np.memmap(part_path, dtype=np.float32, mode="c")
+            os.replace(part_path, cache_path)
+        except ffmpeg.Error as e:
+            raise AudioDecodeError(str(e))
+        except OSError as e:
+            raise AudioDecodeError(f"音频解码失败: {str(e)}")
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    else:
+        # 刷新访问时间，延长缓存有效期
+        os.utime(cache_path)
+
+    if os.path.getsize(cache_path) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return np.memmap(cache_path, dtype=np.float32, mode="c")
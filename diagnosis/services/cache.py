@@ -0,0 +1,127 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+import redis
+from .redis_client import get_redis
+
+logger = logging.getLogger('diagnosis')
+
+
+class TieredCache:
+    """
+    两级缓存：进程内 LRU + 可选的 Redis 共享层
+
+    读取时先查本地，未命中再查 Redis（命中后回填本地）；写入时两层同时写。
+    Redis 不可用时只记录警告并当作未命中处理，不影响主流程。
+    """
+
+    def __init__(self, namespace: str, max_entries: int = 1024, ttl: Optional[float] = None,
+                 use_redis: bool = True):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.use_redis = use_redis
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._local_hits = 0
+        self._redis_hits = 0
+        self._misses = 0
+        self._labels: dict = {}
+
+    def _redis_key(self, key: str) -> str:
+        return f"ctd:{self.namespace}:{key}"
+
+    def _get_local(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def _set_local(self, key: str, value: str, ttl: Optional[float]):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count_label(self, label: Optional[str], field: str):
+        if label is None:
+            return
+        with self._lock:
+            counts = self._labels.setdefault(label, {"hits": 0, "misses": 0})
+            counts[field] += 1
+
+    def get(self, key: str, label: Optional[str] = None) -> Optional[str]:
+        """
+        读取缓存
+
+        Args:
+            key: 缓存键
+            label: 统计标签（如调用类型），用于按标签统计命中率
+        """
+        value = self._get_local(key)
+        if value is not None:
+            self._local_hits += 1
+            self._count_label(label, "hits")
+            return value
+
+        client = get_redis() if self.use_redis else None
+        if client is not None:
+            try:
+                raw = client.get(self._redis_key(key))
+            except redis.RedisError as e:
+                logger.warning(f"Redis缓存读取失败 ({self.namespace}): {str(e)}")
+                raw = None
+            if raw is not None:
+                value = raw.decode() if isinstance(raw, bytes) else raw
+                self._set_local(key, value, self.ttl)
+                self._redis_hits += 1
+                self._count_label(label, "hits")
+                return value
+
+        self._misses += 1
+        self._count_label(label, "misses")
+        return None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None):
+        ttl = ttl or self.ttl
+        self._set_local(key, value, ttl)
+
+        client = get_redis() if self.use_redis else None
+        if client is not None:
+            try:
+                client.set(self._redis_key(key), value, ex=int(ttl) if ttl else None)
+            except redis.RedisError as e:
+                logger.warning(f"Redis缓存写入失败 ({self.namespace}): {str(e)}")
+
+    def clear(self):
+        """清空本地缓存（不影响 Redis 中的共享数据）"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self._local_hits + self._redis_hits + self._misses
+        with self._lock:
+            by_label = {
+                label: dict(counts, hit_ratio=round(counts["hits"] / (counts["hits"] + counts["misses"]), 4))
+                for label, counts in self._labels.items()
+            }
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "local_hits": self._local_hits,
+            "redis_hits": self._redis_hits,
+            "misses": self._misses,
+            "hit_ratio": round((self._local_hits + self._redis_hits) / lookups, 4) if lookups else 0.0,
+            "by_label": by_label,
+        }
@@ -0,0 +1,243 @@
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from typing import Dict, FrozenSet, Iterable, NamedTuple, Optional, Tuple
+import redis
+from ..models import Doctor
+from .redis_client import get_redis
+from .pattern_matcher import PatternDictionary, canonical_names, pattern_matcher
+
+logger = logging.getLogger('diagnosis')
+
+# 未配置 Redis 时无法得知其他进程对医生的修改，索引超过该时间（秒）后全量重建
+max_age = float(os.getenv("DOCTOR_INDEX_MAX_AGE", 300))
+
+VERSION_KEY = "ctd:doctor_index:version"
+# 有序集合：成员为医生 ID（"*" 表示需要全量重建），分数为最近一次修改时的版本号
+CHANGES_KEY = "ctd:doctor_index:changes"
+FULL_REBUILD = "*"
+
+# 版本号加一并记录修改的医生，保证两者原子更新
+_BUMP_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('ZADD', KEYS[2], version, ARGV[1])
+return version
+"""
+
+
+class DoctorEntry(NamedTuple):
+    """单个医生的预计算数据"""
+    id: int
+    sort_key: tuple  # 与 Doctor.Meta.ordering 一致：评分、接诊量降序，再按 ID
+    patterns: FrozenSet[str]  # 统一为证型词典中的名称（同义词归入对应证型）
+    pattern_count: int  # len(pattern_list)，与原有的匹配分数计算保持一致（含重复项）
+    title_score: float
+    rating_score: float
+    info: dict  # 推荐结果中的医生信息
+
+
+class IndexSnapshot(NamedTuple):
+    """不可变的索引快照，更新时整体替换，读取时无需加锁"""
+    entries: Tuple[DoctorEntry, ...]  # 按 Doctor.Meta.ordering 排序
+    by_pattern: Dict[str, FrozenSet[int]]  # 证型 -> 擅长该证型的医生 ID
+    version: int
+
+
+def make_entry(doctor: Doctor, dictionary: Optional[PatternDictionary] = None) -> DoctorEntry:
+    """
+    Args:
+        doctor: 医生对象
+        dictionary: 证型词典；批量构建时由调用方取一次传入
+    """
+    patterns = doctor.pattern_list
+    return DoctorEntry(
+        id=doctor.id,
+        sort_key=(-doctor.rating, -doctor.patients_count, doctor.id),
+        patterns=frozenset(canonical_names(dictionary or pattern_matcher.dictionary(), patterns)),
+        pattern_count=len(patterns),
+        title_score=doctor.title_weight,
+        rating_score=doctor.rating_score,
+        info={
+            'id': doctor.id,
+            'name': doctor.name,
+            'title': doctor.get_title_display(),
+            'hospital': doctor.hospital,
+            'department': doctor.department,
+            'specialty': doctor.specialty,
+            'tcm_patterns': doctor.tcm_patterns,
+            'years_of_experience': doctor.years_of_experience,
+            'rating': doctor.rating,
+            'patients_count': doctor.patients_count,
+        },
+    )
+
+
+def pattern_postings(entries: Iterable[DoctorEntry]) -> Dict[str, FrozenSet[int]]:
+    postings: Dict[str, set] = {}
+    for entry in entries:
+        for pattern in entry.patterns:
+            postings.setdefault(pattern, set()).add(entry.id)
+    return {pattern: frozenset(ids) for pattern, ids in postings.items()}
+
+
+class DoctorIndex:
+    """
+    进程内的医生索引
+
+    首次使用时全量加载医生，预计算证型集合、职称分数和评分分数，并建立证型到医生的倒排索引。
+    本进程内的修改由 Doctor 的 post_save/post_delete 信号增量更新；其他进程的修改通过
+    Redis 中的版本号和修改记录同步，只重新读取变更的医生。未配置 Redis 时超过 DOCTOR_INDEX_MAX_AGE 全量重建。
+
+    QuerySet.update()、bulk_create() 等批量操作不触发信号，之后需调用 invalidate()。
+    """
+
+    def __init__(self):
+        self._snapshot: Optional[IndexSnapshot] = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "incremental_updates": 0, "last_build_seconds": 0.0}
+
+    def snapshot(self) -> IndexSnapshot:
+        """返回最新的索引快照（必要时先同步其他进程的修改）"""
+        remote = self._remote_version()
+        snapshot = self._snapshot
+        if snapshot is not None and not self._stale(snapshot, remote):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or (remote is None and self._stale(snapshot, remote)) or (
+                remote is not None and remote < snapshot.version
+            ):
+                # 首次加载、未配置 Redis 时过期，或 Redis 数据丢失（版本号回退）
+                return self._rebuild(remote)
+            if remote is not None and remote > snapshot.version:
+                return self._sync(snapshot, remote)
+            return snapshot
+
+    def _stale(self, snapshot: IndexSnapshot, remote: Optional[int]) -> bool:
+        if remote is None:
+            return time.monotonic() - self._built_at >= max_age
+        return remote != snapshot.version
+
+    def doctor_changed(self, doctor_id: int, doctor: Optional[Doctor] = None):
+        """
+        医生保存或删除后调用（事务提交后）
+
+        Args:
+            doctor_id: 医生 ID
+            doctor: 保存后的医生对象；删除时为 None
+        """
+        version = self._bump(str(doctor_id))
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            entry = make_entry(doctor) if doctor is not None else None
+            # 版本号连续说明期间没有其他进程的修改，可以直接采用新版本号
+            next_version = version if version is not None and version == snapshot.version + 1 else snapshot.version
+            self._snapshot = self._apply(snapshot, {doctor_id: entry}, next_version)
+            self._stats["incremental_updates"] += 1
+
+    def invalidate(self):
+        """丢弃索引（所有进程），下次使用时全量重建"""
+        self._bump(FULL_REBUILD)
+        with self._lock:
+            self._snapshot = None
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        return dict(
+            self._stats,
+            doctors=len(snapshot.entries) if snapshot else 0,
+            patterns=len(snapshot.by_pattern) if snapshot else 0,
+            version=snapshot.version if snapshot else None,
+        )
+
+    def _rebuild(self, version: Optional[int]) -> IndexSnapshot:
+        started = time.perf_counter()
+        # 先读版本号再读数据：加载期间的修改会在下次同步时重新读取
+        dictionary = pattern_matcher.dictionary()
+        entries = sorted((make_entry(doctor, dictionary) for doctor in Doctor.objects.all()), key=lambda e: e.sort_key)
+        snapshot = IndexSnapshot(tuple(entries), pattern_postings(entries), version or 0)
+        self._snapshot = snapshot
+        self._built_at = time.monotonic()
+        elapsed = time.perf_counter() - started
+        self._stats["builds"] += 1
+        self._stats["last_build_seconds"] = round(elapsed, 4)
+        logger.info(f"医生推荐索引已重建: {len(entries)} 位医生，{len(snapshot.by_pattern)} 个证型，"
+                    f"版本 {snapshot.version}，耗时{elapsed:.3f}秒")
+        return snapshot
+
+    def _sync(self, snapshot: IndexSnapshot, remote: int) -> IndexSnapshot:
+        """重新读取版本号 snapshot.version 之后被修改的医生"""
+        try:
+            changed = get_redis().zrangebyscore(CHANGES_KEY, f"({snapshot.version}", remote)
+        except redis.RedisError as e:
+            logger.warning(f"读取医生推荐索引的变更失败: {str(e)}")
+            return snapshot
+        ids = [member.decode() if isinstance(member, bytes) else member for member in changed]
+        if FULL_REBUILD in ids:
+            return self._rebuild(remote)
+        doctor_ids = [int(doctor_id) for doctor_id in ids]
+        dictionary = pattern_matcher.dictionary()
+        loaded = {doctor.id: make_entry(doctor, dictionary) for doctor in Doctor.objects.filter(id__in=doctor_ids)}
+        self._snapshot = self._apply(snapshot, {doctor_id: loaded.get(doctor_id) for doctor_id in doctor_ids}, remote)
+        self._stats["incremental_updates"] += len(doctor_ids)
+        return self._snapshot
+
+    @staticmethod
+    def _apply(snapshot: IndexSnapshot, changes: Dict[int, Optional[DoctorEntry]], version: int) -> IndexSnapshot:
+        """生成包含修改的新快照（None 表示删除），只更新受影响的证型"""
+        entries = list(snapshot.entries)
+        by_pattern = dict(snapshot.by_pattern)
+        old = {entry.id: entry for entry in entries if entry.id in changes}
+        affected = set()
+        for doctor_id, entry in changes.items():
+            previous = old.get(doctor_id)
+            if previous is not None:
+                entries.pop(bisect_left([e.sort_key for e in entries], previous.sort_key))
+                affected.update(previous.patterns)
+            if entry is not None:
+                entries.insert(bisect_left([e.sort_key for e in entries], entry.sort_key), entry)
+                affected.update(entry.patterns)
+
+        for pattern in affected:
+            ids = set(by_pattern.get(pattern, ()))
+            for doctor_id, entry in changes.items():
+                ids.discard(doctor_id)
+                if entry is not None and pattern in entry.patterns:
+                    ids.add(doctor_id)
+            if ids:
+                by_pattern[pattern] = frozenset(ids)
+            else:
+                by_pattern.pop(pattern, None)
+        return IndexSnapshot(tuple(entries), by_pattern, version)
+
+    @staticmethod
+    def _remote_version() -> Optional[int]:
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            return int(client.get(VERSION_KEY) or 0)
+        except redis.RedisError as e:
+            logger.warning(f"读取医生推荐索引的版本号失败: {str(e)}")
+            return None
+
+    @staticmethod
+    def _bump(member: str) -> Optional[int]:
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            return int(client.eval(_BUMP_SCRIPT, 2, VERSION_KEY, CHANGES_KEY, member))
+        except redis.RedisError as e:
+            logger.warning(f"发布医生推荐索引的变更失败: {str(e)}")
+            return None
+
+
+# 全局医生索引（每个进程一份）
+doctor_index = DoctorIndex()
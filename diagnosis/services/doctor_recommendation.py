@@ -1,6 +1,48 @@
-import re
-from typing import List, Dict, Tuple
+import os
+from typing import List, Dict, NamedTuple, Optional, Tuple
+from asgiref.sync import sync_to_async
 from ..models import Doctor, PreDiagnosisReport
+from .doctor_index import IndexSnapshot, doctor_index, make_entry, pattern_postings
+from .pattern_matcher import pattern_matcher
+from . import doctor_scoring
+
+# 推荐接口 k 的上限（未指定 k 时返回全部医生）
+max_k = int(os.getenv("DOCTOR_RECOMMEND_MAX_K", 100))
+
+
+class RecommendationPage(NamedTuple):
+    recommendations: List[Dict]
+    total: int  # 满足最低分数的医生总数
+    next_offset: Optional[int]  # 下一页的 offset，没有更多结果时为 None
+
+
+def parse_page_params(data) -> Tuple[Optional[int], int, Optional[float]]:
+    """
+    解析推荐接口的分页参数
+
+    Args:
+        data: 请求数据，可包含 k、offset、min_score
+
+    Returns:
+        (k, offset, min_score)，未指定 k 时为 None（返回全部）
+
+    Raises:
+        ValueError: 参数不合法，消息可直接返回给客户端
+    """
+    try:
+        k = data.get('k')
+        k = int(k) if k not in (None, '') else None
+        offset = int(data.get('offset') or 0)
+        min_score = data.get('min_score')
+        min_score = float(min_score) if min_score not in (None, '') else None
+    except (TypeError, ValueError):
+        raise ValueError('k、offset 须为整数，min_score 须为数字')
+    if k is not None and not 1 <= k <= max_k:
+        raise ValueError(f'k 须在 1 到 {max_k} 之间')
+    if offset < 0:
+        raise ValueError('offset 不能为负数')
+    return k, offset, min_score
+
 
 class DoctorRecommendationService:
     """医生推荐服务"""
@@ -20,18 +62,11 @@ class DoctorRecommendationService:
             report_content: 报告内容
             
         Returns:
-            提取到的证型列表
+            提取到的证型列表（同义词统一为证型名称，按首次出现的顺序去重）
         """
-        # 简单的证型提取逻辑，可以根据需要优化
-        common_patterns = [
-            '气虚证', '阳虚证', '阴虚证', '痰湿证', '血瘀证', '肝郁证',
-            '脾胃气虚', '肝郁气滞', '肾阳虚', '肾阴虚'
-        ]
-        found_patterns = []
-        for pattern in common_patterns:
-            if pattern in report_content:
-                found_patterns.append(pattern)
-        return found_patterns
+        # 证型词典编译为 Aho-Corasick 自动机，报告内容只扫描一遍；
+        # 相互包含的证型取最长的匹配，如“肝肾阴虚”不再同时提取出“肾阴虚”
+        return pattern_matcher.extract_names(report_content)
 
     def calculate_pattern_score(self, report_patterns: List[str], doctor: Doctor) -> float:
         """计算证型匹配分数
@@ -46,7 +81,7 @@ class DoctorRecommendationService:
         if not report_patterns:
             return 0.5  # 如果没有提取到证型，返回中等分数
             
-        doctor_patterns = doctor.pattern_list
+        doctor_patterns = pattern_matcher.canonical(doctor.pattern_list)
         if not doctor_patterns:
             return 0.3  # 如果医生没有设置擅长证型，返回较低分数
             
@@ -64,17 +99,7 @@ class DoctorRecommendationService:
         Returns:
             评分分数 (0-1)
         """
-        # 评分占 70%，接诊量占 30%
-        rating_weight = 0.7
-        patients_weight = 0.3
-        
-        # 评分转换为 0-1 分数
-        rating_score = doctor.rating / 5.0
-        
-        # 接诊量分数（假设 5000 是一个较好的接诊量基准）
-        patients_score = min(doctor.patients_count / 5000, 1.0)
-        
-        return (rating_score * rating_weight) + (patients_score * patients_weight)
+        return doctor.rating_score
 
     def get_recommendations(self, report: PreDiagnosisReport) -> List[Dict]:
         """获取医生推荐列表
@@ -85,56 +110,101 @@ class DoctorRecommendationService:
         Returns:
             推荐列表，包含医生信息和匹配分数
         """
+        return self.recommend(report).recommendations
+
+    async def aget_recommendations(self, report: PreDiagnosisReport) -> List[Dict]:
+        """get_recommendations 的异步版本"""
+        return (await self.arecommend(report)).recommendations
+
+    def recommend(self, report: PreDiagnosisReport, k: Optional[int] = None, offset: int = 0,
+                  min_score: Optional[float] = None) -> RecommendationPage:
+        """获取一页医生推荐
+        
+        Args:
+            report: 预诊报告对象
+            k: 返回数量，None 表示全部
+            offset: 跳过排名靠前的医生数
+            min_score: 最低匹配分数
+            
+        Returns:
+            RecommendationPage: 推荐列表、总数和下一页的 offset
+        """
         if not report.report_content:
-            return []
+            return RecommendationPage([], 0, None)
             
         # 提取报告中的证型
         report_patterns = self.extract_patterns(report.report_content)
         
-        # 获取所有医生
-        doctors = Doctor.objects.all()
+        # 使用预计算的医生索引，不再逐次读取全部医生
+        return self.rank_snapshot(report_patterns, doctor_index.snapshot(), k, offset, min_score)
+
+    async def arecommend(self, report: PreDiagnosisReport, k: Optional[int] = None, offset: int = 0,
+                         min_score: Optional[float] = None) -> RecommendationPage:
+        """recommend 的异步版本（证型词典或索引需要重建、同步时在线程中读取数据库）"""
+        if not report.report_content:
+            return RecommendationPage([], 0, None)
+
+        def prepare():
+            return self.extract_patterns(report.report_content), doctor_index.snapshot()
+
+        report_patterns, snapshot = await sync_to_async(prepare, thread_sensitive=False)()
+        return self.rank_snapshot(report_patterns, snapshot, k, offset, min_score)
+
+    def rank_doctors(self, report_patterns: List[str], doctors) -> List[Dict]:
+        """计算每位医生的匹配分数并按分数排序
+        
+        Args:
+            report_patterns: 报告中的证型列表
+            doctors: 医生列表
+            
+        Returns:
+            推荐列表，包含医生信息和匹配分数
+        """
+        entries = tuple(make_entry(doctor) for doctor in doctors)
+        return self.rank_snapshot(report_patterns, IndexSnapshot(entries, pattern_postings(entries), 0)).recommendations
+
+    def rank_snapshot(self, report_patterns: List[str], snapshot: IndexSnapshot, k: Optional[int] = None,
+                      offset: int = 0, min_score: Optional[float] = None) -> RecommendationPage:
+        """按预计算的索引计算匹配分数并排序，规则与 calculate_pattern_score 等方法一致
+        
+        医生数据按列存储（NumPy 数组），所有医生的分数一次向量化计算；
+        只对返回的医生排序和生成结果，开销与 offset + k 成正比而不是医生总数。
         
-        recommendations = []
-        for doctor in doctors:
-            # 计算各项分数
-            pattern_score = self.calculate_pattern_score(report_patterns, doctor)
-            title_score = doctor.title_weight
-            rating_score = self.calculate_rating_score(doctor)
+        Args:
+            report_patterns: 报告中的证型列表
+            snapshot: 医生索引快照
+            k: 返回数量，None 表示全部
+            offset: 跳过排名靠前的医生数
+            min_score: 最低匹配分数
             
-            # 计算总分
-            total_score = (
-                pattern_score * self.weights['pattern'] +
-                title_score * self.weights['title'] +
-                rating_score * self.weights['rating']
-            )
+        Returns:
+            RecommendationPage: 推荐列表、总数和下一页的 offset
+        """
+        columns = doctor_scoring.columns_for(snapshot)
+        pattern_score = doctor_scoring.pattern_scores(columns, report_patterns)
+        total_score = doctor_scoring.total_scores(columns, pattern_score, self.weights)
+        matching_score = doctor_scoring.round_scores(total_score)
+        rows, total = doctor_scoring.select_top(matching_score, k, offset, min_score)
+
+        recommendations = []
+        # 按匹配分数排序
+        for i in rows.tolist():
+            entry = snapshot.entries[i]
             
             # 生成匹配原因
             matching_reasons = []
-            if pattern_score > 0.7:
+            if pattern_score[i] > 0.7:
                 matching_reasons.append("对您的证型有丰富治疗经验")
-            if title_score > 0.8:
+            if entry.title_score > 0.8:
                 matching_reasons.append("具有丰富的临床经验")
-            if rating_score > 0.8:
+            if entry.rating_score > 0.8:
                 matching_reasons.append("患者评价较高")
             
             recommendations.append({
-                'doctor': {
-                    'id': doctor.id,
-                    'name': doctor.name,
-                    'title': doctor.get_title_display(),
-                    'hospital': doctor.hospital,
-                    'department': doctor.department,
-                    'specialty': doctor.specialty,
-                    'tcm_patterns': doctor.tcm_patterns,
-                    'years_of_experience': doctor.years_of_experience,
-                    'rating': doctor.rating,
-                    'patients_count': doctor.patients_count
-                },
-                'matching_score': round(total_score, 3),
+                'doctor': dict(entry.info),
+                'matching_score': float(matching_score[i]),
                 'matching_reasons': matching_reasons
             })
         
-        # 按匹配分数排序
-        recommendations.sort(key=lambda x: x['matching_score'], reverse=True)
-        
-        return recommendations
+        next_offset = offset + len(recommendations)
+        return RecommendationPage(recommendations, total, next_offset if next_offset < total else None)
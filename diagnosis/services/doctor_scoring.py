@@ -0,0 +1,141 @@
+import threading
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import numpy as np
+from .doctor_index import DoctorEntry, IndexSnapshot
+
+
+class DoctorColumns(NamedTuple):
+    """按列存储的医生数据，行顺序与快照中的 entries 一致"""
+    title_score: np.ndarray  # float64
+    rating_score: np.ndarray  # float64
+    pattern_count: np.ndarray  # int64，len(pattern_list)
+    bitmap: np.ndarray  # uint8 (医生数, ceil(证型数 / 8))，第 i 个证型对应第 i // 8 字节的第 i % 8 位
+    vocabulary: Dict[str, int]  # 证型 -> 位序号
+
+
+def build_columns(entries: Sequence[DoctorEntry]) -> DoctorColumns:
+    vocabulary: Dict[str, int] = {}
+    for entry in entries:
+        for pattern in entry.patterns:
+            vocabulary.setdefault(pattern, len(vocabulary))
+
+    count = len(entries)
+    bitmap = np.zeros((count, max((len(vocabulary) + 7) // 8, 1)), dtype=np.uint8)
+    rows, bits = [], []
+    for row, entry in enumerate(entries):
+        for pattern in entry.patterns:
+            rows.append(row)
+            bits.append(vocabulary[pattern])
+    if rows:
+        rows, bits = np.array(rows), np.array(bits)
+        np.bitwise_or.at(bitmap, (rows, bits >> 3), (1 << (bits & 7)).astype(np.uint8))
+
+    return DoctorColumns(
+        title_score=np.fromiter((e.title_score for e in entries), dtype=np.float64, count=count),
+        rating_score=np.fromiter((e.rating_score for e in entries), dtype=np.float64, count=count),
+        pattern_count=np.fromiter((e.pattern_count for e in entries), dtype=np.int64, count=count),
+        bitmap=bitmap,
+        vocabulary=vocabulary,
+    )
+
+
+_cache_lock = threading.Lock()
+_cache: Tuple = (None, None)
+
+
+def columns_for(snapshot: IndexSnapshot) -> DoctorColumns:
+    """返回快照对应的列数据，同一快照只构建一次（索引更新后生成新快照，自然失效）"""
+    global _cache
+    cached_snapshot, columns = _cache
+    if cached_snapshot is snapshot:
+        return columns
+    with _cache_lock:
+        cached_snapshot, columns = _cache
+        if cached_snapshot is not snapshot:
+            columns = build_columns(snapshot.entries)
+            _cache = (snapshot, columns)
+    return columns
+
+
+def matched_counts(columns: DoctorColumns, report_patterns: List[str]) -> np.ndarray:
+    """每位医生与报告证型的交集大小；报告证型重复时按次数计，与逐个判断 p in pattern_list 一致"""
+    matched = np.zeros(len(columns.pattern_count), dtype=np.int64)
+    for pattern in report_patterns:
+        bit = columns.vocabulary.get(pattern)
+        if bit is not None:
+            matched += (columns.bitmap[:, bit >> 3] >> (bit & 7)) & 1
+    return matched
+
+
+def pattern_scores(columns: DoctorColumns, report_patterns: List[str]) -> np.ndarray:
+    """与 DoctorRecommendationService.calculate_pattern_score 的规则一致"""
+    count = len(columns.pattern_count)
+    if not report_patterns:
+        return np.full(count, 0.5)
+    matched = matched_counts(columns, report_patterns)
+    max_possible = np.maximum(columns.pattern_count, len(report_patterns))
+    # 医生没有证型时 max_possible 仍为报告证型数（> 0），除法安全，结果再替换为 0.3
+    return np.where(columns.pattern_count == 0, 0.3, matched / max_possible)
+
+
+def total_scores(columns: DoctorColumns, pattern_score: np.ndarray, weights: Dict[str, float]) -> np.ndarray:
+    """加权总分，运算顺序与逐个医生计算时相同，浮点结果逐位一致"""
+    return (
+        pattern_score * weights['pattern'] +
+        columns.title_score * weights['title'] +
+        columns.rating_score * weights['rating']
+    )
+
+
+def round_scores(scores: np.ndarray, ndigits: int = 3) -> np.ndarray:
+    """
+    与 Python round() 结果一致的向量化舍入
+
+    np.round 先乘 10^ndigits 再取整，在恰好接近 .5 的位置可能与 round() 的十进制舍入结果不同；
+    这些位置逐个用 round() 重新计算，其余位置两者一致。
+    """
+    scale = 10.0 ** ndigits
+    scaled = scores * scale
+    rounded = np.rint(scaled) / scale
+    fraction = scaled - np.floor(scaled)
+    for i in np.flatnonzero(np.abs(fraction - 0.5) < 1e-6):
+        rounded[i] = round(float(scores[i]), ndigits)
+    return rounded
+
+
+def rank_order(rounded: np.ndarray) -> np.ndarray:
+    """按舍入后的分数降序排列，分数相同时保持快照顺序（与 list.sort(reverse=True) 的稳定排序一致）"""
+    return np.argsort(-rounded, kind='stable')
+
+
+def select_top(scores: np.ndarray, k: Optional[int], offset: int = 0,
+               min_score: Optional[float] = None) -> Tuple[np.ndarray, int]:
+    """
+    选出排名第 offset 到 offset + k 的医生，顺序与 rank_order 全量排序后截取的结果一致
+
+    只对前 offset + k 名排序：以第 offset + k 名的分数为阈值（np.partition，线性时间），
+    高于阈值的全部入选，等于阈值的按快照顺序补足，再对这部分做稳定排序。
+
+    Args:
+        scores: 舍入后的分数
+        k: 返回数量，None 表示全部
+        offset: 跳过的数量
+        min_score: 最低分数，低于该分数的医生不参与排名
+
+    Returns:
+        (行号数组, 满足 min_score 的医生总数)
+    """
+    rows = np.arange(len(scores)) if min_score is None else np.flatnonzero(scores >= min_score)
+    total = len(rows)
+    end = total if k is None else min(offset + k, total)
+    if offset >= end:
+        return rows[:0], total
+
+    values = scores[rows]
+    if end < total:
+        threshold = np.partition(values, total - end)[total - end]
+        above = np.flatnonzero(values > threshold)
+        ties = np.flatnonzero(values == threshold)[:end - len(above)]
+        keep = np.sort(np.concatenate([above, ties]))
+        rows, values = rows[keep], values[keep]
+    return rows[rank_order(values)[offset:end]], total
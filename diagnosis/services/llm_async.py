@@ -0,0 +1,385 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, Dict, List, Optional
+import httpx
+from asgiref.sync import sync_to_async
+from . import llm_cache
+from .llm_gateway import (
+    PROVIDERS, ProviderConfig, LLMError, LLMCancelled, LLMTimeout, LLMResult, RETRY_STATUS, call_outcome,
+    _build_payload, _parse_response, _retry_after, _backoff,
+    connect_timeout, read_timeout, queue_timeout, max_retries, backoff_max,
+)
+from . import metrics
+from .llm_router import llm_router, record_attempt
+from .rate_limiter import rate_limiter, estimate_tokens, RateLimitTimeout
+
+logger = logging.getLogger('diagnosis')
+
+
+def _new_client(provider: ProviderConfig) -> httpx.AsyncClient:
+    """
+    为一次调用创建 AsyncClient，由调用方在结束时关闭
+
+    WSGI 部署下每个异步请求都由 async_to_sync 在新的事件循环中运行，客户端不能跨事件循环复用，
+    因此不缓存客户端；同一次调用内的重试复用同一个客户端。
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=queue_timeout),
+        limits=httpx.Limits(
+            max_connections=provider.max_concurrency,
+            max_keepalive_connections=provider.max_concurrency,
+        ),
+    )
+
+
+def _api_key(provider: ProviderConfig) -> str:
+    api_key = os.getenv(provider.api_key_env)
+    if not api_key:
+        raise LLMError(f"{provider.api_key_env} environment variable is not set")
+    return api_key
+
+
+def _headers(provider: ProviderConfig, api_key: str, stream: bool = False) -> dict:
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+    }
+    if stream:
+        headers["Accept"] = "text/event-stream"
+        if provider.name == "dashscope":
+            headers["X-DashScope-SSE"] = "enable"
+    return headers
+
+
+def _stream_payload(provider: ProviderConfig, prompt: str, temperature: float, top_p: float) -> dict:
+    payload = _build_payload(provider, prompt, temperature, top_p)
+    if provider.name == "dashscope":
+        # 增量输出：每个事件只包含新生成的部分
+        payload["parameters"]["incremental_output"] = True
+    else:
+        payload["stream"] = True
+    return payload
+
+
+def _parse_event(data: dict) -> tuple:
+    """解析一个 SSE 事件，返回 (增量文本, usage)；兼容 output.text 和 choices[].delta.content 两种格式"""
+    output = data.get("output") or {}
+    text = output.get("text")
+    if text is None:
+        choices = data.get("choices") or output.get("choices") or []
+        if choices:
+            text = (choices[0].get("delta") or choices[0].get("message") or {}).get("content")
+    return text or "", data.get("usage") or {}
+
+
+class CompletionStream:
+    """
+    流式调用大模型
+
+    按路由顺序选择未熔断的服务商，逐段产出增量文本；在产出第一段之前失败时切换到下一个服务商，
+    之后失败则抛出 LLMError。迭代结束后 result 为完整结果（含 token 用量和耗时）。
+    流式输出无法对冲，延迟和错误仍计入路由统计。
+
+    用法：
+        stream = CompletionStream(prompt, call_type="report")
+        async for delta in stream:
+            ...
+        stream.result
+    """
+
+    def __init__(self, prompt: str, call_type: str = "default", temperature: float = 0.7, top_p: float = 0.9):
+        self.prompt = prompt
+        self.call_type = call_type
+        self.temperature = temperature
+        self.top_p = top_p
+        self.result: Optional[LLMResult] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._run()
+
+    async def _stream_provider(self, config: ProviderConfig, usage: dict) -> AsyncIterator[str]:
+        payload = _stream_payload(config, self.prompt, self.temperature, self.top_p)
+        await _acquire(config, estimate_tokens(self.prompt), None)
+        async with _new_client(config) as client, client.stream(
+            "POST", config.url, headers=_headers(config, _api_key(config), stream=True), json=payload
+        ) as response:
+            if response.status_code != 200:
+                if response.status_code == 429:
+                    rate_limiter.throttle(config.name, min(_retry_after(response) or _backoff(0), backoff_max))
+                body = (await response.aread()).decode(errors="ignore")
+                raise LLMError(
+                    f"{config.display_name}API调用失败: {response.status_code} {body[:200]}",
+                    response.status_code,
+                )
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    text, event_usage = _parse_event(json.loads(data))
+                except ValueError:
+                    raise LLMError(f"{config.display_name}API返回格式错误: {data[:200]}")
+                usage.update(event_usage)
+                if text:
+                    yield text
+
+    async def _run(self) -> AsyncIterator[str]:
+        tried = []
+        last_error: Optional[Exception] = None
+        while True:
+            provider = llm_router.next_provider(tried) or (llm_router.providers[0] if not tried else None)
+            if provider is None:
+                metrics.record_request(self.call_type, None, call_outcome(last_error))
+                raise LLMError(f"所有大模型服务商调用失败: {str(last_error)}")
+            if tried:
+                metrics.record_fallback(self.call_type, tried[-1], provider, "failover")
+            tried.append(provider)
+            config = PROVIDERS[provider]
+            health = llm_router.health[provider]
+
+            started = time.perf_counter()
+            usage: dict = {}
+            chunks = []
+            try:
+                async for delta in self._stream_provider(config, usage):
+                    chunks.append(delta)
+                    yield delta
+            except (LLMError, httpx.HTTPError) as e:
+                if isinstance(e, LLMError) and e.status_code == 429:
+                    health.record_rate_limited()
+                else:
+                    health.record_failure()
+                if isinstance(e, httpx.TimeoutException):
+                    e = LLMTimeout(f"{config.display_name}API响应超时: {str(e)}")
+                record_attempt(provider, self.call_type, self.prompt, started, error=e, mode="stream")
+                if chunks:
+                    metrics.record_request(self.call_type, provider, call_outcome(e))
+                    raise LLMError(f"{config.display_name}API流式输出中断: {str(e)}") from e
+                last_error = e
+                logger.warning(f"大模型流式调用 {self.call_type} 经 {provider} 失败: {str(e)}")
+                continue
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开，不计入服务商的成功或失败
+                health.release_probe()
+                record_attempt(provider, self.call_type, self.prompt, started,
+                               error=LLMCancelled("client disconnected"), mode="stream")
+                metrics.record_request(self.call_type, provider, "cancelled")
+                raise
+
+            latency = time.perf_counter() - started
+            health.record_success(self.call_type, latency)
+            input_tokens = int(usage.get("input_tokens", usage.get("prompt_tokens", 0)) or 0)
+            output_tokens = int(usage.get("output_tokens", usage.get("completion_tokens", 0)) or 0)
+            rate_limiter.settle(provider, config.tpm, estimate_tokens(self.prompt), input_tokens + output_tokens)
+            self.result = LLMResult(
+                "".join(chunks).strip(), provider, config.model, input_tokens, output_tokens, latency
+            )
+            record_attempt(provider, self.call_type, self.prompt, started, result=self.result, mode="stream")
+            metrics.record_request(self.call_type, provider, "success")
+            logger.info(
+                f"大模型流式调用 {self.call_type} 经 {provider}/{config.model} 完成: 耗时{latency:.2f}秒，"
+                f"输入{input_tokens} token，输出{output_tokens} token"
+            )
+            return
+
+
+async def _acquire(config: ProviderConfig, tokens: int, timeout: Optional[float]):
+    """按服务商配额排队（与同步网关共用 rate_limiter），超过期限按限流处理"""
+    try:
+        await rate_limiter.aacquire(config.name, config.rpm, config.tpm, tokens, timeout=timeout)
+    except RateLimitTimeout as e:
+        raise LLMError(f"{config.display_name}API限流: {str(e)}", 429) from e
+
+
+async def _call_provider(provider: str, prompt: str, call_type: str, timeout: Optional[float],
+                         temperature: float, top_p: float) -> LLMResult:
+    """异步调用单个服务商，重试和限流策略与同步网关一致（429、5xx 和连接失败带抖动退避重试）"""
+    config = PROVIDERS[provider]
+    headers = _headers(config, _api_key(config))
+    payload = _build_payload(config, prompt, temperature, top_p)
+    request_timeout = httpx.Timeout(timeout or read_timeout, connect=connect_timeout, pool=queue_timeout)
+    estimated_tokens = estimate_tokens(prompt)
+
+    async with _new_client(config) as client:
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            delay = None
+            status_code = None
+            await _acquire(config, estimated_tokens, timeout)
+            try:
+                response = await client.post(config.url, headers=headers, json=payload, timeout=request_timeout)
+            except httpx.PoolTimeout as e:
+                raise LLMError(f"{config.display_name}API并发请求已满，等待超时") from e
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                error = f"{config.display_name}API连接失败: {str(e)}"
+            except httpx.TimeoutException as e:
+                # 读取超时不重试，与同步网关一致
+                raise LLMTimeout(f"{config.display_name}API响应超时: {str(e)}") from e
+            else:
+                if response.status_code == 200:
+                    try:
+                        text, input_tokens, output_tokens = _parse_response(config, response.json())
+                    except ValueError as e:
+                        raise LLMError(f"{config.display_name}API返回格式错误: {response.text[:200]}") from e
+                    rate_limiter.settle(provider, config.tpm, estimated_tokens, input_tokens + output_tokens)
+                    latency = time.perf_counter() - started
+                    logger.info(
+                        f"大模型异步调用 {call_type} 经 {provider}/{config.model} 完成: 耗时{latency:.2f}秒，"
+                        f"输入{input_tokens} token，输出{output_tokens} token，重试{attempt}次"
+                    )
+                    return LLMResult(text, provider, config.model, input_tokens, output_tokens, latency)
+
+                error = f"{config.display_name}API调用失败: {response.status_code} {response.text[:200]}"
+                status_code = response.status_code
+                if status_code not in RETRY_STATUS:
+                    raise LLMError(error, status_code)
+                delay = _retry_after(response)
+
+            delay = min(delay, backoff_max) if delay is not None else _backoff(attempt)
+            if status_code == 429:
+                rate_limiter.throttle(provider, delay)
+            if attempt >= max_retries:
+                raise LLMError(error, status_code)
+            attempt += 1
+            logger.warning(f"{error}，{delay:.2f}秒后重试（第{attempt}次）")
+            if status_code != 429:
+                # 429 时在 rate_limiter 中等待暂停结束
+                await asyncio.sleep(delay)
+
+
+async def _attempt(provider: str, prompt: str, call_type: str, timeout: Optional[float],
+                   temperature: float, top_p: float) -> LLMResult:
+    """调用服务商并把结果计入路由统计"""
+    health = llm_router.health[provider]
+    started = time.perf_counter()
+    try:
+        result = await _call_provider(provider, prompt, call_type, timeout, temperature, top_p)
+    except asyncio.CancelledError:
+        health.release_probe()
+        record_attempt(provider, call_type, prompt, started, error=LLMCancelled("cancelled"), mode="async")
+        raise
+    except LLMError as e:
+        if e.status_code == 429:
+            health.record_rate_limited()
+        else:
+            health.record_failure()
+        record_attempt(provider, call_type, prompt, started, error=e, mode="async")
+        raise
+    except Exception as e:
+        health.record_failure()
+        record_attempt(provider, call_type, prompt, started, error=e, mode="async")
+        raise
+    health.record_success(call_type, result.latency)
+    record_attempt(provider, call_type, prompt, started, result=result, mode="async")
+    return result
+
+
+async def acall(prompt: str, call_type: str = "default", timeout: Optional[float] = None,
+                temperature: float = 0.7, top_p: float = 0.9,
+                cacheable: Optional[Callable[[str], bool]] = None) -> LLMResult:
+    """
+    llm_cache.cached_llm_call 的异步版本
+
+    读写同一份回复缓存，服务商选择、p95 对冲和熔断与 llm_router 一致；
+    对冲时较慢的一方会被真正取消（关闭连接），等待期间不占用线程。
+
+    Args:
+        prompt: 提示词
+        call_type: 调用类型（questions、report、treatment 等）
+        timeout: 总体期限（秒）
+        temperature: 采样温度
+        top_p: 核采样阈值
+        cacheable: 校验回复的函数，返回 False 的回复不写入缓存
+
+    Returns:
+        LLMResult: 调用结果
+
+    Raises:
+        LLMError: 所有服务商都失败或超过期限
+    """
+    cached = await sync_to_async(llm_cache.lookup, thread_sensitive=False)(prompt, call_type, temperature, top_p)
+    if cached is not None:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout if timeout else None
+    tried: List[str] = []
+    pending: Dict[asyncio.Task, str] = {}
+    last_error: Optional[Exception] = None
+
+    def launch(provider: str):
+        tried.append(provider)
+        remaining = deadline - loop.time() if deadline else None
+        task = asyncio.ensure_future(_attempt(provider, prompt, call_type, remaining, temperature, top_p))
+        pending[task] = provider
+
+    launch(llm_router.next_provider(tried) or llm_router.providers[0])
+    try:
+        while pending:
+            remaining = deadline - loop.time() if deadline else None
+            if remaining is not None and remaining <= 0:
+                metrics.record_request(call_type, None, "timeout")
+                raise LLMTimeout(f"大模型调用超过期限 {timeout:g}秒")
+
+            hedge_from = None
+            wait_for = remaining
+            if len(pending) == 1 and any(
+                name not in tried and llm_router.health[name].available() for name in llm_router.providers
+            ):
+                hedge_from = next(iter(pending.values()))
+                hedge_after = llm_router.health[hedge_from].hedge_delay(call_type)
+                if remaining is None or hedge_after < remaining:
+                    wait_for = hedge_after
+                else:
+                    hedge_from = None
+
+            done, _ = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if hedge_from is not None:
+                    provider = llm_router.next_provider(tried)
+                    if provider is not None:
+                        llm_router.health[hedge_from].record_hedge()
+                        metrics.record_fallback(call_type, hedge_from, provider, "hedge")
+                        logger.info(
+                            f"大模型异步调用 {call_type}: {hedge_from} 超过 p95 延迟仍未返回，向 {provider} 发送对冲请求"
+                        )
+                        launch(provider)
+                continue
+
+            failed = None
+            for task in done:
+                provider = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    last_error = e
+                    failed = provider
+                    logger.warning(f"大模型异步调用 {call_type} 经 {provider} 失败: {str(e)}")
+                    continue
+                metrics.record_request(call_type, provider, "success")
+                if cacheable is None or cacheable(result.text):
+                    await sync_to_async(llm_cache.store, thread_sensitive=False)(
+                        prompt, call_type, result, temperature, top_p
+                    )
+                return result
+
+            if not pending:
+                provider = llm_router.next_provider(tried)
+                if provider is not None:
+                    metrics.record_fallback(call_type, failed, provider, "failover")
+                    launch(provider)
+    finally:
+        for task in pending:
+            task.cancel()
+        # 等待被取消的调用关闭各自的客户端
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    metrics.record_request(call_type, None, call_outcome(last_error))
+    raise LLMError(f"所有大模型服务商调用失败: {str(last_error)}")
+
@@ -0,0 +1,126 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import unicodedata
+from typing import Callable, Optional
+from .cache import TieredCache
+from .llm_gateway import LLMResult, PROVIDERS
+from .llm_router import llm_router
+
+logger = logging.getLogger('diagnosis')
+
+# 不使用缓存的调用类型（逗号分隔），如 LLM_CACHE_DISABLED_TYPES=treatment
+disabled_call_types = {
+    t.strip() for t in os.getenv("LLM_CACHE_DISABLED_TYPES", "").split(",") if t.strip()
+}
+
+# 大模型回复缓存：进程内 LRU + 配置了 REDIS_URL 时在所有 worker 间共享
+llm_cache = TieredCache(
+    namespace="llm",
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", 2048)),
+    ttl=float(os.getenv("LLM_CACHE_TTL", 24 * 3600)),
+    use_redis=os.getenv("LLM_CACHE_REDIS", "true").lower() not in ("0", "false", "no", "off"),
+)
+
+_savings_lock = threading.Lock()
+_savings: dict = {}
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """统一全角/半角字符并合并空白，使仅有排版差异的提示词命中同一条缓存"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", prompt)).strip()
+
+
+def cache_key(prompt: str, params: dict) -> str:
+    """缓存键：规范化后的提示词 + 参与路由的模型 + 采样参数"""
+    models = ",".join(f"{name}/{PROVIDERS[name].model}" for name in llm_router.providers if name in PROVIDERS)
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "models": models, "params": params},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _record_saving(call_type: str, result: LLMResult):
+    with _savings_lock:
+        saved = _savings.setdefault(call_type, {"input_tokens": 0, "output_tokens": 0, "seconds": 0.0})
+        saved["input_tokens"] += result.input_tokens
+        saved["output_tokens"] += result.output_tokens
+        saved["seconds"] += result.latency
+
+
+def lookup(prompt: str, call_type: str, temperature: float = 0.7, top_p: float = 0.9) -> Optional[LLMResult]:
+    """查询缓存，命中时返回 cached=True 的结果并累计节省量；该调用类型未启用缓存时返回 None"""
+    if call_type in disabled_call_types:
+        return None
+    cached = llm_cache.get(cache_key(prompt, {"temperature": temperature, "top_p": top_p}), label=call_type)
+    if cached is None:
+        return None
+    try:
+        result = LLMResult(**json.loads(cached))._replace(cached=True)
+    except (ValueError, TypeError) as e:
+        logger.warning(f"忽略格式错误的大模型缓存条目: {str(e)}")
+        return None
+    _record_saving(call_type, result)
+    logger.info(f"大模型调用 {call_type} 命中缓存")
+    return result
+
+
+def store(prompt: str, call_type: str, result: LLMResult, temperature: float = 0.7, top_p: float = 0.9):
+    """写入缓存（空回复和未启用缓存的调用类型不写入）"""
+    if call_type in disabled_call_types or not result.text:
+        return
+    key = cache_key(prompt, {"temperature": temperature, "top_p": top_p})
+    llm_cache.set(key, json.dumps(result._asdict(), ensure_ascii=False))
+
+
+def cached_llm_call(prompt: str, call_type: str = "default", timeout: Optional[float] = None,
+                    temperature: float = 0.7, top_p: float = 0.9,
+                    cacheable: Optional[Callable[[str], bool]] = None) -> LLMResult:
+    """
+    带缓存的大模型调用
+
+    命中时返回首次调用的结果（cached=True），并累计节省的 token 数和耗时；
+    未命中时通过 llm_router 调用并写入缓存。LLM_CACHE_DISABLED_TYPES 中的调用类型不读写缓存。
+
+    Args:
+        prompt: 提示词
+        call_type: 调用类型（questions、report、treatment 等）
+        timeout: 总体期限（秒）
+        temperature: 采样温度
+        top_p: 核采样阈值
+        cacheable: 校验回复的函数，返回 False 的回复（如无法解析的结构化输出）不写入缓存
+
+    Returns:
+        LLMResult: 调用结果
+    """
+    result = lookup(prompt, call_type, temperature, top_p)
+    if result is not None:
+        return result
+
+    result = llm_router.call(prompt, call_type=call_type, timeout=timeout, temperature=temperature, top_p=top_p)
+    if cacheable is None or cacheable(result.text):
+        store(prompt, call_type, result, temperature, top_p)
+    return result
+
+
+def stats() -> dict:
+    """缓存命中率，以及按调用类型统计的命中、未命中和节省的 token 数、耗时"""
+    cache_stats = llm_cache.stats()
+    with _savings_lock:
+        saved = {
+            call_type: dict(values, seconds=round(values["seconds"], 3))
+            for call_type, values in _savings.items()
+        }
+    by_type = {}
+    for call_type, counts in cache_stats.pop("by_label").items():
+        by_type[call_type] = dict(counts, saved=saved.get(call_type, {}))
+    cache_stats["by_call_type"] = by_type
+    cache_stats["disabled_call_types"] = sorted(disabled_call_types)
+    return cache_stats
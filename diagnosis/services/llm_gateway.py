@@ -0,0 +1,313 @@
+import os
+import time
+import random
+import logging
+import threading
+from typing import Dict, NamedTuple, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from .rate_limiter import rate_limiter, estimate_tokens, RateLimitTimeout
+
+# 加载环境变量
+load_dotenv()
+
+logger = logging.getLogger('diagnosis')
+
+# 建立连接和等待响应的超时时间（秒）
+connect_timeout = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+read_timeout = float(os.getenv("LLM_READ_TIMEOUT", 60))
+
+# 429、5xx 和连接失败时的最大重试次数
+max_retries = int(os.getenv("LLM_MAX_RETRIES", 2))
+
+# 指数退避的基数和上限（秒），实际等待时间在 [0, 退避时间] 内随机
+backoff_base = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+backoff_max = float(os.getenv("LLM_BACKOFF_MAX", 8))
+
+# 并发已满时等待空闲名额的最长时间（秒）
+queue_timeout = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """大模型调用失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LLMCancelled(LLMError):
+    """调用已被取消（如对冲请求中较慢的一方）"""
+
+
+class LLMTimeout(LLMError):
+    """等待响应超时或超过调用期限"""
+
+
+def call_outcome(error: Optional[Exception]) -> str:
+    """调用结果分类，用于指标和结构化日志"""
+    if error is None:
+        return "success"
+    if isinstance(error, LLMCancelled):
+        return "cancelled"
+    if isinstance(error, LLMTimeout):
+        return "timeout"
+    if isinstance(error, LLMError) and error.status_code == 429:
+        return "rate_limited"
+    return "error"
+
+
+class LLMResult(NamedTuple):
+    text: str
+    provider: str
+    model: str
+    input_tokens: int
+    output_tokens: int
+    latency: float
+    cached: bool = False
+
+
+class ProviderConfig(NamedTuple):
+    name: str
+    display_name: str
+    url: str
+    model: str
+    api_key_env: str
+    max_concurrency: int
+    rpm: int = 0  # 每分钟请求数上限，0 表示不限制
+    tpm: int = 0  # 每分钟 token 数上限，0 表示不限制
+
+
+# 服务商接口地址可通过 DASHSCOPE_URL / VOLCANO_URL 覆盖（如指向 llm_standin 模拟服务）
+PROVIDERS = {
+    "dashscope": ProviderConfig(
+        name="dashscope",
+        display_name="百炼",
+        url=os.getenv("DASHSCOPE_URL", "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"),
+        model="qwen-max",
+        api_key_env="DASHSCOPE_API_KEY",
+        max_concurrency=int(os.getenv("DASHSCOPE_MAX_CONCURRENCY", 8)),
+        rpm=int(os.getenv("DASHSCOPE_RPM", 0)),
+        tpm=int(os.getenv("DASHSCOPE_TPM", 0)),
+    ),
+    "volcano": ProviderConfig(
+        name="volcano",
+        display_name="火山引擎",
+        url=os.getenv("VOLCANO_URL", "https://open.volcengineapi.com/v1/text_generation"),
+        model="chatglm3-6b",  # 使用ChatGLM3作为备选模型
+        api_key_env="VOLCANO_API_KEY",
+        max_concurrency=int(os.getenv("VOLCANO_MAX_CONCURRENCY", 8)),
+        rpm=int(os.getenv("VOLCANO_RPM", 0)),
+        tpm=int(os.getenv("VOLCANO_TPM", 0)),
+    ),
+}
+
+
+def _build_payload(provider: ProviderConfig, prompt: str, temperature: float, top_p: float) -> dict:
+    messages = [{"role": "user", "content": prompt}]
+    if provider.name == "dashscope":
+        return {
+            "model": provider.model,
+            "input": {"messages": messages},
+            "parameters": {"temperature": temperature, "top_p": top_p, "result_format": "text"},
+        }
+    return {
+        "model": provider.model,
+        "messages": messages,
+        "parameters": {"temperature": temperature, "top_p": top_p},
+    }
+
+
+def _parse_response(provider: ProviderConfig, data: dict) -> tuple:
+    """解析响应，返回 (文本, 输入 token 数, 输出 token 数)"""
+    output = data.get("output") or {}
+    if "text" not in output:
+        raise LLMError(f"{provider.display_name}API返回格式错误: {data}")
+    usage = data.get("usage") or {}
+    input_tokens = usage.get("input_tokens", usage.get("prompt_tokens", 0))
+    output_tokens = usage.get("output_tokens", usage.get("completion_tokens", 0))
+    return output["text"].strip(), int(input_tokens or 0), int(output_tokens or 0)
+
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """读取 Retry-After（只支持秒数形式）"""
+    value = response.headers.get("Retry-After")
+    try:
+        return max(float(value), 0.0) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(backoff_max, backoff_base * (2 ** attempt)))
+
+
+class LLMGateway:
+    """
+    大模型调用网关
+
+    每个服务商一个 requests.Session（长连接复用，避免每次调用重新握手），
+    统一设置连接/读取超时，对 429、5xx 和连接失败做有限次数的带抖动退避重试，
+    并用信号量限制每个服务商的并发请求数。每次发送前按服务商的 rpm/tpm 配额排队（rate_limiter），
+    收到 429 时暂停该服务商的放行。
+    """
+
+    def __init__(self, providers: Dict[str, ProviderConfig] = None):
+        self.providers = providers or PROVIDERS
+        self._sessions: Dict[str, requests.Session] = {}
+        self._semaphores = {
+            name: threading.BoundedSemaphore(config.max_concurrency)
+            for name, config in self.providers.items()
+        }
+        self._lock = threading.Lock()
+        self._stats = {
+            name: {"calls": 0, "errors": 0, "retries": 0, "in_flight": 0}
+            for name in self.providers
+        }
+
+    def _session(self, provider: ProviderConfig) -> requests.Session:
+        session = self._sessions.get(provider.name)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(provider.name)
+                if session is None:
+                    session = requests.Session()
+                    # 连接池大小与并发上限一致；重试由网关自己处理
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=provider.max_concurrency, max_retries=0)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._sessions[provider.name] = session
+        return session
+
+    def _count(self, provider: str, field: str, delta: int = 1):
+        with self._lock:
+            self._stats[provider][field] += delta
+
+    def _post(self, provider: ProviderConfig, headers: dict, payload: dict, timeout: tuple) -> requests.Response:
+        """占用一个并发名额发送请求"""
+        semaphore = self._semaphores[provider.name]
+        if not semaphore.acquire(timeout=queue_timeout):
+            raise LLMError(f"{provider.display_name}API并发请求已满，等待超时")
+        self._count(provider.name, "in_flight")
+        try:
+            return self._session(provider).post(provider.url, headers=headers, json=payload, timeout=timeout)
+        finally:
+            self._count(provider.name, "in_flight", -1)
+            semaphore.release()
+
+    def call(self, provider: str, prompt: str, call_type: str = "default",
+             temperature: float = 0.7, top_p: float = 0.9,
+             timeout: Optional[float] = None,
+             cancel: Optional[threading.Event] = None) -> LLMResult:
+        """
+        调用大模型生成文本
+
+        Args:
+            provider: 服务商名称（dashscope / volcano）
+            prompt: 提示词
+            call_type: 调用类型，用于日志和统计（如 questions、report、treatment）
+            temperature: 采样温度
+            top_p: 核采样阈值
+            timeout: 读取超时（秒），默认使用 LLM_READ_TIMEOUT；等待限流配额的时间也不超过该值
+            cancel: 取消标记，置位后不再发起新的请求或重试（已发出的请求无法中断，结果被丢弃）
+
+        Returns:
+            LLMResult: 生成的文本、服务商、模型、token 用量和耗时
+
+        Raises:
+            LLMError: 调用失败（重试耗尽或不可重试的错误）
+        """
+        config = self.providers[provider]
+        api_key = os.getenv(config.api_key_env)
+        if not api_key:
+            raise LLMError(f"{config.api_key_env} environment variable is not set")
+
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+        payload = _build_payload(config, prompt, temperature, top_p)
+        request_timeout = (connect_timeout, timeout or read_timeout)
+        estimated_tokens = estimate_tokens(prompt)
+
+        self._count(provider, "calls")
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise LLMCancelled(f"{config.display_name}API调用已取消")
+            delay = None
+            status_code = None
+
+            # 按配额排队，超过期限按限流处理（由路由切换服务商）
+            try:
+                admitted = rate_limiter.acquire(
+                    provider, config.rpm, config.tpm, estimated_tokens, timeout=timeout, cancel=cancel
+                )
+            except RateLimitTimeout as e:
+                self._count(provider, "errors")
+                raise LLMError(f"{config.display_name}API限流: {str(e)}", 429) from e
+            if not admitted:
+                raise LLMCancelled(f"{config.display_name}API调用已取消")
+
+            try:
+                response = self._post(config, headers, payload, request_timeout)
+            except (requests.ConnectionError, requests.ConnectTimeout) as e:
+                error = f"{config.display_name}API连接失败: {str(e)}"
+            except requests.Timeout as e:
+                # 读取超时不重试：同一请求再等一次只会让调用方更久拿不到结果
+                self._count(provider, "errors")
+                raise LLMTimeout(f"{config.display_name}API响应超时: {str(e)}") from e
+            else:
+                if response.status_code == 200:
+                    try:
+                        text, input_tokens, output_tokens = _parse_response(config, response.json())
+                    except ValueError as e:
+                        self._count(provider, "errors")
+                        raise LLMError(f"{config.display_name}API返回格式错误: {response.text[:200]}") from e
+                    except LLMError:
+                        self._count(provider, "errors")
+                        raise
+                    rate_limiter.settle(provider, config.tpm, estimated_tokens, input_tokens + output_tokens)
+                    latency = time.perf_counter() - started
+                    logger.info(
+                        f"大模型调用 {call_type} 经 {provider}/{config.model} 完成: 耗时{latency:.2f}秒，"
+                        f"输入{input_tokens} token，输出{output_tokens} token，重试{attempt}次"
+                    )
+                    return LLMResult(text, provider, config.model, input_tokens, output_tokens, latency)
+
+                error = f"{config.display_name}API调用失败: {response.status_code} {response.text[:200]}"
+                status_code = response.status_code
+                if status_code not in RETRY_STATUS:
+                    self._count(provider, "errors")
+                    raise LLMError(error, status_code)
+                delay = _retry_after(response)
+
+            delay = min(delay, backoff_max) if delay is not None else _backoff(attempt)
+            if status_code == 429:
+                # 所有进程一起暂停放行，避免各自重试加剧限流；重试时在 rate_limiter 中排队等待
+                rate_limiter.throttle(provider, delay)
+
+            if attempt >= max_retries:
+                self._count(provider, "errors")
+                raise LLMError(error, status_code)
+
+            attempt += 1
+            self._count(provider, "retries")
+            logger.warning(f"{error}，{delay:.2f}秒后重试（第{attempt}次）")
+            if status_code == 429:
+                continue
+            if cancel is not None:
+                cancel.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {name: dict(values) for name, values in self._stats.items()}
+
+
+llm_gateway = LLMGateway()
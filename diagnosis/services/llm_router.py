@@ -0,0 +1,309 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional
+from .llm_gateway import PROVIDERS, llm_gateway, LLMError, LLMCancelled, LLMTimeout, LLMResult, call_outcome
+from . import metrics
+
+logger = logging.getLogger('diagnosis')
+
+# 服务商优先顺序，排在前面的为主服务商
+provider_order = [p.strip() for p in os.getenv("LLM_PROVIDER_ORDER", "dashscope,volcano").split(",") if p.strip()]
+
+# 每个服务商保留的最近调用记录条数
+window_size = int(os.getenv("LLM_ROUTER_WINDOW", 100))
+
+# 主服务商超过其 p95 延迟仍未返回时向备用服务商发送对冲请求；
+# 样本不足时使用默认等待时间，并限制在 [最小, 最大] 范围内（秒）
+hedge_min_samples = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 10))
+hedge_default_delay = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", 15))
+hedge_min_delay = float(os.getenv("LLM_HEDGE_MIN_DELAY", 1))
+hedge_max_delay = float(os.getenv("LLM_HEDGE_MAX_DELAY", 30))
+
+# 熔断：连续失败次数或最近窗口内的错误率达到阈值后，在冷却时间内跳过该服务商
+breaker_failures = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+breaker_error_rate = float(os.getenv("LLM_BREAKER_ERROR_RATE", 0.5))
+breaker_min_calls = int(os.getenv("LLM_BREAKER_MIN_CALLS", 10))
+breaker_cooldown = float(os.getenv("LLM_BREAKER_COOLDOWN", 30))
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("LLM_ROUTER_WORKERS", 32)),
+    thread_name_prefix="llm-router",
+)
+
+
+class ProviderHealth:
+    """
+    单个服务商的滚动统计和熔断状态
+
+    延迟按调用类型分别统计（生成问题和生成报告的耗时相差一个数量级），
+    错误率和熔断按服务商统计。429 是限流而不是服务故障，只计数，不触发熔断。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._latencies: Dict[str, deque] = {}
+        self._outcomes = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self._probing = False
+        self.rate_limited = 0
+        self.hedges = 0
+
+    def hedge_delay(self, call_type: str) -> float:
+        with self._lock:
+            samples = sorted(self._latencies.get(call_type, ()))
+        if len(samples) < hedge_min_samples:
+            return hedge_default_delay
+        p95 = samples[min(int(len(samples) * 0.95), len(samples) - 1)]
+        return min(max(p95, hedge_min_delay), hedge_max_delay)
+
+    def available(self) -> bool:
+        """是否可以接受请求（只查询，不占用半开状态的探测名额）"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.monotonic() - self.opened_at >= breaker_cooldown
+            return not self._probing
+
+    def allow(self) -> bool:
+        """熔断打开时返回 False；冷却结束后放行一个探测请求"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= breaker_cooldown:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self, call_type: str, latency: float):
+        with self._lock:
+            self._latencies.setdefault(call_type, deque(maxlen=window_size)).append(latency)
+            self._outcomes.append(True)
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                logger.info(f"大模型服务商 {self.name} 已恢复，熔断关闭")
+            self.state = "closed"
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._outcomes.append(False)
+            self.consecutive_failures += 1
+            failures = self._outcomes.count(False)
+            error_rate = failures / len(self._outcomes)
+            if self.state == "half_open" or self.consecutive_failures >= breaker_failures or (
+                len(self._outcomes) >= breaker_min_calls and error_rate >= breaker_error_rate
+            ):
+                if self.state != "open":
+                    logger.warning(
+                        f"大模型服务商 {self.name} 熔断 {breaker_cooldown:g}秒"
+                        f"（连续失败{self.consecutive_failures}次，错误率{error_rate:.2f}）"
+                    )
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+    def record_rate_limited(self):
+        with self._lock:
+            self.rate_limited += 1
+            self._probing = False
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedges += 1
+
+    def release_probe(self):
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = len(self._outcomes)
+            latencies = {}
+            for call_type, values in self._latencies.items():
+                ordered = sorted(values)
+                latencies[call_type] = {
+                    "samples": len(ordered),
+                    "p50": round(ordered[len(ordered) // 2], 3),
+                    "p95": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 3),
+                }
+            return {
+                "state": self.state,
+                "error_rate": round(self._outcomes.count(False) / calls, 4) if calls else 0.0,
+                "consecutive_failures": self.consecutive_failures,
+                "rate_limited": self.rate_limited,
+                "hedges": self.hedges,
+                "latency": latencies,
+            }
+
+
+class LLMRouter:
+    """
+    在多个大模型服务商之间路由
+
+    按优先顺序选择未熔断的服务商。主服务商超过其 p95 延迟仍未返回时，
+    向下一个服务商发送对冲请求，取最先成功的结果并取消另一方；
+    主服务商直接失败时立即改用下一个服务商。
+    """
+
+    def __init__(self, providers: List[str] = None):
+        self.providers = providers or provider_order
+        self.health = {name: ProviderHealth(name) for name in self.providers}
+
+    def next_provider(self, tried: List[str]) -> Optional[str]:
+        """按优先顺序选出下一个未熔断的服务商（半开状态时占用探测名额）"""
+        for name in self.providers:
+            if name not in tried and self.health[name].allow():
+                return name
+        return None
+
+    def _has_next(self, tried: List[str]) -> bool:
+        return any(name not in tried and self.health[name].available() for name in self.providers)
+
+    def _attempt(self, provider: str, prompt: str, call_type: str, timeout: Optional[float],
+                 cancel: threading.Event, params: dict) -> LLMResult:
+        health = self.health[provider]
+        started = time.perf_counter()
+        try:
+            result = llm_gateway.call(provider, prompt, call_type=call_type, timeout=timeout,
+                                      cancel=cancel, **params)
+        except LLMCancelled as e:
+            health.release_probe()
+            record_attempt(provider, call_type, prompt, started, error=e)
+            raise
+        except LLMError as e:
+            if e.status_code == 429:
+                health.record_rate_limited()
+            else:
+                health.record_failure()
+            record_attempt(provider, call_type, prompt, started, error=e)
+            raise
+        except Exception as e:
+            health.record_failure()
+            record_attempt(provider, call_type, prompt, started, error=e)
+            raise
+        health.record_success(call_type, result.latency)
+        record_attempt(provider, call_type, prompt, started, result=result)
+        return result
+
+    def call(self, prompt: str, call_type: str = "default", timeout: Optional[float] = None,
+             **params) -> LLMResult:
+        """
+        调用大模型，自动选择服务商、对冲慢请求并跳过熔断中的服务商
+
+        Args:
+            prompt: 提示词
+            call_type: 调用类型（questions、report、treatment 等），延迟统计按类型区分
+            timeout: 总体期限（秒），同时作为每次请求的读取超时上限
+            **params: 传给 llm_gateway.call 的采样参数
+
+        Returns:
+            LLMResult: 最先成功的结果
+
+        Raises:
+            LLMError: 所有服务商都失败或超过期限
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        cancel = threading.Event()
+        tried: List[str] = []
+        pending = {}
+        last_error: Optional[Exception] = None
+
+        def launch(provider: str):
+            tried.append(provider)
+            remaining = deadline - time.monotonic() if deadline else None
+            future = _executor.submit(self._attempt, provider, prompt, call_type, remaining, cancel, params)
+            pending[future] = provider
+
+        # 全部熔断时仍尝试主服务商，避免请求直接失败
+        launch(self.next_provider(tried) or self.providers[0])
+        try:
+            while pending:
+                remaining = deadline - time.monotonic() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    metrics.record_request(call_type, None, "timeout")
+                    raise LLMTimeout(f"大模型调用超过期限 {timeout:g}秒")
+
+                # 只有一个请求在进行且还有备用服务商时，最多等待该服务商的 p95 延迟
+                hedge_from = None
+                wait_for = remaining
+                if len(pending) == 1 and self._has_next(tried):
+                    hedge_from = next(iter(pending.values()))
+                    hedge_after = self.health[hedge_from].hedge_delay(call_type)
+                    if remaining is None or hedge_after < remaining:
+                        wait_for = hedge_after
+                    else:
+                        hedge_from = None
+
+                done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+                if not done:
+                    if hedge_from is not None:
+                        provider = self.next_provider(tried)
+                        if provider is not None:
+                            self.health[hedge_from].record_hedge()
+                            metrics.record_fallback(call_type, hedge_from, provider, "hedge")
+                            logger.info(
+                                f"大模型调用 {call_type}: {hedge_from} 超过 p95 延迟仍未返回，向 {provider} 发送对冲请求"
+                            )
+                            launch(provider)
+                    continue
+
+                failed = None
+                for future in done:
+                    provider = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        last_error = e
+                        failed = provider
+                        logger.warning(f"大模型调用 {call_type} 经 {provider} 失败: {str(e)}")
+                        continue
+                    metrics.record_request(call_type, provider, "success")
+                    return result
+
+                # 没有进行中的请求时，立即改用下一个服务商
+                if not pending:
+                    provider = self.next_provider(tried)
+                    if provider is not None:
+                        metrics.record_fallback(call_type, failed, provider, "failover")
+                        launch(provider)
+        finally:
+            # 通知仍在进行的请求放弃（不再重试，结果丢弃）
+            cancel.set()
+
+        metrics.record_request(call_type, None, call_outcome(last_error))
+        raise LLMError(f"所有大模型服务商调用失败: {str(last_error)}")
+
+    def stats(self) -> dict:
+        return {name: health.stats() for name, health in self.health.items()}
+
+
+def record_attempt(provider: str, call_type: str, prompt: str, started: float, result: Optional[LLMResult] = None,
+                   error: Optional[Exception] = None, mode: str = "sync"):
+    """把一次服务商调用计入指标（started 为 time.perf_counter() 的起始值）"""
+    config = PROVIDERS.get(provider)
+    metrics.record_call(
+        provider,
+        result.model if result else (config.model if config else ""),
+        call_type,
+        call_outcome(error),
+        time.perf_counter() - started,
+        len(prompt),
+        input_tokens=result.input_tokens if result else 0,
+        output_tokens=result.output_tokens if result else 0,
+        mode=mode,
+        error=str(error) if error is not None else None,
+    )
+
+
+llm_router = LLMRouter()
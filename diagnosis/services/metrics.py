@@ -0,0 +1,239 @@
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('diagnosis')
+
+# 每次大模型调用一行 JSON，便于日志系统检索和聚合
+call_logger = logging.getLogger('diagnosis.llm_calls')
+
+# 提示词长度分档（字符数），用于观察提示词大小与延迟的关系
+PROMPT_SIZE_BUCKETS = (500, 1000, 2000, 4000)
+
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000)
+
+
+def prompt_size_label(prompt_chars: int) -> str:
+    for i, upper in enumerate(PROMPT_SIZE_BUCKETS):
+        if prompt_chars < upper:
+            lower = PROMPT_SIZE_BUCKETS[i - 1] if i else 0
+            return f"{lower}-{upper}"
+    return f"{PROMPT_SIZE_BUCKETS[-1]}+"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for upper, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = f'le="{_number(upper)}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(round(total, 6))}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+def _gauge(name: str, documentation: str, labelnames: Tuple[str, ...], samples: Iterable[tuple],
+           kind: str = "gauge") -> List[str]:
+    """运行时状态（读取各模块的 stats()）输出为 gauge/counter"""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for *labels, value in samples:
+        lines.append(f"{name}{_labels(labelnames, labels)} {_number(value)}")
+    return lines
+
+
+# 每个服务商的每次调用（含重试，对冲的两次请求各算一次）
+llm_calls = Counter(
+    "ctd_llm_calls_total", "LLM provider calls by outcome (success, error, timeout, rate_limited, cancelled)",
+    ("provider", "model", "call_type", "outcome"),
+)
+llm_call_duration = Histogram(
+    "ctd_llm_call_duration_seconds", "LLM provider call latency including retries",
+    ("provider", "call_type", "prompt_size"), LATENCY_BUCKETS,
+)
+llm_tokens = Counter(
+    "ctd_llm_tokens_total", "Tokens reported by the provider",
+    ("provider", "model", "call_type", "kind"),
+)
+llm_prompt_tokens = Histogram(
+    "ctd_llm_prompt_tokens", "Prompt tokens per successful call",
+    ("provider", "call_type"), TOKEN_BUCKETS,
+)
+# 一次业务请求（路由层，可能包含对冲和切换）
+llm_requests = Counter(
+    "ctd_llm_requests_total", "Routed LLM requests by final outcome and serving provider",
+    ("call_type", "provider", "outcome"),
+)
+llm_fallbacks = Counter(
+    "ctd_llm_fallbacks_total", "Requests sent to a backup provider (reason: failover or hedge)",
+    ("call_type", "from_provider", "to_provider", "reason"),
+)
+
+_REGISTRY = (llm_calls, llm_call_duration, llm_tokens, llm_prompt_tokens, llm_requests, llm_fallbacks)
+
+
+def record_call(provider: str, model: str, call_type: str, outcome: str, latency: float, prompt_chars: int,
+                input_tokens: int = 0, output_tokens: int = 0, mode: str = "sync", error: Optional[str] = None):
+    """
+    记录一次服务商调用，并输出一行结构化日志
+
+    Args:
+        provider: 服务商名称
+        model: 模型名称
+        call_type: 调用类型（questions、report、treatment 等）
+        outcome: success / error / timeout / rate_limited / cancelled
+        latency: 耗时（秒，含重试和限流排队）
+        prompt_chars: 提示词字符数
+        input_tokens: 服务商返回的输入 token 数
+        output_tokens: 服务商返回的输出 token 数
+        mode: sync / async / stream
+        error: 失败原因
+    """
+    prompt_size = prompt_size_label(prompt_chars)
+    llm_calls.inc(provider, model, call_type, outcome)
+    llm_call_duration.observe(latency, provider, call_type, prompt_size)
+    if input_tokens:
+        llm_tokens.inc(provider, model, call_type, "input", amount=input_tokens)
+        llm_prompt_tokens.observe(input_tokens, provider, call_type)
+    if output_tokens:
+        llm_tokens.inc(provider, model, call_type, "output", amount=output_tokens)
+
+    record = {
+        "event": "llm_call",
+        "ts": round(time.time(), 3),
+        "provider": provider,
+        "model": model,
+        "call_type": call_type,
+        "mode": mode,
+        "outcome": outcome,
+        "latency": round(latency, 3),
+        "prompt_chars": prompt_chars,
+        "prompt_size": prompt_size,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+    }
+    if error:
+        record["error"] = error[:200]
+    call_logger.info(json.dumps(record, ensure_ascii=False))
+
+
+def record_request(call_type: str, provider: Optional[str], outcome: str):
+    """记录一次路由层请求的最终结果（provider 为最终返回结果的服务商）"""
+    llm_requests.inc(call_type, provider or "none", outcome)
+
+
+def record_fallback(call_type: str, from_provider: str, to_provider: str, reason: str):
+    """记录一次切换到备用服务商（failover：主服务商失败；hedge：主服务商慢于 p95）"""
+    llm_fallbacks.inc(call_type, from_provider, to_provider, reason)
+
+
+def _runtime_metrics() -> List[str]:
+    """抓取时读取网关、路由、限流器和回复缓存的当前状态"""
+    # 延迟导入：这些模块在调用时会记录指标
+    from .llm_gateway import llm_gateway
+    from .llm_router import llm_router
+    from .rate_limiter import rate_limiter
+    from . import llm_cache
+
+    lines = []
+    gateway = llm_gateway.stats()
+    lines += _gauge("ctd_llm_in_flight", "LLM requests currently in flight (sync gateway)", ("provider",),
+                    [(name, stats["in_flight"]) for name, stats in gateway.items()])
+    lines += _gauge("ctd_llm_retries_total", "Retries in the sync gateway", ("provider",),
+                    [(name, stats["retries"]) for name, stats in gateway.items()], kind="counter")
+
+    routing = llm_router.stats()
+    lines += _gauge("ctd_llm_breaker_open", "1 when the provider circuit breaker is open or half-open", ("provider",),
+                    [(name, int(stats.get("state") != "closed")) for name, stats in routing.items()])
+
+    limits = rate_limiter.stats()["providers"]
+    lines += _gauge("ctd_llm_rate_limit_waiting", "Requests waiting for rate limit quota", ("provider",),
+                    [(name, stats["waiting"]) for name, stats in limits.items()])
+    lines += _gauge("ctd_llm_rate_limit_wait_seconds_total", "Total time spent waiting for quota", ("provider",),
+                    [(name, stats["wait_seconds"]) for name, stats in limits.items()], kind="counter")
+    lines += _gauge("ctd_llm_rate_limit_rejected_total", "Requests rejected by the limiter (queue full or timeout)",
+                    ("provider",), [(name, stats["rejected"] + stats["timeouts"]) for name, stats in limits.items()],
+                    kind="counter")
+
+    cache = llm_cache.stats()["by_call_type"]
+    lines += _gauge("ctd_llm_cache_lookups_total", "LLM reply cache lookups", ("call_type", "result"),
+                    [(call_type, result, counts[key])
+                     for call_type, counts in cache.items() for result, key in (("hit", "hits"), ("miss", "misses"))],
+                    kind="counter")
+    lines += _gauge("ctd_llm_cache_saved_tokens_total", "Tokens saved by LLM reply cache hits", ("call_type",),
+                    [(call_type, counts["saved"].get("input_tokens", 0) + counts["saved"].get("output_tokens", 0))
+                     for call_type, counts in cache.items()], kind="counter")
+    return lines
+
+
+def render() -> str:
+    """输出 Prometheus 文本格式（本进程的统计）"""
+    lines = []
+    for metric in _REGISTRY:
+        lines += metric.render()
+    try:
+        lines += _runtime_metrics()
+    except Exception as e:
+        logger.warning(f"采集运行时指标失败: {str(e)}")
+    return "\n".join(lines) + "\n"
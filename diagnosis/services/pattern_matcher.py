@@ -0,0 +1,212 @@
+import os
+import time
+import logging
+import threading
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+import redis
+from ..models import TCMPattern, TCMPatternSynonym
+from .redis_client import get_redis
+
+logger = logging.getLogger('diagnosis')
+
+# 未配置 Redis 时无法得知其他进程对证型词典的修改，超过该时间（秒）后重新加载
+max_age = float(os.getenv("PATTERN_DICTIONARY_MAX_AGE", 300))
+
+VERSION_KEY = "ctd:pattern_dictionary:version"
+
+
+class Automaton:
+    """
+    Aho-Corasick 自动机：对文本扫描一遍即可找出所有词条的全部出现位置
+
+    状态转移用字典保存（中文字符集大，不适合数组），失配指针按广度优先构建，
+    每个状态的输出合并了失配链上所有状态的输出。
+    """
+
+    def __init__(self, terms: Dict[str, int]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[int, int]]] = [[]]  # (词条长度, 证型 ID)
+
+        for term, pattern_id in terms.items():
+            state = 0
+            for char in term:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append((len(term), pattern_id))
+
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self._goto)
+
+    def find_all(self, text: str) -> List[Tuple[int, int, int]]:
+        """返回所有匹配 (起始位置, 长度, 证型 ID)，包括相互重叠的匹配"""
+        matches = []
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, pattern_id in output[state]:
+                matches.append((end - length, length, pattern_id))
+        return matches
+
+    def find(self, text: str) -> List[Tuple[int, int, int]]:
+        """
+        返回不被更长匹配完全包含的匹配，按出现位置排序
+
+        例如“肝肾阴虚”只匹配“肝肾阴虚”，不再匹配其中的“肾阴虚”“阴虚”；
+        部分重叠的匹配都保留，如“脾胃气虚证”中的“脾胃气虚”和“气虚证”。
+        """
+        matches = sorted(self.find_all(text), key=lambda m: (m[0], -m[1]))
+        selected = []
+        covered = 0
+        for match in matches:
+            # 起始位置不早于已选的匹配，结束位置也不晚于其中最靠后的，即被其包含
+            if match[0] + match[1] > covered:
+                selected.append(match)
+                covered = match[0] + match[1]
+        return selected
+
+
+class PatternDictionary(NamedTuple):
+    """不可变的证型词典快照"""
+    names: Dict[int, str]  # 证型 ID -> 证型名称
+    terms: Dict[str, int]  # 证型名称及同义词 -> 证型 ID
+    automaton: Automaton
+    version: int
+
+
+def canonical_names(dictionary: PatternDictionary, terms: Iterable[str]) -> List[str]:
+    result = []
+    for term in terms:
+        pattern_id = dictionary.terms.get(term)
+        result.append(dictionary.names[pattern_id] if pattern_id is not None else term)
+    return result
+
+
+class PatternMatcher:
+    """
+    从报告内容中提取证型
+
+    证型词典（TCMPattern 及其同义词）编译为 Aho-Corasick 自动机并缓存在进程内，
+    提取时对报告内容只扫描一遍，同义词统一为对应的证型。词典修改后由信号调用 invalidate()，
+    配置了 REDIS_URL 时其他进程通过版本号同步；未配置时超过 PATTERN_DICTIONARY_MAX_AGE 重新加载。
+    """
+
+    def __init__(self):
+        self._dictionary: Optional[PatternDictionary] = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"builds": 0, "last_build_seconds": 0.0}
+
+    def dictionary(self) -> PatternDictionary:
+        remote = self._remote_version()
+        dictionary = self._dictionary
+        if dictionary is not None and not self._stale(dictionary, remote):
+            return dictionary
+        with self._lock:
+            dictionary = self._dictionary
+            if dictionary is None or self._stale(dictionary, remote):
+                dictionary = self._build(remote)
+            return dictionary
+
+    def _stale(self, dictionary: PatternDictionary, remote: Optional[int]) -> bool:
+        if remote is None:
+            return time.monotonic() - self._built_at >= max_age
+        return remote != dictionary.version
+
+    def extract(self, text: str) -> List[int]:
+        """提取文本中的证型 ID，按首次出现的顺序去重"""
+        if not text:
+            return []
+        found = self.dictionary().automaton.find(text)
+        return list(dict.fromkeys(pattern_id for _, _, pattern_id in found))
+
+    def extract_names(self, text: str) -> List[str]:
+        """提取文本中的证型名称，按首次出现的顺序去重"""
+        names = self.dictionary().names
+        return [names[pattern_id] for pattern_id in self.extract(text)]
+
+    def canonical(self, terms: Iterable[str]) -> List[str]:
+        """将证型名称或同义词统一为证型名称，词典中没有的保持原样"""
+        return canonical_names(self.dictionary(), terms)
+
+    def register(self, terms: Iterable[str]):
+        """将词典中没有的证型（如医生新填写的擅长证型）加入词典"""
+        dictionary = self.dictionary()
+        missing = [term for term in dict.fromkeys(terms) if term not in dictionary.terms]
+        if not missing:
+            return
+        # 其他进程可能已加入或设为同义词，以数据库为准
+        missing = set(missing) - set(TCMPatternSynonym.objects.filter(name__in=missing).values_list('name', flat=True))
+        for term in missing:
+            TCMPattern.objects.get_or_create(name=term)
+
+    def invalidate(self):
+        """丢弃词典（所有进程），下次使用时重新加载"""
+        client = get_redis()
+        if client is not None:
+            try:
+                client.incr(VERSION_KEY)
+            except redis.RedisError as e:
+                logger.warning(f"发布证型词典的变更失败: {str(e)}")
+        with self._lock:
+            self._dictionary = None
+
+    def stats(self) -> dict:
+        dictionary = self._dictionary
+        return dict(
+            self._stats,
+            patterns=len(dictionary.names) if dictionary else 0,
+            terms=len(dictionary.terms) if dictionary else 0,
+            states=len(dictionary.automaton) if dictionary else 0,
+        )
+
+    def _build(self, version: Optional[int]) -> PatternDictionary:
+        started = time.perf_counter()
+        names = dict(TCMPattern.objects.values_list('id', 'name'))
+        terms = {name: pattern_id for pattern_id, name in names.items()}
+        for name, pattern_id in TCMPatternSynonym.objects.values_list('name', 'pattern_id'):
+            terms.setdefault(name, pattern_id)
+        dictionary = PatternDictionary(names, terms, Automaton(terms), version or 0)
+        self._dictionary = dictionary
+        self._built_at = time.monotonic()
+        elapsed = time.perf_counter() - started
+        self._stats["builds"] += 1
+        self._stats["last_build_seconds"] = round(elapsed, 4)
+        logger.info(f"证型词典已编译: {len(names)} 个证型，{len(terms)} 个词条，"
+                    f"{len(dictionary.automaton)} 个状态，耗时{elapsed:.3f}秒")
+        return dictionary
+
+    @staticmethod
+    def _remote_version() -> Optional[int]:
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            return int(client.get(VERSION_KEY) or 0)
+        except redis.RedisError as e:
+            logger.warning(f"读取证型词典的版本号失败: {str(e)}")
+            return None
+
+
+# 全局证型提取器（每个进程一份）
+pattern_matcher = PatternMatcher()
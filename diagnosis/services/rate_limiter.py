@@ -0,0 +1,346 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Dict, Optional
+import redis
+from asgiref.sync import sync_to_async
+from .redis_client import get_redis
+
+logger = logging.getLogger('diagnosis')
+
+# 令牌桶容量：最多可一次性用掉多少秒的配额
+burst_seconds = float(os.getenv("LLM_RATE_BURST_SECONDS", 10))
+
+# 每个服务商同时排队等待配额的最大请求数（每个进程），超出时直接失败
+queue_size = int(os.getenv("LLM_RATE_QUEUE_SIZE", 100))
+
+# 排队等待配额的最长时间（秒）
+wait_timeout = float(os.getenv("LLM_RATE_QUEUE_TIMEOUT", 30))
+
+# 预估 token 用量时假定的输出长度，调用完成后按实际用量修正
+expected_output_tokens = int(os.getenv("LLM_RATE_OUTPUT_TOKENS", 800))
+
+_WINDOW = 500
+_KEY_TTL_MS = 120 * 1000
+
+# 同时检查暂停标记、请求数桶和 token 桶，全部满足时才扣减，返回需要等待的秒数（"0" 表示已放行）
+_TAKE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local pause = redis.call('PTTL', KEYS[3])
+if pause > 0 then
+  return tostring(pause / 1000)
+end
+local function refill(key, rate, cap)
+  if rate <= 0 then return nil end
+  local v = redis.call('HMGET', key, 'level', 'ts')
+  local level = tonumber(v[1]) or cap
+  local ts = tonumber(v[2]) or now
+  return math.min(cap, level + math.max(now - ts, 0) * rate)
+end
+local req_rate, req_cap = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tok_rate, tok_cap, cost = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local req = refill(KEYS[1], req_rate, req_cap)
+local tok = refill(KEYS[2], tok_rate, tok_cap)
+local wait = 0
+if req and req < 1 then wait = math.max(wait, (1 - req) / req_rate) end
+if tok and tok < cost then wait = math.max(wait, (cost - tok) / tok_rate) end
+if wait > 0 then
+  return tostring(wait)
+end
+if req then
+  redis.call('HSET', KEYS[1], 'level', tostring(req - 1), 'ts', tostring(now))
+  redis.call('PEXPIRE', KEYS[1], ARGV[6])
+end
+if tok then
+  redis.call('HSET', KEYS[2], 'level', tostring(tok - cost), 'ts', tostring(now))
+  redis.call('PEXPIRE', KEYS[2], ARGV[6])
+end
+return '0'
+"""
+
+# 按实际用量修正 token 桶（delta 为正时退还，为负时补扣）
+_ADJUST_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local rate, cap, delta = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local v = redis.call('HMGET', KEYS[1], 'level', 'ts')
+local level = tonumber(v[1]) or cap
+local ts = tonumber(v[2]) or now
+level = math.min(cap, level + math.max(now - ts, 0) * rate + delta)
+redis.call('HSET', KEYS[1], 'level', tostring(level), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], ARGV[4])
+return tostring(level)
+"""
+
+
+class RateLimitTimeout(Exception):
+    """排队已满或在期限内未获得配额"""
+
+
+def estimate_tokens(prompt: str) -> int:
+    """粗略预估一次调用的 token 数：中文约一字一个 token，加上预期的输出长度"""
+    return len(prompt) + expected_output_tokens
+
+
+def _bucket(per_minute: int) -> tuple:
+    """每分钟配额 -> (每秒补充量, 桶容量)"""
+    rate = per_minute / 60.0
+    return rate, max(rate * burst_seconds, 1.0)
+
+
+class _LocalBuckets:
+    """进程内令牌桶，未配置 Redis 或 Redis 不可用时使用（配额按进程计算）"""
+
+    def __init__(self):
+        self._levels: Dict[str, tuple] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, key: str, rate: float, cap: float, now: float) -> float:
+        level, ts = self._levels.get(key, (cap, now))
+        return min(cap, level + max(now - ts, 0) * rate)
+
+    def take(self, provider: str, rpm: int, tpm: int, cost: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            paused = self._paused_until.get(provider, 0) - now
+            if paused > 0:
+                return paused
+            req = tok = None
+            wait = 0.0
+            if rpm > 0:
+                req_rate, req_cap = _bucket(rpm)
+                req = self._refill(f"{provider}:rpm", req_rate, req_cap, now)
+                if req < 1:
+                    wait = max(wait, (1 - req) / req_rate)
+            if tpm > 0:
+                tok_rate, tok_cap = _bucket(tpm)
+                tok = self._refill(f"{provider}:tpm", tok_rate, tok_cap, now)
+                if tok < cost:
+                    wait = max(wait, (cost - tok) / tok_rate)
+            if wait > 0:
+                return wait
+            if req is not None:
+                self._levels[f"{provider}:rpm"] = (req - 1, now)
+            if tok is not None:
+                self._levels[f"{provider}:tpm"] = (tok - cost, now)
+            return 0.0
+
+    def adjust(self, provider: str, tpm: int, delta: float):
+        now = time.monotonic()
+        rate, cap = _bucket(tpm)
+        key = f"{provider}:tpm"
+        with self._lock:
+            self._levels[key] = (min(cap, self._refill(key, rate, cap, now) + delta), now)
+
+    def pause(self, provider: str, seconds: float):
+        with self._lock:
+            self._paused_until[provider] = max(self._paused_until.get(provider, 0), time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    大模型服务商限流器
+
+    每个服务商两个令牌桶：每分钟请求数（rpm）和每分钟 token 数（tpm），为 0 时不限制。
+    配置了 REDIS_URL 时桶状态保存在 Redis 中，由 Lua 脚本原子地检查和扣减，所有进程共享同一份配额；
+    否则（或 Redis 出错时）退化为进程内令牌桶。
+    配额不足时请求在有界队列中等待，超过期限或队列已满时抛出 RateLimitTimeout。
+    服务商返回 429 时暂停该服务商的放行，所有进程一起等待，而不是各自重试。
+    """
+
+    def __init__(self, namespace: str = "ratelimit"):
+        self.namespace = namespace
+        self._local = _LocalBuckets()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, dict] = {}
+        self._waits: Dict[str, deque] = {}
+
+    def _key(self, provider: str, suffix: str) -> str:
+        return f"ctd:{self.namespace}:{provider}:{suffix}"
+
+    def _stat(self, provider: str) -> dict:
+        stats = self._stats.get(provider)
+        if stats is None:
+            stats = self._stats[provider] = {
+                "admitted": 0, "waited": 0, "rejected": 0, "timeouts": 0, "cancelled": 0, "throttled": 0,
+                "waiting": 0, "wait_seconds": 0.0, "max_wait": 0.0,
+            }
+            self._waits[provider] = deque(maxlen=_WINDOW)
+        return stats
+
+    def _take(self, provider: str, rpm: int, tpm: int, tokens: int) -> float:
+        """尝试获取配额，返回需要等待的秒数（0 表示已放行）"""
+        cost = min(float(tokens), _bucket(tpm)[1]) if tpm > 0 else 0.0
+        client = get_redis()
+        if client is not None:
+            req_rate, req_cap = _bucket(rpm) if rpm > 0 else (0, 0)
+            tok_rate, tok_cap = _bucket(tpm) if tpm > 0 else (0, 0)
+            try:
+                wait = client.eval(
+                    _TAKE_SCRIPT, 3,
+                    self._key(provider, "rpm"), self._key(provider, "tpm"), self._key(provider, "pause"),
+                    req_rate, req_cap, tok_rate, tok_cap, cost, _KEY_TTL_MS,
+                )
+                return float(wait)
+            except redis.RedisError as e:
+                logger.warning(f"Redis限流不可用，使用进程内限流 ({provider}): {str(e)}")
+        return self._local.take(provider, rpm, tpm, cost)
+
+    def _enter_queue(self, provider: str):
+        with self._lock:
+            stats = self._stat(provider)
+            if stats["waiting"] >= queue_size:
+                stats["rejected"] += 1
+                raise RateLimitTimeout(f"{provider} 限流排队已满（{queue_size}）")
+            stats["waiting"] += 1
+
+    def _leave_queue(self, provider: str, waited: float, outcome: str):
+        with self._lock:
+            stats = self._stat(provider)
+            stats["waiting"] -= 1
+            stats[outcome] += 1
+            stats["waited"] += 1
+            stats["wait_seconds"] += waited
+            stats["max_wait"] = max(stats["max_wait"], waited)
+            self._waits[provider].append(waited)
+
+    def _admitted(self, provider: str):
+        with self._lock:
+            self._stat(provider)["admitted"] += 1
+
+    @staticmethod
+    def _sleep_for(wait: float, deadline: float) -> float:
+        # 加少量抖动，避免同时等待的请求在同一时刻一起重试
+        return min(wait * random.uniform(1.0, 1.1) + 0.005, max(deadline - time.monotonic(), 0))
+
+    def acquire(self, provider: str, rpm: int = 0, tpm: int = 0, tokens: int = 0,
+                timeout: Optional[float] = None, cancel: Optional[threading.Event] = None) -> bool:
+        """
+        等待并获取一次调用的配额
+
+        Args:
+            provider: 服务商名称
+            rpm: 每分钟请求数上限，0 表示不限制
+            tpm: 每分钟 token 数上限，0 表示不限制
+            tokens: 本次调用预估的 token 数
+            timeout: 最长等待时间（秒），不超过 LLM_RATE_QUEUE_TIMEOUT
+            cancel: 取消标记，置位后停止等待
+
+        Returns:
+            bool: 获得配额返回 True，等待期间被取消返回 False
+
+        Raises:
+            RateLimitTimeout: 排队已满或超过期限
+        """
+        wait = self._take(provider, rpm, tpm, tokens)
+        if wait <= 0:
+            self._admitted(provider)
+            return True
+
+        self._enter_queue(provider)
+        started = time.monotonic()
+        deadline = started + min(timeout or wait_timeout, wait_timeout)
+        outcome = "timeouts"
+        try:
+            while True:
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(f"{provider} 在 {deadline - started:.1f} 秒内未获得调用配额")
+                delay = self._sleep_for(wait, deadline)
+                if cancel is not None:
+                    if cancel.wait(delay):
+                        outcome = "cancelled"
+                        return False
+                else:
+                    time.sleep(delay)
+                wait = self._take(provider, rpm, tpm, tokens)
+                if wait <= 0:
+                    outcome = "admitted"
+                    return True
+        finally:
+            self._leave_queue(provider, time.monotonic() - started, outcome)
+
+    async def aacquire(self, provider: str, rpm: int = 0, tpm: int = 0, tokens: int = 0,
+                       timeout: Optional[float] = None) -> bool:
+        """acquire 的异步版本，等待期间不占用线程；任务被取消时停止排队"""
+        take = sync_to_async(self._take, thread_sensitive=False)
+        wait = await take(provider, rpm, tpm, tokens)
+        if wait <= 0:
+            self._admitted(provider)
+            return True
+
+        self._enter_queue(provider)
+        started = time.monotonic()
+        deadline = started + min(timeout or wait_timeout, wait_timeout)
+        outcome = "timeouts"
+        try:
+            while True:
+                if time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(f"{provider} 在 {deadline - started:.1f} 秒内未获得调用配额")
+                await asyncio.sleep(self._sleep_for(wait, deadline))
+                wait = await take(provider, rpm, tpm, tokens)
+                if wait <= 0:
+                    outcome = "admitted"
+                    return True
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        finally:
+            self._leave_queue(provider, time.monotonic() - started, outcome)
+
+    def settle(self, provider: str, tpm: int, estimated: int, actual: int):
+        """调用完成后按实际 token 用量修正 token 桶"""
+        if tpm <= 0 or not actual or actual == estimated:
+            return
+        rate, cap = _bucket(tpm)
+        delta = min(float(estimated), cap) - actual
+        client = get_redis()
+        if client is not None:
+            try:
+                client.eval(_ADJUST_SCRIPT, 1, self._key(provider, "tpm"), rate, cap, delta, _KEY_TTL_MS)
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Redis限流不可用，使用进程内限流 ({provider}): {str(e)}")
+        self._local.adjust(provider, tpm, delta)
+
+    def throttle(self, provider: str, seconds: float):
+        """服务商返回 429 后暂停放行 seconds 秒"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            self._stat(provider)["throttled"] += 1
+        client = get_redis()
+        if client is not None:
+            try:
+                key = self._key(provider, "pause")
+                # 只延长不缩短已有的暂停
+                if client.pttl(key) < seconds * 1000:
+                    client.set(key, 1, px=max(int(seconds * 1000), 1))
+                return
+            except redis.RedisError as e:
+                logger.warning(f"Redis限流不可用，使用进程内限流 ({provider}): {str(e)}")
+        self._local.pause(provider, seconds)
+
+    def stats(self) -> dict:
+        """各服务商的放行、排队、拒绝次数和排队等待时间（本进程）"""
+        result = {}
+        with self._lock:
+            for provider, stats in self._stats.items():
+                waits = sorted(self._waits[provider])
+                result[provider] = dict(
+                    stats,
+                    wait_seconds=round(stats["wait_seconds"], 3),
+                    max_wait=round(stats["max_wait"], 3),
+                    avg_wait=round(stats["wait_seconds"] / stats["waited"], 3) if stats["waited"] else 0.0,
+                    p95_wait=round(waits[min(int(len(waits) * 0.95), len(waits) - 1)], 3) if waits else 0.0,
+                )
+        return {"backend": "redis" if get_redis() is not None else "local", "providers": result}
+
+
+# 全局限流器
+rate_limiter = RateLimiter()
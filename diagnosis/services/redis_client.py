@@ -0,0 +1,33 @@
+import logging
+import threading
+from typing import Optional
+import redis
+from django.conf import settings
+
+logger = logging.getLogger('diagnosis')
+
+_client: Optional[redis.Redis] = None
+_lock = threading.Lock()
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """
+    获取进程内共享的 Redis 客户端
+
+    Returns:
+        未配置 REDIS_URL 时返回 None，调用方应退化为进程内实现
+    """
+    global _client
+    url = getattr(settings, 'REDIS_URL', None)
+    if not url:
+        return None
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = redis.Redis.from_url(
+                    url,
+                    socket_connect_timeout=getattr(settings, 'REDIS_CONNECT_TIMEOUT', 1.0),
+                    socket_timeout=getattr(settings, 'REDIS_SOCKET_TIMEOUT', 2.0),
+                    health_check_interval=30,
+                )
+    return _client
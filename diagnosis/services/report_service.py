@@ -1,22 +1,135 @@
+import re
 import json
+import time
+import asyncio
 import logging
-import requests
 import os
-from typing import List, Dict
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Optional
 from dotenv import load_dotenv
+from .llm_gateway import LLMResult
+from .llm_cache import cached_llm_call
+from .llm_async import acall
 
 # 加载环境变量
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# 诊断报告和治疗方案并发生成的共同期限（秒）
+generation_timeout = float(os.getenv("REPORT_GENERATION_TIMEOUT", 120))
+
+# 并发生成使用的线程数（每份报告占用两个）
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("REPORT_GENERATION_WORKERS", 8)),
+    thread_name_prefix="report-generation",
+)
+
+# 所有问题回答完毕后是否在后台预生成报告
+pregeneration_enabled = os.getenv("REPORT_PREGENERATION", "true").lower() not in ("0", "false", "no", "off")
+
+# 生成模式：separate 为诊断报告和治疗方案各调用一次，combined 为一次调用生成两部分
+generation_mode = os.getenv("REPORT_GENERATION_MODE", "separate").strip().lower()
+
+# combined 模式回复中两部分的分隔标记
+REPORT_MARKER = "===诊断报告==="
+TREATMENT_MARKER = "===治疗方案==="
+
+# 分隔标记所在行，容忍前后的 Markdown 标题/加粗符号、全角等号和【】形式
+_MARKER_LINE = re.compile(
+    r"^[ \t#*>]*(?:[=＝]{2,}|【)[ \t]*(诊断报告|治疗方案)[ \t]*(?:[=＝]{2,}|】)[ \t*]*$",
+    re.MULTILINE,
+)
+_JSON_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+_SECTION_KEYS = {
+    "report": ("report", "诊断报告"),
+    "treatment": ("treatment", "treatment_plan", "治疗方案"),
+}
+
+_stats_lock = threading.Lock()
+_mode_stats: Dict[str, dict] = {}
+
+
+def parse_combined(text: str) -> Optional[Dict[str, str]]:
+    """
+    拆分 combined 模式的回复
+
+    优先按分隔标记拆分；模型改为输出 JSON（{"report": ..., "treatment": ...}，可带 ```json 代码块）时也能识别。
+    两部分都存在且非空时返回 {'report': ..., 'treatment': ...}，否则返回 None。
+    """
+    if not text:
+        return None
+
+    markers = list(_MARKER_LINE.finditer(text))
+    sections = {}
+    for i, match in enumerate(markers):
+        part = "report" if match.group(1) == "诊断报告" else "treatment"
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        if part in sections:
+            # 标记重复出现，无法确定边界
+            return None
+        sections[part] = text[match.end():end].strip()
+    if sections.get("report") and sections.get("treatment"):
+        return sections
+
+    try:
+        data = json.loads(_JSON_FENCE.sub("", text.strip()))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    sections = {}
+    for part, keys in _SECTION_KEYS.items():
+        value = next((data[key] for key in keys if isinstance(data.get(key), str)), "")
+        if not value.strip():
+            return None
+        sections[part] = value.strip()
+    return sections
+
+
+def _record_generation(mode: str, calls: List[Optional[LLMResult]], seconds: float, complete: bool,
+                       fallback: bool = False):
+    """记录一次完整生成（诊断报告 + 治疗方案）的调用次数、token 用量和耗时，缓存命中的调用不计 token"""
+    with _stats_lock:
+        stats = _mode_stats.setdefault(mode, {
+            "generations": 0, "incomplete": 0, "fallbacks": 0, "llm_calls": 0, "cached_calls": 0,
+            "input_tokens": 0, "output_tokens": 0, "seconds": 0.0,
+        })
+        stats["generations"] += 1
+        stats["incomplete"] += not complete
+        stats["fallbacks"] += fallback
+        for result in calls:
+            if result is None:
+                continue
+            if result.cached:
+                stats["cached_calls"] += 1
+                continue
+            stats["llm_calls"] += 1
+            stats["input_tokens"] += result.input_tokens
+            stats["output_tokens"] += result.output_tokens
+        stats["seconds"] += seconds
+
+
+def generation_stats() -> dict:
+    """按生成模式统计的平均 token 用量和耗时，用于比较 separate 和 combined 模式"""
+    with _stats_lock:
+        by_mode = {}
+        for mode, stats in _mode_stats.items():
+            count = stats["generations"]
+            by_mode[mode] = dict(
+                stats,
+                seconds=round(stats["seconds"], 3),
+                avg_input_tokens=round(stats["input_tokens"] / count, 1),
+                avg_output_tokens=round(stats["output_tokens"] / count, 1),
+                avg_seconds=round(stats["seconds"] / count, 3),
+            )
+    return {"mode": generation_mode, "by_mode": by_mode}
+
 class ReportGenerationService:
     def __init__(self):
-        # DashScope配置
-        self.dashscope_url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+        # 服务商地址、模型、连接池和路由由 llm_gateway / llm_router 统一管理
         self.dashscope_api_key = os.getenv('DASHSCOPE_API_KEY')
-        # 火山引擎配置
-        self.volcano_url = "https://open.volcengineapi.com/v1/text_generation"
         self.volcano_api_key = os.getenv('VOLCANO_API_KEY')
         
         if not self.dashscope_api_key:
@@ -24,74 +137,39 @@ class ReportGenerationService:
         if not self.volcano_api_key:
             raise ValueError("VOLCANO_API_KEY environment variable is not set")
 
-    def _call_dashscope(self, prompt: str) -> str:
-        """调用阿里百炼API"""
-        headers = {
-            "Authorization": f"Bearer {self.dashscope_api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            self.dashscope_url,
-            headers=headers,
-            json={
-                "model": "qwen-max",
-                "input": {
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ]
-                },
-                "parameters": {
-                    "temperature": 0.7,
-                    "top_p": 0.9,
-                    "result_format": "text"
-                }
-            }
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        if "output" not in result:
-            raise Exception(f"百炼API返回格式错误: {result}")
-            
-        return result["output"]["text"].strip()
-
-    def _call_volcano(self, prompt: str) -> str:
-        """调用火山引擎API"""
-        headers = {
-            "Authorization": f"Bearer {self.volcano_api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        response = requests.post(
-            self.volcano_url,
-            headers=headers,
-            json={
-                "model": "chatglm3-6b",  # 使用ChatGLM3作为备选模型
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                "parameters": {
-                    "temperature": 0.7,
-                    "top_p": 0.9
-                }
-            }
-        )
-        response.raise_for_status()
-        
-        result = response.json()
-        if "output" not in result or "text" not in result["output"]:
-            raise Exception(f"火山引擎API返回格式错误: {result}")
-            
-        return result["output"]["text"].strip()
-        
-    def generate_report(self, user_description: str, qa_pairs: List[Dict[str, str]], treatment: bool = False) -> str:
+    def _call(self, prompt: str, call_type: str, deadline: Optional[float] = None,
+              cacheable=None) -> Optional[LLMResult]:
+        """调用大模型，不超过截止时间（time.monotonic()），失败时返回 None"""
+        try:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError("已超过报告生成期限")
+
+            # 相同提示词优先读缓存；否则优先百炼，慢于其 p95 时对冲到火山引擎，失败或熔断时直接切换
+            return cached_llm_call(prompt, call_type=call_type, timeout=timeout, cacheable=cacheable)
+
+        except Exception as e:
+            logger.error(f"生成 {call_type} 失败: {str(e)}")
+            return None
+
+    async def _acall(self, prompt: str, call_type: str, deadline: Optional[float] = None,
+                     cacheable=None) -> Optional[LLMResult]:
+        """_call 的异步版本"""
+        try:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    raise TimeoutError("已超过报告生成期限")
+            return await acall(prompt, call_type=call_type, timeout=timeout, cacheable=cacheable)
+        except Exception as e:
+            logger.error(f"生成 {call_type} 失败: {str(e)}")
+            return None
+
+    def generate_report(self, user_description: str, qa_pairs: List[Dict[str, str]], treatment: bool = False,
+                        deadline: Optional[float] = None) -> str:
         """
         生成诊断报告
         
@@ -99,27 +177,138 @@ class ReportGenerationService:
             user_description: 用户自述内容
             qa_pairs: 问答对列表，每个问答对包含 question 和 answer
             treatment: 是否生成治疗方案
+            deadline: 截止时间（time.monotonic()），调用不超过剩余时间
             
         Returns:
             str: 生成的诊断报告
         """
         # 构建提示词
         prompt = self._build_prompt(user_description, qa_pairs, treatment)
+        result = self._call(prompt, "treatment" if treatment else "report", deadline)
+        return result.text if result else None
+
+    def generate_report_and_treatment(self, user_description: str, qa_pairs: List[Dict[str, str]],
+                                      report: bool = True, treatment: bool = True,
+                                      timeout: float = generation_timeout) -> Dict[str, Optional[str]]:
+        """
+        生成诊断报告和治疗方案
+
+        默认（separate 模式）两个提示词同时提交，总耗时约等于较慢的一次调用；
+        REPORT_GENERATION_MODE=combined 且两部分都需要生成时，只调用一次大模型，
+        回复按分隔标记拆分，拆分失败时在剩余期限内退回两次调用。
+        两者共用一个期限，到期未完成或调用失败的部分返回 None，由调用方保存已完成的部分并标记重试。
+
+        Args:
+            user_description: 用户自述内容
+            qa_pairs: 问答对列表
+            report: 是否生成诊断报告
+            treatment: 是否生成治疗方案
+            timeout: 共同期限（秒）
+
+        Returns:
+            dict: {'report': 诊断报告或 None, 'treatment': 治疗方案或 None}，未请求的部分不出现
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        mode = ("combined" if generation_mode == "combined" else "separate") if report and treatment else None
+        calls = []
+        results = None
+        fallback = False
+
+        if mode == "combined":
+            result = self._call(
+                self._build_combined_prompt(user_description, qa_pairs), "report_treatment", deadline,
+                cacheable=lambda text: parse_combined(text) is not None,
+            )
+            calls.append(result)
+            results = parse_combined(result.text) if result else None
+            if results is None:
+                fallback = True
+                logger.warning("合并生成失败或回复无法拆分，改为分别生成诊断报告和治疗方案")
+
+        if results is None:
+            futures = {}
+            if report:
+                futures['report'] = _executor.submit(
+                    self._call, self._build_prompt(user_description, qa_pairs, False), "report", deadline
+                )
+            if treatment:
+                futures['treatment'] = _executor.submit(
+                    self._call, self._build_prompt(user_description, qa_pairs, True), "treatment", deadline
+                )
+
+            wait(futures.values(), timeout=max(deadline - time.monotonic(), 0))
+            results = {}
+            for part, future in futures.items():
+                result = future.result() if future.done() else None
+                if not future.done():
+                    # 超时的调用无法中断，结果丢弃，线程会在网关读取超时后释放
+                    logger.error(f"生成 {part} 超过 {timeout:.0f}秒期限")
+                calls.append(result)
+                results[part] = result.text if result else None
+
+        if mode:
+            _record_generation(mode, calls, time.monotonic() - started, all(results.values()), fallback)
+        return results
+
+    async def agenerate_report(self, user_description: str, qa_pairs: List[Dict[str, str]],
+                               treatment: bool = False, timeout: Optional[float] = None) -> Optional[str]:
+        """generate_report 的异步版本，失败时返回 None"""
+        prompt = self._build_prompt(user_description, qa_pairs, treatment)
+        deadline = time.monotonic() + timeout if timeout else None
+        result = await self._acall(prompt, "treatment" if treatment else "report", deadline)
+        return result.text if result else None
+
+    async def agenerate_report_and_treatment(self, user_description: str, qa_pairs: List[Dict[str, str]],
+                                             report: bool = True, treatment: bool = True,
+                                             timeout: float = generation_timeout) -> Dict[str, Optional[str]]:
+        """generate_report_and_treatment 的异步版本：在事件循环中生成，到期未完成的调用被取消"""
+        started = time.monotonic()
+        deadline = started + timeout
+        mode = ("combined" if generation_mode == "combined" else "separate") if report and treatment else None
+        calls = []
+        results = None
+        fallback = False
+
+        if mode == "combined":
+            result = await self._acall(
+                self._build_combined_prompt(user_description, qa_pairs), "report_treatment", deadline,
+                cacheable=lambda text: parse_combined(text) is not None,
+            )
+            calls.append(result)
+            results = parse_combined(result.text) if result else None
+            if results is None:
+                fallback = True
+                logger.warning("合并生成失败或回复无法拆分，改为分别生成诊断报告和治疗方案")
+
+        if results is None:
+            parts = {}
+            if report:
+                parts['report'] = asyncio.ensure_future(
+                    self._acall(self._build_prompt(user_description, qa_pairs, False), "report", deadline)
+                )
+            if treatment:
+                parts['treatment'] = asyncio.ensure_future(
+                    self._acall(self._build_prompt(user_description, qa_pairs, True), "treatment", deadline)
+                )
+            if not parts:
+                return {}
+
+            done, pending = await asyncio.wait(parts.values(), timeout=max(deadline - time.monotonic(), 0))
+            for task in pending:
+                task.cancel()
+            results = {}
+            for part, task in parts.items():
+                result = task.result() if task in done else None
+                if task not in done:
+                    logger.error(f"生成 {part} 超过 {timeout:.0f}秒期限")
+                calls.append(result)
+                results[part] = result.text if result else None
+
+        if mode:
+            _record_generation(mode, calls, time.monotonic() - started, all(results.values()), fallback)
+        return results
 
-        try:
-            # 首先尝试调用百炼API
-            try:
-                report = self._call_dashscope(prompt)
-            except Exception as e:
-                logger.warning(f"百炼API调用失败，尝试使用火山引擎: {str(e)}")
-                report = self._call_volcano(prompt)
-                
-            return report
-            
-        except Exception as e:
-            logger.error(f"Failed to generate report: {str(e)}")
-            return None
-            
     def _build_prompt(self, user_description: str, qa_pairs: List[Dict[str, str]], treatment: bool = False) -> str:
         """构建提示词"""
         qa_text = "\n".join([
@@ -162,4 +351,39 @@ class ReportGenerationService:
 5. 注意事项和禁忌
 
 请用专业但通俗易懂的语言撰写建议，确保患者能够理解。对于需要在专业医生指导下进行的治疗，请特别说明。不要输出任何落款信息。
-"""
\ No newline at end of file
+"""
+
+    def _build_combined_prompt(self, user_description: str, qa_pairs: List[Dict[str, str]]) -> str:
+        """构建一次生成诊断报告和治疗方案的提示词，两部分以分隔标记分开"""
+        qa_text = "\n".join([
+            f"问题{i+1}: {qa['question']}\n回答{i+1}: {qa['answer']}"
+            for i, qa in enumerate(qa_pairs)
+        ])
+
+        return f"""你是一位经验丰富的中医主治医师，你要基于患者自述和问诊记录进行初步诊断，生成一份中医诊断报告，并制定一份中医治疗方案。请仔细分析以下信息：
+
+患者自述：
+{user_description}
+
+问诊记录：
+{qa_text}
+
+请严格按照以下格式输出两部分内容，分隔标记单独占一行，原样输出，不要添加其他标记：
+
+{REPORT_MARKER}
+（诊断报告，按照中医诊断的传统方法进行分析和总结，不要给出治疗方案，应该至少包含：）
+**辨证论治**
+- 分析八纲（阴阳、表里、寒热、虚实）
+- 辨别病因病机
+- 确定证型（如气虚、阳虚、痰湿等）
+
+{TREATMENT_MARKER}
+（治疗方案，请提供以下内容：）
+1. 推荐的中药方剂（如有）
+2. 针灸建议（如适用）
+3. 生活调理建议
+4. 饮食指导
+5. 注意事项和禁忌
+
+请用专业但通俗易懂的语言撰写，适当解释中医术语，确保患者能够理解。如果发现任何需要紧急就医的危险信号，请在诊断报告中特别标注；对于需要在专业医生指导下进行的治疗，请特别说明。在辨证论治时，请注意结合现代医学知识，确保诊断的科学性和安全性。不要输出任何落款信息。
+"""
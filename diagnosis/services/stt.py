@@ -1,44 +1,250 @@
 import os
+import time
+import hashlib
 import logging
-import ffmpeg
+import resource
+import threading
 import numpy as np
-from typing import BinaryIO
+from typing import BinaryIO, Dict, List, NamedTuple, Optional
 from funasr import AutoModel
 from funasr.utils.postprocess_utils import rich_transcription_postprocess
+from .audio_decode import SAMPLE_RATE, AudioDecodeError, decode_audio
+from .cache import TieredCache
+
+logger = logging.getLogger('diagnosis')
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    """读取布尔类型的环境变量（"0"/"false"/"no"/"off" 视为关闭）"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ("0", "false", "no", "off", "")
 
-SAMPLE_RATE = 16000
 
 # 模型加载
 model_path = os.getenv("MODEL_PATH", "/opt/ccs/models/SenseVoiceSmall")
 vad_path = os.getenv("VAD_PATH", "/opt/ccs/models/speech_fsmn_vad_zh-cn-16k-common-pytorch")
 
 # 支持任意时长音频输入
-vad_enable = os.getenv("VAD_ENABLE", True)
+vad_enable = _env_flag("VAD_ENABLE", True)
 
 # 推理方式
 device_type = os.getenv("DEVICE_TYPE", "cuda")
 
+# 推理后端："torch"（FunASR AutoModel）或 "onnx"（onnxruntime 量化模型，适用于纯 CPU 节点）
+stt_backend = os.getenv("STT_BACKEND", "torch").lower()
+
 # 设置用于 CPU 内部操作并行性的线程数（在使用GPU时此设置不影响主要计算）
-cpu_num = os.getenv("ncpu", 4)
+cpu_num = int(os.getenv("ncpu", 4))
 
 # 语言
 language = os.getenv("language", "zh")
 
-batch_size = os.getenv("batch_size", 64)
+batch_size = int(os.getenv("batch_size", 64))
+
+use_itn = _env_flag("use_itn", True)
+
+# 并发请求合并为一批推理（见 stt_batcher）
+batching_enable = _env_flag("STT_BATCHING", True)
+
+# 识别结果缓存（按解码后 PCM 的哈希寻址）
+transcription_cache = TieredCache(
+    namespace="stt",
+    max_entries=int(os.getenv("STT_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("STT_CACHE_TTL", 7 * 24 * 3600)),
+    use_redis=_env_flag("STT_CACHE_REDIS", True),
+)
+
+
+class ModelConfig(NamedTuple):
+    """模型配置，作为模型注册表的键"""
+    vad: bool
+    device: str
+    ncpu: int
+    # "asr": SenseVoice（可带 VAD）；"vad": 单独的 FSMN VAD（流式切分用）
+    kind: str = "asr"
+
+
+class _LoadedModel(NamedTuple):
+    model: object
+    load_seconds: float
+    rss_delta_mb: float
+    gpu_memory_mb: Optional[float]
+    loaded_at: float
+
+
+def _current_rss_mb() -> float:
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        # 非 Linux 平台退化为峰值内存
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _gpu_memory_mb(device: str) -> Optional[float]:
+    if not device.startswith("cuda"):
+        return None
+    try:
+        import torch
+        if not torch.cuda.is_available():
+            return None
+        return torch.cuda.memory_allocated() / (1024 * 1024)
+    except Exception:
+        return None
+
+
+class ModelRegistry:
+    """
+    进程级语音识别模型注册表
+
+    每种配置（VAD 开关、推理设备、CPU 线程数）在每个工作进程中只加载一次，
+    后续请求直接复用已加载的模型。加载过程按配置加锁，不同配置之间互不阻塞。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._config_locks: Dict[ModelConfig, threading.Lock] = {}
+        self._models: Dict[ModelConfig, _LoadedModel] = {}
+
+    @staticmethod
+    def make_config(vad: Optional[bool] = None, device: Optional[str] = None,
+                    ncpu: Optional[int] = None, kind: str = "asr") -> ModelConfig:
+        return ModelConfig(
+            vad=vad_enable if vad is None else bool(vad),
+            device=device or ("cpu" if stt_backend == "onnx" and kind == "asr" else device_type),
+            ncpu=int(ncpu or cpu_num),
+            kind=kind,
+        )
+
+    def _config_lock(self, config: ModelConfig) -> threading.Lock:
+        with self._lock:
+            return self._config_locks.setdefault(config, threading.Lock())
+
+    def get(self, vad: Optional[bool] = None, device: Optional[str] = None,
+            ncpu: Optional[int] = None, kind: str = "asr"):
+        """获取指定配置的模型，未加载时在当前线程中加载"""
+        config = self.make_config(vad, device, ncpu, kind)
+        loaded = self._models.get(config)
+        if loaded is not None:
+            return loaded.model
+
+        with self._config_lock(config):
+            loaded = self._models.get(config)
+            if loaded is None:
+                loaded = self._load(config)
+                self._models[config] = loaded
+        return loaded.model
+
+    def _load(self, config: ModelConfig) -> _LoadedModel:
+        rss_before = _current_rss_mb()
+        started = time.perf_counter()
+        if config.kind == "vad":
+            model = initialize_vad_model(device=config.device, ncpu=config.ncpu)
+        else:
+            model = initialize_model(vad=config.vad, device=config.device, ncpu=config.ncpu)
+        load_seconds = time.perf_counter() - started
+        rss_delta = _current_rss_mb() - rss_before
+        gpu_memory = _gpu_memory_mb(config.device)
+
+        logger.info(
+            f"语音模型已加载: kind={config.kind} vad={config.vad} device={config.device} ncpu={config.ncpu} "
+            f"耗时 {load_seconds:.2f}s, 内存增长 {rss_delta:.1f}MB"
+            + (f", 显存占用 {gpu_memory:.1f}MB" if gpu_memory is not None else "")
+        )
+        return _LoadedModel(model, load_seconds, rss_delta, gpu_memory, time.time())
+
+    def is_loaded(self, vad: Optional[bool] = None, device: Optional[str] = None,
+                  ncpu: Optional[int] = None, kind: str = "asr") -> bool:
+        return self.make_config(vad, device, ncpu, kind) in self._models
+
+    def warm_up(self, configs: Optional[List[ModelConfig]] = None):
+        """预加载模型（默认加载环境变量指定的配置）"""
+        for config in configs or [self.make_config()]:
+            try:
+                self.get(*config)
+            except Exception as e:
+                logger.error(f"语音模型预加载失败 {config}: {str(e)}")
+
+    def stats(self) -> List[dict]:
+        """返回已加载模型的加载耗时与内存占用"""
+        return [
+            {
+                "kind": config.kind,
+                "vad": config.vad,
+                "device": config.device,
+                "ncpu": config.ncpu,
+                "load_seconds": round(loaded.load_seconds, 3),
+                "rss_delta_mb": round(loaded.rss_delta_mb, 1),
+                "gpu_memory_mb": None if loaded.gpu_memory_mb is None else round(loaded.gpu_memory_mb, 1),
+                "loaded_at": loaded.loaded_at,
+            }
+            for config, loaded in list(self._models.items())
+        ]
+
+    def clear(self):
+        """释放所有已加载的模型"""
+        with self._lock:
+            self._models.clear()
+
+
+# 进程内共享的模型注册表
+model_registry = ModelRegistry()
+
+
+def get_model(vad: Optional[bool] = None, device: Optional[str] = None, ncpu: Optional[int] = None):
+    """获取进程内共享的语音识别模型"""
+    return model_registry.get(vad=vad, device=device, ncpu=ncpu)
+
+
+def get_vad_model(device: Optional[str] = None, ncpu: Optional[int] = None):
+    """获取进程内共享的 FSMN VAD 模型（用于流式切分）"""
+    return model_registry.get(vad=True, device=device, ncpu=ncpu, kind="vad")
+
+
+# FunASR 的 AutoModel.generate 会修改模型实例上的状态，进程内共享的 VAD 模型同一时间只允许一个调用
+_vad_lock = threading.Lock()
 
-use_itn = os.getenv("use_itn", True)
 
-def initialize_model():
-    """初始化语音识别模型"""
-    if vad_enable:
+def run_vad(model=None, **kwargs):
+    """
+    在进程内共享的 VAD 模型上切分语音（多个流式连接和并行识别之间串行执行）
+
+    Args:
+        model: VAD 模型，默认使用 get_vad_model()
+        **kwargs: 传给 model.generate 的参数
+
+    Returns:
+        list: model.generate 的结果
+    """
+    model = model or get_vad_model()
+    with _vad_lock:
+        return model.generate(**kwargs)
+
+
+def initialize_model(vad: Optional[bool] = None, device: Optional[str] = None, ncpu: Optional[int] = None,
+                     backend: Optional[str] = None):
+    """初始化语音识别模型（每次调用都会重新加载，请求处理中请使用 get_model）"""
+    vad = vad_enable if vad is None else vad
+    device = device or device_type
+    ncpu = ncpu or cpu_num
+
+    if (backend or stt_backend) == "onnx":
+        from .stt_onnx import OnnxSenseVoiceModel
+        return OnnxSenseVoiceModel(model_path, vad_path if vad else None, ncpu=ncpu)
+
+    if vad:
         # 准确预测
         model = AutoModel(
             model=model_path,
             vad_model=vad_path,
             vad_kwargs={"max_single_segment_time": 30000},
             trust_remote_code=False,
-            device=device_type,
-            ncpu=cpu_num,
+            device=device,
+            ncpu=ncpu,
             disable_update=True
         )
     else:
@@ -46,36 +252,48 @@ def initialize_model():
         model = AutoModel(
             model=model_path,
             trust_remote_code=False,
-            device=device_type,
-            ncpu=cpu_num,
+            device=device,
+            ncpu=ncpu,
             disable_update=True
         )
-    
-    print(f"音频模型成功加载到 {device_type}")
+
+    logger.info(f"音频模型成功加载到 {device}")
     return model
 
-def transcribe_audio(file_path: str, model=None) -> dict:
+
+def initialize_vad_model(device: Optional[str] = None, ncpu: Optional[int] = None):
+    """初始化单独的 FSMN VAD 模型"""
+    model = AutoModel(
+        model=vad_path,
+        max_single_segment_time=30000,
+        trust_remote_code=False,
+        device=device or device_type,
+        ncpu=ncpu or cpu_num,
+        disable_update=True
+    )
+    logger.info(f"VAD模型成功加载到 {device or device_type}")
+    return model
+
+
+def transcribe_pcm(data: np.ndarray, model=None, vad: Optional[bool] = None) -> str:
     """
-    将音频文件转换为文字
-    
+    识别已解码的 16kHz 单声道 PCM
+
     Args:
-        file_path: 音频文件路径
-        model: 可选的模型实例，如果为None则创建新实例
+        data: 音频数据
+        model: 可选的模型实例，如果为None则通过进程内共享模型的批处理调度器推理
+        vad: 使用共享模型时是否启用 VAD，None 表示使用环境变量配置
 
     Returns:
-        dict: 包含转换后文字的字典
+        str: 后处理后的识别文字
     """
-    if model is None:
-        model = initialize_model()
-
-    try:
-        # 读取音频文件
-        data = load_audio(file_path)
-        
-        if data is None or len(data) == 0:
-            return {"text": "", "error": "音频文件解码错误"}
-
-        # 进行语音识别
+    if model is None and batching_enable:
+        # 与其他并发请求合并成一批推理
+        from .stt_batcher import get_scheduler
+        text = get_scheduler(vad=vad).transcribe(data)
+    else:
+        if model is None:
+            model = get_model(vad=vad)
         res = model.generate(
             input=data,
             cache={},
@@ -84,35 +302,72 @@ def transcribe_audio(file_path: str, model=None) -> dict:
             merge_vad=True,
             batch_size=batch_size,
         )
+        text = res[0]["text"]
+
+    # 后处理结果
+    return rich_transcription_postprocess(text)
+
+def transcription_cache_key(data: np.ndarray) -> str:
+    """识别结果缓存键：PCM 内容哈希 + 模型及后端 + 语言 + ITN 设置"""
+    digest = hashlib.sha256(np.ascontiguousarray(data, dtype=np.float32).data)
+    digest.update(f"|{model_path}|{stt_backend}|{language}|{int(use_itn)}".encode())
+    return digest.hexdigest()
+
+def transcribe_audio(file_path: str, model=None) -> dict:
+    """
+    将音频文件转换为文字
+
+    Args:
+        file_path: 音频文件路径
+        model: 可选的模型实例，如果为None则通过进程内共享模型的批处理调度器推理
 
-        # 后处理结果
-        result = rich_transcription_postprocess(res[0]["text"])
-        return {"text": result}
+    Returns:
+        dict: 包含转换后文字的字典，命中缓存时 cached 为 True
+    """
+    try:
+        # 读取音频文件
+        try:
+            data = decode_audio(file_path)
+        except AudioDecodeError as e:
+            logger.error(f"音频解码失败: {str(e)}")
+            return {"text": "", "error": f"音频文件解码错误: {str(e)}"}
+
+        if len(data) == 0:
+            return {"text": "", "error": "音频文件解码错误"}
+
+        # 相同音频（客户端重传、重复测试）直接返回缓存结果
+        cache_key = transcription_cache_key(data)
+        cached = transcription_cache.get(cache_key)
+        if cached is not None:
+            return {"text": cached, "cached": True}
+
+        # 进行语音识别，长音频按 VAD 片段分发到进程池并行识别
+        from .stt_parallel import should_parallelize, transcribe_parallel
+        if model is None and should_parallelize(data):
+            result = transcribe_parallel(data)
+        else:
+            result = transcribe_pcm(data, model=model)
+        transcription_cache.set(cache_key, result)
+        return {"text": result, "cached": False}
 
     except Exception as e:
-        logging.error(f"语音转文字失败: {str(e)}")
+        logger.error(f"语音转文字失败: {str(e)}")
         return {"text": "", "error": str(e)}
 
-def load_audio(file_path: str, sr: int = SAMPLE_RATE) -> np.ndarray:
+def load_audio(file_path: str, sr: int = SAMPLE_RATE, use_cache: bool = True) -> np.ndarray:
     """
     加载音频文件并转换为正确的格式
-    
+
     Args:
         file_path: 音频文件路径
         sr: 采样率
+        use_cache: 是否复用已解码的 PCM 缓存
 
     Returns:
-        np.ndarray: 音频数据
+        np.ndarray: 音频数据，解码失败时返回 None
     """
     try:
-        # 使用ffmpeg读取音频
-        out, _ = (
-            ffmpeg.input(file_path)
-            .output("-", format="f32le", acodec="pcm_f32le", ac=1, ar=sr)
-            .run(capture_stdout=True, capture_stderr=True)
-        )
-    except ffmpeg.Error as e:
-        logging.error(f"音频解码失败: {str(e)}")
+        return decode_audio(file_path, sr, use_cache=use_cache)
+    except AudioDecodeError as e:
+        logger.error(f"音频解码失败: {str(e)}")
         return None
-
-    return np.frombuffer(out, np.float32)
@@ -0,0 +1,175 @@
+import os
+import time
+import queue
+import logging
+import threading
+import numpy as np
+from concurrent.futures import Future
+from typing import Callable, Dict, List, NamedTuple, Optional
+from .stt import SAMPLE_RATE, model_registry, language, use_itn, batch_size
+
+logger = logging.getLogger('diagnosis')
+
+# 单批最多合并的音频条数
+max_batch_clips = int(os.getenv("STT_BATCH_MAX_SIZE", 16))
+
+# 首条音频入队后最多等待多久再开始推理（毫秒）
+max_wait_ms = float(os.getenv("STT_BATCH_MAX_WAIT_MS", 20))
+
+# 排队上限，超过后提交方会阻塞等待
+max_queue_size = int(os.getenv("STT_BATCH_MAX_QUEUE", 256))
+
+
+class _PendingClip(NamedTuple):
+    pcm: np.ndarray
+    future: Future
+    enqueued_at: float
+
+
+class BatchScheduler:
+    """
+    语音识别动态批处理调度器
+
+    并发请求提交的 PCM 数据先进入队列，由后台线程按最大等待时间和最大批大小
+    合并成一批，调用一次 model.generate 完成推理后再把结果分发给各自的调用方。
+    同一个模型实例只在调度线程中使用，因此无需再对推理加锁。
+    """
+
+    def __init__(self, model_getter: Callable, generate_kwargs: Dict,
+                 max_batch_size: int = max_batch_clips, max_wait: float = max_wait_ms / 1000,
+                 max_queue: int = max_queue_size):
+        self._model_getter = model_getter
+        self._generate_kwargs = generate_kwargs
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._queue: "queue.Queue[_PendingClip]" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+        self._batches = 0
+        self._clips = 0
+        self._audio_seconds = 0.0
+        self._inference_seconds = 0.0
+
+    def submit(self, pcm: np.ndarray) -> Future:
+        """提交一段 16kHz 单声道 PCM，返回识别结果（原始文本）的 Future"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put(_PendingClip(pcm, future, time.monotonic()))
+        return future
+
+    def transcribe(self, pcm: np.ndarray, timeout: Optional[float] = None) -> str:
+        """提交并等待识别结果"""
+        return self.submit(pcm).result(timeout=timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stt-batcher', daemon=True)
+                self._thread.start()
+
+    def _collect(self) -> List[_PendingClip]:
+        first = self._queue.get()
+        batch = [first]
+        deadline = first.enqueued_at + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                self._process(batch)
+            except Exception as e:
+                # 兜底：保证调用方不会永远等待
+                logger.error(f"语音批处理失败: {str(e)}")
+                for clip in batch:
+                    if not clip.future.done():
+                        clip.future.set_exception(e)
+
+    def _generate(self, model, inputs: List[np.ndarray]) -> List[str]:
+        res = model.generate(input=inputs, cache={}, **self._generate_kwargs)
+        if len(res) != len(inputs):
+            raise RuntimeError(f"批处理结果数量不匹配: 输入 {len(inputs)} 条, 输出 {len(res)} 条")
+        return [item["text"] for item in res]
+
+    def _process(self, batch: List[_PendingClip]):
+        model = self._model_getter()
+        started = time.perf_counter()
+        try:
+            texts = self._generate(model, [clip.pcm for clip in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            # 单条异常音频不应拖累整批，退化为逐条推理
+            logger.warning(f"批量推理失败，退化为逐条推理: {str(e)}")
+            texts = []
+            for clip in batch:
+                try:
+                    texts.append(self._generate(model, [clip.pcm])[0])
+                except Exception as clip_error:
+                    texts.append(clip_error)
+        elapsed = time.perf_counter() - started
+
+        self._batches += 1
+        self._clips += len(batch)
+        self._audio_seconds += sum(len(clip.pcm) for clip in batch) / SAMPLE_RATE
+        self._inference_seconds += elapsed
+
+        for clip, text in zip(batch, texts):
+            if isinstance(text, Exception):
+                clip.future.set_exception(text)
+            else:
+                clip.future.set_result(text)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self._batches,
+            "clips": self._clips,
+            "avg_batch_size": round(self._clips / self._batches, 2) if self._batches else 0,
+            "queue_depth": self._queue.qsize(),
+            "audio_seconds": round(self._audio_seconds, 1),
+            "inference_seconds": round(self._inference_seconds, 3),
+            "audio_seconds_per_second": (
+                round(self._audio_seconds / self._inference_seconds, 2) if self._inference_seconds else 0
+            ),
+        }
+
+
+_schedulers: Dict[tuple, BatchScheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(vad: Optional[bool] = None, device: Optional[str] = None,
+                  ncpu: Optional[int] = None) -> BatchScheduler:
+    """获取指定模型配置对应的进程内批处理调度器"""
+    config = model_registry.make_config(vad, device, ncpu)
+    scheduler = _schedulers.get(config)
+    if scheduler is not None:
+        return scheduler
+
+    with _schedulers_lock:
+        scheduler = _schedulers.get(config)
+        if scheduler is None:
+            scheduler = BatchScheduler(
+                model_getter=lambda: model_registry.get(*config),
+                generate_kwargs={
+                    "language": language,
+                    "use_itn": use_itn,
+                    "merge_vad": True,
+                    "batch_size": batch_size,
+                },
+            )
+            _schedulers[config] = scheduler
+    return scheduler
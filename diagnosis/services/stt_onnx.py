@@ -0,0 +1,63 @@
+import os
+import logging
+import numpy as np
+from typing import List, Union
+
+logger = logging.getLogger('diagnosis')
+
+SAMPLE_RATE = 16000
+
+# 是否使用 int8 量化模型（model_quant.onnx）
+onnx_quantize = os.getenv("STT_ONNX_QUANTIZE", "true").lower() not in ("0", "false", "no", "off")
+
+
+class OnnxSenseVoiceModel:
+    """
+    基于 onnxruntime 的 SenseVoice + FSMN VAD 推理（CPU）
+
+    对外提供与 funasr.AutoModel.generate 相同的调用方式和返回格式（带 <|zh|> 等标签的原始文本），
+    因此后续的 rich_transcription_postprocess、批处理调度和缓存都无需区分后端。
+    模型目录中没有导出的 ONNX 文件时，funasr_onnx 会在首次加载时自动导出（需要安装 funasr 和 torch）。
+    """
+
+    def __init__(self, model_dir: str, vad_dir: str = None, ncpu: int = 4,
+                 quantize: bool = onnx_quantize, batch_size: int = 16):
+        try:
+            from funasr_onnx import SenseVoiceSmall, Fsmn_vad
+        except ImportError as e:
+            raise ImportError(
+                "ONNX 推理后端需要安装 funasr-onnx 和 onnxruntime：pip install funasr-onnx onnxruntime"
+            ) from e
+
+        # funasr_onnx 使用顺序执行模式，算子间并行线程不起作用，只需设置算子内线程数
+        self.asr = SenseVoiceSmall(
+            model_dir,
+            batch_size=batch_size,
+            quantize=quantize,
+            intra_op_num_threads=ncpu,
+        )
+        self.vad = Fsmn_vad(vad_dir, quantize=quantize, intra_op_num_threads=ncpu) if vad_dir else None
+        logger.info(f"ONNX 语音模型已加载: quantize={quantize} ncpu={ncpu} vad={bool(vad_dir)}")
+
+    def _split(self, pcm: np.ndarray) -> List[np.ndarray]:
+        """按 VAD 结果切分音频（毫秒 -> 采样点）"""
+        if self.vad is None:
+            return [pcm]
+        segments = self.vad(pcm)[0]
+        clips = [pcm[beg * SAMPLE_RATE // 1000:end * SAMPLE_RATE // 1000] for beg, end in segments]
+        return [clip for clip in clips if len(clip) > 0]
+
+    def generate(self, input: Union[np.ndarray, List[np.ndarray]], cache: dict = None,
+                 language: str = "auto", use_itn: bool = True, **kwargs) -> List[dict]:
+        inputs = input if isinstance(input, list) else [input]
+        textnorm = "withitn" if use_itn else "woitn"
+
+        results = []
+        for pcm in inputs:
+            pcm = np.ascontiguousarray(pcm, dtype=np.float32)
+            texts = [
+                self.asr(clip, language=language, textnorm=textnorm)[0]
+                for clip in self._split(pcm)
+            ]
+            results.append({"text": "".join(texts)})
+        return results
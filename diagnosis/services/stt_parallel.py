@@ -0,0 +1,148 @@
+import os
+import logging
+import threading
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+from funasr.utils.postprocess_utils import rich_transcription_postprocess
+from .stt import (
+    SAMPLE_RATE, model_registry, run_vad, cpu_num, language, use_itn, batch_size
+)
+
+logger = logging.getLogger('diagnosis')
+
+# 并行识别的进程数，0 表示不启用
+parallel_workers = int(os.getenv("STT_PARALLEL_WORKERS", 0))
+
+# 音频时长达到该值（秒）才拆分并行识别
+parallel_min_seconds = float(os.getenv("STT_PARALLEL_MIN_SECONDS", 60))
+
+# 相邻 VAD 片段合并后的最大长度（毫秒），与 FunASR 的 max_single_segment_time 一致
+max_chunk_ms = int(os.getenv("STT_PARALLEL_MAX_CHUNK_MS", 30000))
+
+# 每段前后额外保留的音频（毫秒），避免切点附近的字被截断；不超过与相邻片段之间静音的中点
+overlap_ms = int(os.getenv("STT_PARALLEL_OVERLAP_MS", 200))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _init_worker(ncpu: int):
+    """工作进程初始化：加载不带 VAD 的识别模型（切分已在主进程完成）"""
+    model_registry.get(vad=False, ncpu=ncpu)
+
+
+def _recognize(pcm: np.ndarray, ncpu: int) -> str:
+    model = model_registry.get(vad=False, ncpu=ncpu)
+    res = model.generate(
+        input=pcm,
+        cache={},
+        language=language,
+        use_itn=use_itn,
+        merge_vad=True,
+        batch_size=batch_size,
+    )
+    return rich_transcription_postprocess(res[0]["text"])
+
+
+def _worker_threads() -> int:
+    return max(1, cpu_num // max(parallel_workers, 1))
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """进程池在首次使用时创建，每个进程常驻一份预加载的模型"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # spawn 避免在已加载模型、已启动线程的进程中 fork
+                _pool = ProcessPoolExecutor(
+                    max_workers=parallel_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(_worker_threads(),),
+                )
+    return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def should_parallelize(data: np.ndarray) -> bool:
+    return parallel_workers > 1 and len(data) >= parallel_min_seconds * SAMPLE_RATE
+
+
+def plan_chunks(segments: List[List[int]], total_samples: int,
+                chunk_ms: int = max_chunk_ms) -> List[Tuple[int, int]]:
+    """
+    将相邻 VAD 片段合并为不超过 chunk_ms 的识别单元，并在两端加上余量
+
+    余量最多 overlap_ms，且不超过与相邻单元之间静音的中点，相邻单元不会包含同一段音频，
+    识别结果按顺序直接拼接，不需要按文字猜测重复的部分（说话人真实重复的字词得以保留）。
+
+    Returns:
+        每个单元的 (起始采样点, 结束采样点)，互不重叠
+    """
+    merged = []
+    for beg, end in segments:
+        if merged and end - merged[-1][0] <= chunk_ms:
+            merged[-1][1] = end
+        else:
+            merged.append([beg, end])
+
+    chunks = []
+    for i, (beg, end) in enumerate(merged):
+        start_ms = beg - overlap_ms
+        if i > 0:
+            start_ms = max(start_ms, (merged[i - 1][1] + beg) // 2)
+        stop_ms = end + overlap_ms
+        if i + 1 < len(merged):
+            stop_ms = min(stop_ms, (end + merged[i + 1][0]) // 2)
+        start = max(start_ms * SAMPLE_RATE // 1000, 0)
+        stop = min(stop_ms * SAMPLE_RATE // 1000, total_samples)
+        if stop > start:
+            chunks.append((start, stop))
+    return chunks
+
+
+def transcribe_parallel(data: np.ndarray) -> str:
+    """
+    长音频分段并行识别
+
+    在主进程用 VAD 找到语音边界，把片段分发到常驻模型的进程池中并行识别，
+    再按原顺序拼接。耗时随 CPU 核数增加而下降，而不再与音频时长成正比。
+
+    Returns:
+        str: 后处理后的识别文字
+    """
+    res = run_vad(input=data, cache={})
+    segments = res[0]["value"] if res else []
+    # 单元长度兼顾识别上下文和并行度：保证每个进程都能分到片段
+    total_ms = len(data) * 1000 // SAMPLE_RATE
+    chunk_ms = min(max_chunk_ms, max(total_ms // parallel_workers, 1000))
+    chunks = plan_chunks(segments, len(data), chunk_ms)
+    if not chunks:
+        return ""
+
+    ncpu = _worker_threads()
+    pool = get_pool()
+    try:
+        futures = [pool.submit(_recognize, np.array(data[start:stop]), ncpu) for start, stop in chunks]
+        texts = [future.result() for future in futures]
+    except Exception:
+        # 工作进程异常退出后进程池不可再用，下次调用重新创建
+        _reset_pool()
+        raise
+
+    text = "".join(texts)
+    logger.info(
+        f"并行识别完成: 音频 {len(data) / SAMPLE_RATE:.1f}s, "
+        f"{len(segments)} 个 VAD 片段合并为 {len(chunks)} 段, {parallel_workers} 个进程"
+    )
+    return text
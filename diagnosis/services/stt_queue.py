@@ -0,0 +1,221 @@
+import os
+import time
+import uuid
+import logging
+from typing import Callable, Optional
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+logger = logging.getLogger('diagnosis')
+
+QUEUE_KEY = 'ctd:stt:queue'
+PROCESSING_KEY = 'ctd:stt:processing'
+LEASES_KEY = 'ctd:stt:leases'
+DEAD_LETTER_KEY = 'ctd:stt:dead'
+JOB_KEY = 'ctd:stt:job:{}'
+
+# 任务被取出后多久未确认即视为工作进程失联，重新入队（秒）
+visibility_timeout = int(os.getenv('STT_JOB_VISIBILITY_TIMEOUT', 300))
+
+# 最大尝试次数，超过后进入死信队列
+max_attempts = int(os.getenv('STT_JOB_MAX_ATTEMPTS', 3))
+
+# 任务状态保留时间（秒）
+job_ttl = int(os.getenv('STT_JOB_TTL', 7 * 24 * 3600))
+
+
+# 为处理中列表里没有租约的任务补登租约：工作进程在 BLMOVE 之后、登记租约之前崩溃时，
+# 任务只存在于处理中列表，补登后按租约过期的流程重新投递
+_ADOPT_SCRIPT = """
+local adopted = 0
+for _, job_id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+    adopted = adopted + redis.call('ZADD', KEYS[2], 'NX', ARGV[1], job_id)
+end
+return adopted
+"""
+
+# 租约与处理中列表同时移除，避免补登租约的扫描看到只剩处理中记录的任务
+_EXPIRE_SCRIPT = """
+if redis.call('ZREM', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('LREM', KEYS[1], 1, ARGV[1])
+return 1
+"""
+
+
+class QueueUnavailable(RuntimeError):
+    """未配置 Redis，无法使用异步任务队列"""
+
+
+def is_available() -> bool:
+    return get_redis() is not None
+
+
+def worker_client() -> redis.Redis:
+    """工作进程专用连接：阻塞读取需要比共享客户端更长的 socket 超时"""
+    if not getattr(settings, 'REDIS_URL', None):
+        raise QueueUnavailable('REDIS_URL 未配置')
+    return redis.Redis.from_url(settings.REDIS_URL, socket_timeout=None, health_check_interval=30)
+
+
+def _update_job(client: redis.Redis, job_id: str, **fields):
+    fields['updated_at'] = time.time()
+    key = JOB_KEY.format(job_id)
+    pipe = client.pipeline()
+    pipe.hset(key, mapping={k: '' if v is None else v for k, v in fields.items()})
+    pipe.expire(key, job_ttl)
+    pipe.execute()
+
+
+def enqueue(description_id: int, client: Optional[redis.Redis] = None) -> str:
+    """
+    提交语音转文字任务
+
+    Args:
+        description_id: UserDescription 的 ID
+
+    Returns:
+        str: 任务 ID
+    """
+    client = client or get_redis()
+    if client is None:
+        raise QueueUnavailable('REDIS_URL 未配置')
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    key = JOB_KEY.format(job_id)
+    pipe = client.pipeline()
+    pipe.hset(key, mapping={
+        'description_id': description_id,
+        'status': 'queued',
+        'attempts': 0,
+        'error': '',
+        'created_at': now,
+        'updated_at': now,
+    })
+    pipe.expire(key, job_ttl)
+    pipe.lpush(QUEUE_KEY, job_id)
+    pipe.execute()
+    return job_id
+
+
+def get_job(job_id: str, client: Optional[redis.Redis] = None) -> Optional[dict]:
+    """查询任务状态，任务不存在或 Redis 不可用时返回 None"""
+    client = client or get_redis()
+    if client is None or not job_id:
+        return None
+    try:
+        raw = client.hgetall(JOB_KEY.format(job_id))
+    except redis.RedisError as e:
+        logger.warning(f'读取语音识别任务 {job_id} 失败: {str(e)}')
+        return None
+    if not raw:
+        return None
+    job = {k.decode(): v.decode() for k, v in raw.items()}
+    job['id'] = job_id
+    job['attempts'] = int(job.get('attempts') or 0)
+    return job
+
+
+def reserve(client: redis.Redis, timeout: int = 5) -> Optional[dict]:
+    """
+    取出一个任务并登记租约，超过 visibility_timeout 未确认的任务会被重新投递
+
+    阻塞读取无法放进 Lua 脚本，取出与登记租约是两次调用；期间崩溃留下的任务由 requeue_expired 补登租约。
+
+    Returns:
+        任务信息，队列为空时返回 None
+    """
+    job_id = client.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, 'RIGHT', 'LEFT')
+    if job_id is None:
+        return None
+    job_id = job_id.decode()
+
+    client.zadd(LEASES_KEY, {job_id: time.time() + visibility_timeout})
+    key = JOB_KEY.format(job_id)
+    attempts = client.hincrby(key, 'attempts', 1)
+    _update_job(client, job_id, status='running', worker_pid=os.getpid())
+
+    description_id = client.hget(key, 'description_id')
+    if description_id is None:
+        # 任务信息已过期，直接丢弃
+        ack(client, job_id)
+        return None
+    return {'id': job_id, 'description_id': int(description_id), 'attempts': attempts}
+
+
+def _release(client: redis.Redis, job_id: str):
+    pipe = client.pipeline()
+    pipe.lrem(PROCESSING_KEY, 1, job_id)
+    pipe.zrem(LEASES_KEY, job_id)
+    pipe.execute()
+
+
+def ack(client: redis.Redis, job_id: str):
+    """任务完成"""
+    _release(client, job_id)
+    _update_job(client, job_id, status='completed', error='')
+
+
+def fail(client: redis.Redis, job_id: str, error: str) -> bool:
+    """
+    任务失败：未超过最大尝试次数时重新入队，否则进入死信队列
+
+    Returns:
+        bool: 进入死信队列时返回 True
+    """
+    _release(client, job_id)
+    attempts = int(client.hget(JOB_KEY.format(job_id), 'attempts') or 0)
+    if attempts >= max_attempts:
+        _update_job(client, job_id, status='dead', error=error)
+        client.lpush(DEAD_LETTER_KEY, job_id)
+        logger.error(f'语音识别任务 {job_id} 已尝试 {attempts} 次，进入死信队列: {error}')
+        return True
+    else:
+        _update_job(client, job_id, status='retrying', error=error)
+        client.lpush(QUEUE_KEY, job_id)
+        logger.warning(f'语音识别任务 {job_id} 失败（第 {attempts}/{max_attempts} 次），重新入队: {error}')
+        return False
+
+
+def requeue_expired(client: redis.Redis, on_dead: Optional[Callable[[dict], None]] = None) -> int:
+    """
+    重新投递租约过期（工作进程崩溃或超时）的任务
+
+    Args:
+        on_dead: 任务进入死信队列时调用，参数为任务信息
+    """
+    adopted = int(client.eval(_ADOPT_SCRIPT, 2, PROCESSING_KEY, LEASES_KEY, time.time() + visibility_timeout))
+    if adopted:
+        logger.warning(f'为 {adopted} 个没有租约的语音识别任务补登租约')
+
+    expired = client.zrangebyscore(LEASES_KEY, 0, time.time())
+    count = 0
+    for job_id in expired:
+        job_id = job_id.decode()
+        # 移除租约成功的进程才负责重新投递，避免多个工作进程重复处理
+        if client.eval(_EXPIRE_SCRIPT, 2, PROCESSING_KEY, LEASES_KEY, job_id):
+            if fail(client, job_id, '处理超时，工作进程可能已退出') and on_dead is not None:
+                job = get_job(job_id, client)
+                if job is not None:
+                    on_dead(job)
+            count += 1
+    return count
+
+
+def stats(client: Optional[redis.Redis] = None) -> dict:
+    client = client or get_redis()
+    if client is None:
+        return {}
+    pipe = client.pipeline()
+    pipe.llen(QUEUE_KEY)
+    pipe.llen(PROCESSING_KEY)
+    pipe.llen(DEAD_LETTER_KEY)
+    try:
+        queued, processing, dead = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning(f'读取语音识别队列统计失败: {str(e)}')
+        return {}
+    return {'queued': queued, 'processing': processing, 'dead': dead}
@@ -0,0 +1,137 @@
+import os
+import logging
+import numpy as np
+from typing import List, NamedTuple, Optional
+from .stt import SAMPLE_RATE, get_vad_model, run_vad, transcribe_pcm
+
+logger = logging.getLogger('diagnosis')
+
+# 每次送入 VAD 的音频长度（毫秒）
+vad_chunk_ms = int(os.getenv("STT_STREAM_CHUNK_MS", 200))
+
+# 单次录音最长时长（秒）
+stream_max_seconds = float(os.getenv("STT_STREAM_MAX_SECONDS", 600))
+
+
+class TranscribedSegment(NamedTuple):
+    index: int
+    start_ms: int
+    end_ms: int
+    text: str
+
+
+class StreamTooLongError(ValueError):
+    """录音超过允许的最长时长"""
+
+
+class StreamingTranscriber:
+    """
+    增量 VAD 切分的流式语音识别
+
+    音频以任意大小的块持续送入，按固定步长喂给流式 FSMN VAD；每当 VAD 判定一段语音
+    结束，就立即识别该段并返回文字，录音结束时只需处理最后一段。只保留尚未识别的
+    音频，内存占用与单段语音长度相关，而与录音总时长无关。
+    """
+
+    def __init__(self, vad_model=None, max_seconds: float = stream_max_seconds):
+        self._vad_model = vad_model or get_vad_model()
+        self._vad_cache = {}
+        self._chunk_samples = int(vad_chunk_ms * SAMPLE_RATE / 1000)
+        self._max_samples = int(max_seconds * SAMPLE_RATE)
+
+        # 尚未送入 VAD 的尾部数据
+        self._pending = np.zeros(0, dtype=np.float32)
+        # 保留的音频从 _buffer_offset（样本序号）开始
+        self._buffer = np.zeros(0, dtype=np.float32)
+        self._buffer_offset = 0
+        self._received = 0
+
+        # 当前未结束语音段的起点（毫秒）
+        self._segment_start: Optional[int] = None
+        self.segments: List[TranscribedSegment] = []
+
+    @property
+    def duration(self) -> float:
+        """已接收音频时长（秒）"""
+        return self._received / SAMPLE_RATE
+
+    @property
+    def text(self) -> str:
+        return "".join(segment.text for segment in self.segments)
+
+    def feed(self, pcm: np.ndarray) -> List[TranscribedSegment]:
+        """送入一块 16kHz 单声道 float32 PCM，返回本次新识别完成的语音段"""
+        self._received += len(pcm)
+        if self._received > self._max_samples:
+            raise StreamTooLongError(f"录音时长超过 {self._max_samples // SAMPLE_RATE} 秒")
+
+        self._pending = np.concatenate([self._pending, pcm.astype(np.float32, copy=False)])
+        finished = []
+        while len(self._pending) >= self._chunk_samples:
+            chunk = self._pending[:self._chunk_samples]
+            self._pending = self._pending[self._chunk_samples:]
+            finished.extend(self._run_vad(chunk, is_final=False))
+        return finished
+
+    def finish(self) -> List[TranscribedSegment]:
+        """录音结束，处理剩余音频并返回最后的语音段"""
+        chunk, self._pending = self._pending, np.zeros(0, dtype=np.float32)
+        finished = self._run_vad(chunk, is_final=True)
+
+        if self._segment_start is not None:
+            # VAD 未给出结束点时以录音结尾作为结束
+            end_ms = self._received * 1000 // SAMPLE_RATE
+            segment = self._transcribe_segment(self._segment_start, end_ms)
+            self._segment_start = None
+            if segment is not None:
+                finished.append(segment)
+        return finished
+
+    def _run_vad(self, chunk: np.ndarray, is_final: bool) -> List[TranscribedSegment]:
+        self._buffer = np.concatenate([self._buffer, chunk])
+        res = run_vad(
+            self._vad_model,
+            input=chunk,
+            cache=self._vad_cache,
+            is_final=is_final,
+            chunk_size=vad_chunk_ms,
+        )
+
+        finished = []
+        for beg, end in res[0]["value"] if res else []:
+            if beg != -1:
+                self._segment_start = beg
+            if end != -1 and self._segment_start is not None:
+                segment = self._transcribe_segment(self._segment_start, end)
+                self._segment_start = None
+                if segment is not None:
+                    finished.append(segment)
+
+        self._trim_buffer()
+        return finished
+
+    def _transcribe_segment(self, start_ms: int, end_ms: int) -> Optional[TranscribedSegment]:
+        start = max(start_ms * SAMPLE_RATE // 1000 - self._buffer_offset, 0)
+        end = end_ms * SAMPLE_RATE // 1000 - self._buffer_offset
+        pcm = self._buffer[start:end]
+        if len(pcm) == 0:
+            return None
+
+        # 整段已由 VAD 切好，识别时不再重复做 VAD
+        text = transcribe_pcm(pcm, vad=False)
+        if not text:
+            return None
+        segment = TranscribedSegment(len(self.segments), start_ms, end_ms, text)
+        self.segments.append(segment)
+        return segment
+
+    def _trim_buffer(self):
+        """丢弃已识别完成或确定为静音的音频"""
+        if self._segment_start is not None:
+            keep_from = self._segment_start * SAMPLE_RATE // 1000
+        else:
+            keep_from = self._buffer_offset + len(self._buffer)
+        drop = keep_from - self._buffer_offset
+        if drop > 0:
+            self._buffer = self._buffer[drop:]
+            self._buffer_offset += drop
@@ -0,0 +1,74 @@
+import logging
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import UserDescription, DiagnosisQuestion, Doctor, TCMPattern, TCMPatternSynonym
+from .services.ai_service import pregeneration_enabled
+from .services.doctor_index import doctor_index
+from .services.pattern_matcher import pattern_matcher
+
+logger = logging.getLogger('diagnosis')
+
+
+@receiver(post_save, sender=UserDescription)
+def pregenerate_questions(sender, instance, raw=False, update_fields=None, **kwargs):
+    """用户自述有了文字内容后，立即在后台为报告生成问题，客户端请求问题时直接返回"""
+    if raw or not pregeneration_enabled or not instance.text_content:
+        return
+    if update_fields is not None and 'text_content' not in update_fields:
+        return
+    if DiagnosisQuestion.objects.filter(report_id=instance.report_id).exists():
+        return
+
+    # 延迟导入：tasks 依赖语音识别模块，避免 migrate 等命令加载模型库
+    from .tasks import schedule_question_generation
+
+    report_id = instance.report_id
+    transaction.on_commit(lambda: schedule_question_generation(report_id))
+    logger.info(f'Description {instance.id} transcribed, question generation queued for report {report_id}')
+
+
+@receiver(post_save, sender=Doctor)
+def update_doctor_index(sender, instance, raw=False, **kwargs):
+    """医生信息变更后增量更新推荐索引；新填写的擅长证型加入证型词典（均在事务提交后，回滚时不更新）"""
+    doctor_id = instance.id
+
+    def on_commit():
+        # 先加入证型词典，索引条目按更新后的词典统一证型
+        if not raw:
+            pattern_matcher.register(instance.pattern_list)
+        doctor_index.doctor_changed(doctor_id, instance)
+
+    transaction.on_commit(on_commit)
+
+
+@receiver(post_delete, sender=Doctor)
+def remove_from_doctor_index(sender, instance, **kwargs):
+    doctor_id = instance.id
+    transaction.on_commit(lambda: doctor_index.doctor_changed(doctor_id))
+
+
+@receiver(post_save, sender=TCMPattern)
+def reload_pattern_dictionary_on_save(sender, instance, created=False, raw=False, **kwargs):
+    """
+    证型词典变更后重新编译
+
+    新增的证型只对应它自身，医生擅长证型的统一结果不变，推荐索引无需重建（医生保存时自动加入的证型即属此类）；
+    修改名称，或新增的证型与已有同义词同名（证型名称优先于同义词）时，推荐索引一并重建。
+    """
+    rebuild_index = not created or raw or TCMPatternSynonym.objects.filter(name=instance.name).exists()
+    transaction.on_commit(lambda: _reload_pattern_dictionary(rebuild_index))
+
+
+@receiver(post_delete, sender=TCMPattern)
+@receiver(post_save, sender=TCMPatternSynonym)
+@receiver(post_delete, sender=TCMPatternSynonym)
+def reload_pattern_dictionary(sender, **kwargs):
+    """证型删除或同义词变更后重新编译；医生的擅长证型需按新词典统一，推荐索引一并重建"""
+    transaction.on_commit(lambda: _reload_pattern_dictionary(True))
+
+
+def _reload_pattern_dictionary(rebuild_index: bool):
+    pattern_matcher.invalidate()
+    if rebuild_index:
+        doctor_index.invalidate()
@@ -0,0 +1,175 @@
+import re
+import json
+import wave
+import asyncio
+import logging
+import tempfile
+import numpy as np
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from django.core.files import File
+from django.utils.crypto import get_random_string
+from .models import PreDiagnosisReport, UserDescription
+from .services.stt import SAMPLE_RATE
+from .services.stt_stream import StreamingTranscriber, StreamTooLongError
+
+# 获取logger实例
+logger = logging.getLogger('diagnosis')
+
+STREAM_PATH = re.compile(r'^/ws/reports/(?P<report_id>\d+)/description/stream/?$')
+
+
+def _decode_chunk(data: bytes, sample_format: str) -> np.ndarray:
+    """将客户端发送的二进制音频块转换为 float32 PCM"""
+    if sample_format == 'f32le':
+        return np.frombuffer(data[:len(data) - len(data) % 4], dtype='<f4').astype(np.float32)
+    pcm = np.frombuffer(data[:len(data) - len(data) % 2], dtype='<i2')
+    return pcm.astype(np.float32) / 32768.0
+
+
+def _save_description(report_id: int, text: str, audio_path: str) -> UserDescription:
+    """保存流式识别结果和录音文件"""
+    report = PreDiagnosisReport.objects.get(id=report_id)
+    description, _ = UserDescription.objects.get_or_create(report=report)
+    description.text_content = text
+    description.processed = True
+    description.status = 'completed'
+    description.error_message = ''
+    with open(audio_path, 'rb') as f:
+        description.audio.save(f'stream_{get_random_string(12)}.wav', File(f), save=False)
+    description.save()
+    return description
+
+
+class AudioStreamSession:
+    """
+    单个 WebSocket 录音会话
+
+    客户端协议：
+    - 二进制消息：16kHz 单声道 PCM 音频块（默认 s16le，可用查询参数 format=f32le 指定）
+    - 文本消息 {"type": "end"}：录音结束
+    服务端消息：
+    - {"type": "partial", "segment": 0, "start_ms": 0, "end_ms": 1200, "text": "..."}
+    - {"type": "final", "description_id": 1, "text": "..."}
+    - {"type": "error", "error": "..."}
+    """
+
+    def __init__(self, scope, receive, send, report_id: int):
+        self.receive = receive
+        self.send = send
+        self.report_id = report_id
+        query = parse_qs(scope.get('query_string', b'').decode())
+        self.sample_format = query.get('format', ['s16le'])[0]
+        self.transcriber = None
+        self.audio_file = None
+        self.wav = None
+
+    async def send_json(self, payload: dict):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(payload, ensure_ascii=False)})
+
+    async def close(self, code: int = 1000):
+        await self.send({'type': 'websocket.close', 'code': code})
+
+    async def send_segments(self, segments):
+        for segment in segments:
+            await self.send_json({
+                'type': 'partial',
+                'segment': segment.index,
+                'start_ms': segment.start_ms,
+                'end_ms': segment.end_ms,
+                'text': segment.text,
+            })
+
+    def _open_recording(self):
+        self.audio_file = tempfile.NamedTemporaryFile(suffix='.wav')
+        self.wav = wave.open(self.audio_file, 'wb')
+        self.wav.setnchannels(1)
+        self.wav.setsampwidth(2)
+        self.wav.setframerate(SAMPLE_RATE)
+
+    def _close_recording(self):
+        if self.wav is not None:
+            self.wav.close()
+            self.wav = None
+        if self.audio_file is not None:
+            self.audio_file.close()
+            self.audio_file = None
+
+    def _process_chunk(self, data: bytes):
+        pcm = _decode_chunk(data, self.sample_format)
+        self.wav.writeframes((np.clip(pcm, -1.0, 1.0) * 32767).astype('<i2').tobytes())
+        return self.transcriber.feed(pcm)
+
+    def _finish(self):
+        segments = self.transcriber.finish()
+        self.wav.close()
+        self.wav = None
+        self.audio_file.flush()
+        description = _save_description(self.report_id, self.transcriber.text, self.audio_file.name)
+        return segments, description
+
+    async def run(self):
+        if not await PreDiagnosisReport.objects.filter(id=self.report_id).aexists():
+            await self.close(4404)
+            return
+
+        await self.send({'type': 'websocket.accept'})
+        try:
+            # 模型可能仍在预加载中，放到线程里等待
+            self.transcriber = await asyncio.to_thread(StreamingTranscriber)
+            self._open_recording()
+
+            while True:
+                message = await self.receive()
+                if message['type'] == 'websocket.disconnect':
+                    logger.warning(f'报告 {self.report_id} 的音频流在结束前断开')
+                    return
+
+                if message.get('bytes'):
+                    segments = await asyncio.to_thread(self._process_chunk, message['bytes'])
+                    await self.send_segments(segments)
+                    continue
+
+                try:
+                    payload = json.loads(message.get('text') or '{}')
+                except ValueError:
+                    payload = {}
+                if payload.get('type') == 'end':
+                    segments, description = await asyncio.to_thread(self._finish)
+                    await self.send_segments(segments)
+                    await self.send_json({
+                        'type': 'final',
+                        'description_id': description.id,
+                        'text': description.text_content,
+                    })
+                    logger.info(
+                        f'报告 {self.report_id} 的流式识别完成: '
+                        f'音频{self.transcriber.duration:.1f}秒，{len(self.transcriber.segments)} 个语音段'
+                    )
+                    await self.close()
+                    return
+
+        except StreamTooLongError as e:
+            await self.send_json({'type': 'error', 'error': str(e)})
+            await self.close(4413)
+        except Exception as e:
+            logger.error(f'报告 {self.report_id} 的音频流处理失败: {str(e)}')
+            await self.send_json({'type': 'error', 'error': f'音频处理失败: {str(e)}'})
+            await self.close(1011)
+        finally:
+            self._close_recording()
+
+
+async def websocket_application(scope, receive, send):
+    """WebSocket 入口：/ws/reports/<report_id>/description/stream/"""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+
+    match = STREAM_PATH.match(scope['path'])
+    if not match:
+        await send({'type': 'websocket.close', 'code': 4404})
+        return
+
+    session = AudioStreamSession(scope, receive, send, int(match.group('report_id')))
+    await session.run()
@@ -1,33 +1,292 @@
-from .models import UserDescription
+import os
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import timedelta
+from typing import Dict, Optional
+import redis
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import UserDescription, PreDiagnosisReport, DiagnosisQuestion
 from .services.stt import transcribe_audio
+from .services.ai_service import AIService
+from .services.report_service import ReportGenerationService, generation_timeout
+from .services.redis_client import get_redis
+from . import background
 
-def process_audio_task(description_id: int):
+logger = logging.getLogger('diagnosis')
+
+# 客户端请求问题时，等待进行中的问题预生成的最长时间（秒）
+question_wait_timeout = float(os.getenv("QUESTION_PREGENERATION_WAIT", 60))
+
+# 进行中的问题预生成同时登记在 Redis 中（有效期为 question_wait_timeout），
+# 任务队列启用时预生成在 stt_worker 进程中进行，接口进程据此等待而不是重复调用大模型
+QUESTION_JOB_KEY = 'ctd:questions:pregenerating:{}'
+# 等待其他进程中的预生成时查询登记的间隔（秒）
+QUESTION_POLL_INTERVAL = 0.2
+
+_question_jobs_lock = threading.Lock()
+_question_jobs: Dict[int, Future] = {}
+
+def process_audio_task(description_id: int, final_attempt: bool = True):
     """
     处理音频文件，将语音转换为文字
-    
+
     Args:
         description_id: UserDescription模型实例的ID
+        final_attempt: 是否为最后一次尝试；否则失败时保持待处理状态，由任务队列重试
+
+    Returns:
+        bool: 转换成功返回 True；失败返回 False（由任务队列决定是否重试）
     """
     try:
         # 获取用户描述实例
         description = UserDescription.objects.get(id=description_id)
-        
+        description.status = 'processing'
+        description.save(update_fields=['status'])
+
         # 进行语音转文字
         result = transcribe_audio(description.audio.path)
-        
+
         if "error" in result:
-            # 处理错误
-            description.text_content = f"语音转换失败: {result['error']}"
+            # 处理错误；还会重试时保持待处理，避免查询状态的客户端提前放弃
+            description.status = 'error' if final_attempt else 'pending'
+            description.error_message = f"语音转换失败: {result['error']}"
             description.processed = False
         else:
             # 更新文字内容
             description.text_content = result["text"]
+            description.status = 'completed'
+            description.error_message = ''
             description.processed = True
-        
+
         description.save()
-        
-        return True
+
+        return description.processed
     except UserDescription.DoesNotExist:
+        logger.warning(f'User description not found: {description_id}')
         return False
     except Exception as e:
+        logger.error(f'Audio task failed for description ID {description_id}: {str(e)}')
         return False
+
+
+def mark_audio_failed(description_id: int, error: str):
+    """任务队列放弃转写（进入死信队列）后，将用户描述标记为错误"""
+    UserDescription.objects.filter(id=description_id).exclude(status__in=['completed', 'error']).update(
+        status='error', error_message=f"语音转换失败: {error}", processed=False
+    )
+
+
+def _generation_stale_before():
+    return timezone.now() - timedelta(seconds=generation_timeout + 60)
+
+
+def claim_report_generation(report_id: int) -> bool:
+    """
+    将报告标记为生成中，同一时间只有一个请求或后台任务能够领取
+
+    生成超过期限仍未结束（如进程被重启）的标记视为失效，可以重新领取。
+
+    Returns:
+        bool: 领取成功返回 True；报告不存在或正在由其他任务生成时返回 False
+    """
+    return PreDiagnosisReport.objects.filter(pk=report_id).filter(
+        ~Q(status='generating') | Q(updated_at__lt=_generation_stale_before())
+    ).update(status='generating', updated_at=timezone.now()) == 1
+
+
+def report_generation_in_progress(report: PreDiagnosisReport) -> bool:
+    """报告是否正由其他请求或后台任务生成（生成中标记未失效）"""
+    return report.status == 'generating' and report.updated_at >= _generation_stale_before()
+
+
+def generate_report_task(report_id: int):
+    """
+    生成诊断报告和治疗方案并保存（已生成的部分不再重复生成）
+
+    Args:
+        report_id: PreDiagnosisReport模型实例的ID
+
+    Returns:
+        list: 仍需重新生成的字段；报告正在由其他任务生成或不满足生成条件时返回 None
+    """
+    if not claim_report_generation(report_id):
+        logger.info(f'Report {report_id} is already being generated, skipping')
+        return None
+
+    report = None
+    try:
+        report = PreDiagnosisReport.objects.select_related('description').get(id=report_id)
+        questions = list(report.questions.select_related('answer'))
+        if not report.has_description or not questions or not all(hasattr(q, 'answer') for q in questions):
+            # 条件不满足，恢复为处理中
+            report.status = 'processing'
+            report.save(update_fields=['status', 'updated_at'])
+            return None
+
+        if report.report_content and report.treatment_plan:
+            report.apply_generated_parts()
+            report.save(update_fields=['status', 'error_message', 'updated_at'])
+            return []
+
+        qa_pairs = [{'question': q.content, 'answer': q.answer.content} for q in questions]
+        results = ReportGenerationService().generate_report_and_treatment(
+            report.description.text_content,
+            qa_pairs,
+            report=not report.report_content,
+            treatment=not report.treatment_plan,
+        )
+        retry_required = report.apply_generated_parts(results.get('report'), results.get('treatment'))
+        report.save(update_fields=['report_content', 'treatment_plan', 'status', 'error_message', 'updated_at'])
+
+        if retry_required:
+            logger.error(f'Report {report_id} partially generated, retry required: {retry_required}')
+        else:
+            logger.info(f'Successfully generated report {report_id}')
+        return retry_required
+    except Exception as e:
+        logger.error(f'Report task failed for report ID {report_id}: {str(e)}')
+        PreDiagnosisReport.objects.filter(pk=report_id).update(
+            status='error', error_message=str(e), updated_at=timezone.now()
+        )
+        fields = ('report_content', 'treatment_plan')
+        return [field for field in fields if report is None or not getattr(report, field)]
+
+
+def create_questions(report: PreDiagnosisReport, questions: list):
+    """
+    保存生成的问题
+
+    问题编号在同一报告内唯一，后台预生成和接口请求同时保存时只有一方成功，另一方返回已保存的问题。
+
+    Returns:
+        tuple: (问题列表, 是否由本次调用创建)
+    """
+    try:
+        with transaction.atomic():
+            created_questions = [
+                DiagnosisQuestion.objects.create(report=report, question_number=i, content=content)
+                for i, content in enumerate(questions, 1)
+            ]
+    except IntegrityError:
+        logger.info(f'Questions for report {report.id} were created concurrently, using the saved ones')
+        return list(report.questions.all()), False
+    return created_questions, True
+
+
+def generate_questions_task(report_id: int):
+    """
+    为报告生成问题并保存（报告已有问题时跳过）
+
+    Args:
+        report_id: PreDiagnosisReport模型实例的ID
+
+    Returns:
+        list: 报告的问题；报告不存在、没有用户自述或生成失败时返回 None
+    """
+    try:
+        report = PreDiagnosisReport.objects.select_related('description').get(id=report_id)
+        if not report.has_description:
+            return None
+        if report.has_questions:
+            return list(report.questions.all())
+
+        questions = AIService().generate_questions(report.description.text_content)
+        questions, created = create_questions(report, questions)
+        if created:
+            PreDiagnosisReport.objects.filter(pk=report_id, status='pending').update(
+                status='processing', updated_at=timezone.now()
+            )
+            logger.info(f'Pre-generated {len(questions)} questions for report {report_id}')
+        return questions
+    except PreDiagnosisReport.DoesNotExist:
+        logger.warning(f'Report not found: {report_id}')
+        return None
+    except Exception as e:
+        logger.error(f'Question task failed for report ID {report_id}: {str(e)}')
+        return None
+
+
+def schedule_question_generation(report_id: int) -> Future:
+    """在后台为报告生成问题，同一报告在本进程内只提交一次"""
+    with _question_jobs_lock:
+        future = _question_jobs.get(report_id)
+        if future is not None and not future.done():
+            return future
+        _set_question_job(report_id, True)
+        future = background.submit(generate_questions_task, report_id)
+        _question_jobs[report_id] = future
+
+    def forget(done: Future):
+        with _question_jobs_lock:
+            if _question_jobs.get(report_id) is done:
+                del _question_jobs[report_id]
+        _set_question_job(report_id, False)
+
+    future.add_done_callback(forget)
+    return future
+
+
+def question_generation_future(report_id: int) -> Optional[Future]:
+    """本进程内进行中的问题预生成，没有时返回 None"""
+    with _question_jobs_lock:
+        return _question_jobs.get(report_id)
+
+
+def _set_question_job(report_id: int, active: bool):
+    client = get_redis()
+    if client is None:
+        return
+    key = QUESTION_JOB_KEY.format(report_id)
+    try:
+        if active:
+            client.set(key, os.getpid(), ex=max(1, int(question_wait_timeout)))
+        else:
+            client.delete(key)
+    except redis.RedisError as e:
+        logger.warning(f'Failed to record question pre-generation for report {report_id}: {str(e)}')
+
+
+def _question_job_active(report_id: int) -> bool:
+    """其他进程（或本进程）是否登记了进行中的问题预生成"""
+    client = get_redis()
+    if client is None:
+        return False
+    try:
+        return bool(client.exists(QUESTION_JOB_KEY.format(report_id)))
+    except redis.RedisError as e:
+        logger.warning(f'Failed to read question pre-generation for report {report_id}: {str(e)}')
+        return False
+
+
+def wait_for_question_generation(report_id: int):
+    """
+    等待进行中的问题预生成，最长 question_wait_timeout 秒
+
+    本进程内的预生成直接等待其完成；其他进程中的预生成（需配置 Redis）轮询登记直到其结束。
+    预生成失败时抛出其异常。
+    """
+    future = question_generation_future(report_id)
+    if future is not None:
+        future.result(timeout=question_wait_timeout)
+        return
+    deadline = time.monotonic() + question_wait_timeout
+    while time.monotonic() < deadline and _question_job_active(report_id):
+        time.sleep(QUESTION_POLL_INTERVAL)
+
+
+async def await_question_generation(report_id: int):
+    """wait_for_question_generation 的异步版本（shield 避免超时时取消尚未开始的任务）"""
+    future = question_generation_future(report_id)
+    if future is not None:
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), question_wait_timeout)
+        return
+    deadline = time.monotonic() + question_wait_timeout
+    active = sync_to_async(_question_job_active, thread_sensitive=False)
+    while time.monotonic() < deadline and await active(report_id):
+        await asyncio.sleep(QUESTION_POLL_INTERVAL)
@@ -1,3 +1,598 @@
-from django.test import TestCase
+import json
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
+import numpy as np
+import requests
+from django.test import SimpleTestCase, TestCase
+from datetime import timedelta
+from django.utils import timezone
+from rest_framework.test import APIClient
+from .models import Doctor, PreDiagnosisReport, TCMPattern, UserDescription, DiagnosisQuestion, DiagnosisAnswer
+from .services.doctor_index import doctor_index
+from .services.doctor_recommendation import DoctorRecommendationService
+from .services.doctor_scoring import round_scores
+from .services.llm_gateway import LLMCancelled, LLMError, LLMGateway, LLMResult
+from .services.llm_router import LLMRouter
+from .services.rate_limiter import RateLimiter, RateLimitTimeout
+from .services.report_service import parse_combined
+from .services.pattern_matcher import Automaton, pattern_matcher
+from .services import stt_parallel, stt_queue
+from .tasks import claim_report_generation, generate_report_task
 
-# Create your tests here.
+try:
+    # 队列的 Lua 脚本需要 fakeredis[lua]（lupa）才能在没有 Redis 服务的环境中运行
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+PATTERNS = [
+    '气虚证', '阳虚证', '阴虚证', '痰湿证', '血瘀证', '肝郁证',
+    '脾胃气虚', '肝郁气滞', '肾阳虚', '肾阴虚', '痰湿阻肺', '肝阳上亢',
+]
+
+
+def reference_recommendations(service, report_patterns, doctors):
+    """逐个医生计算分数的原始实现，作为向量化计算的对照"""
+    recommendations = []
+    for doctor in doctors:
+        pattern_score = service.calculate_pattern_score(report_patterns, doctor)
+        title_score = doctor.title_weight
+        rating_score = service.calculate_rating_score(doctor)
+        total_score = (
+            pattern_score * service.weights['pattern'] +
+            title_score * service.weights['title'] +
+            rating_score * service.weights['rating']
+        )
+        matching_reasons = []
+        if pattern_score > 0.7:
+            matching_reasons.append("对您的证型有丰富治疗经验")
+        if title_score > 0.8:
+            matching_reasons.append("具有丰富的临床经验")
+        if rating_score > 0.8:
+            matching_reasons.append("患者评价较高")
+        recommendations.append({
+            'doctor': {
+                'id': doctor.id,
+                'name': doctor.name,
+                'title': doctor.get_title_display(),
+                'hospital': doctor.hospital,
+                'department': doctor.department,
+                'specialty': doctor.specialty,
+                'tcm_patterns': doctor.tcm_patterns,
+                'years_of_experience': doctor.years_of_experience,
+                'rating': doctor.rating,
+                'patients_count': doctor.patients_count
+            },
+            'matching_score': round(total_score, 3),
+            'matching_reasons': matching_reasons
+        })
+    recommendations.sort(key=lambda x: x['matching_score'], reverse=True)
+    return recommendations
+
+
+class DoctorScoringParityTest(TestCase):
+    """向量化评分与逐个医生计算的结果（分数、匹配原因和顺序）必须完全一致"""
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(20250403)
+        for i in range(300):
+            patterns = rng.sample(PATTERNS, rng.randint(0, 5))
+            if patterns and rng.random() < 0.1:
+                patterns.append(patterns[0])  # 重复的证型计入 pattern_list 的长度
+            Doctor.objects.create(
+                name=f'医生{i}',
+                title=rng.choice(['主任医师', '副主任医师', '主治医师', '住院医师']),
+                years_of_experience=rng.randint(1, 40),
+                hospital='医院',
+                department='中医科',
+                specialty='专长',
+                tcm_patterns=','.join(patterns),
+                # 取少量离散值，制造大量同分的医生以检验排序的稳定性
+                rating=rng.choice([3.9, 4.2, 4.5, 4.8, 5.0]),
+                patients_count=rng.choice([0, 120, 1234, 2500, 5000, 8000]),
+            )
+
+    def setUp(self):
+        doctor_index.invalidate()
+        self.service = DoctorRecommendationService()
+        self.rng = random.Random(7)
+
+    def test_matches_reference(self):
+        for _ in range(100):
+            report_patterns = self.rng.sample(PATTERNS + ['不在词表中的证型'], self.rng.randint(0, 5))
+            report = PreDiagnosisReport(report_content='，'.join(report_patterns) or '未见明显证型')
+            expected = reference_recommendations(
+                self.service, self.service.extract_patterns(report.report_content), Doctor.objects.all()
+            )
+            self.assertEqual(self.service.get_recommendations(report), expected)
+
+    def test_duplicate_report_patterns(self):
+        report_patterns = ['气虚证', '气虚证', '肾阴虚']
+        doctors = list(Doctor.objects.all())
+        self.assertEqual(
+            self.service.rank_doctors(report_patterns, doctors),
+            reference_recommendations(self.service, report_patterns, doctors),
+        )
+
+    def test_incremental_updates(self):
+        report = PreDiagnosisReport(report_content='肝郁气滞，肾阴虚')
+        self.service.get_recommendations(report)
+        with self.captureOnCommitCallbacks(execute=True):
+            doctor = Doctor.objects.order_by('id').first()
+            doctor.tcm_patterns = '肝郁气滞,肾阴虚'
+            doctor.rating = 4.9
+            doctor.save()
+            Doctor.objects.order_by('id').last().delete()
+        expected = reference_recommendations(
+            self.service, self.service.extract_patterns(report.report_content), Doctor.objects.all()
+        )
+        self.assertEqual(self.service.get_recommendations(report), expected)
+
+    def test_pages_match_full_ranking(self):
+        report = PreDiagnosisReport(report_content='气虚证，肝郁气滞，肾阴虚')
+        ranking = self.service.get_recommendations(report)
+        for _ in range(200):
+            k = self.rng.randint(1, 40)
+            offset = self.rng.randint(0, len(ranking) + 5)
+            min_score = self.rng.choice([None, 0.5, 0.6, 0.65, 0.7, 0.9])
+            expected = [r for r in ranking if min_score is None or r['matching_score'] >= min_score]
+            page = self.service.recommend(report, k, offset, min_score)
+            self.assertEqual(page.recommendations, expected[offset:offset + k])
+            self.assertEqual(page.total, len(expected))
+            self.assertEqual(page.next_offset, offset + k if offset + k < len(expected) else None)
+
+    def test_recommend_without_k_returns_all(self):
+        report = PreDiagnosisReport.objects.create(report_content='气虚证，肝郁气滞')
+        response = APIClient().post('/api/doctors/recommend/', {'report_id': report.id}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['recommendations']), Doctor.objects.count())
+        self.assertIsNone(response.data['next_offset'])
+        response = APIClient().post('/api/doctors/recommend/', {'report_id': report.id, 'k': 0}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_round_matches_python(self):
+        rng = np.random.default_rng(3)
+        # 恰好位于舍入边界附近的值，以及随机值
+        values = np.concatenate([np.arange(0, 2000) / 1000 + 0.0005, rng.random(10000) * 2])
+        self.assertEqual(round_scores(values).tolist(), [round(float(v), 3) for v in values])
+
+
+class PatternMatcherTest(TestCase):
+    """证型词典由迁移初始化，同义词统一为对应证型，相互包含的证型取最长匹配"""
+
+    def setUp(self):
+        pattern_matcher.invalidate()
+
+    def test_extract(self):
+        self.assertEqual(
+            pattern_matcher.extract_names('辨证：肝肾阴虚，兼有瘀血；舌淡，属气虚。肝肾阴亏明显'),
+            ['肝肾阴虚', '血瘀证', '气虚证'],
+        )
+        self.assertEqual(pattern_matcher.extract_names('肾阴虚证，痰湿蕴肺'), ['肾阴虚', '痰湿阻肺'])
+        self.assertEqual(pattern_matcher.extract_names('未见明显异常'), [])
+
+    def test_keeps_partially_overlapping_matches(self):
+        automaton = Automaton({'脾胃气虚': 1, '气虚证': 2, '气虚': 3, '肝肾阴虚': 4, '肾阴虚': 5})
+        self.assertEqual(automaton.find('脾胃气虚证'), [(0, 4, 1), (2, 3, 2)])
+        self.assertEqual(automaton.find('肝肾阴虚'), [(0, 4, 4)])
+
+    def test_matches_substring_search(self):
+        terms = {'ab': 1, 'b': 2, 'bca': 3, 'c': 4, 'abcab': 5, 'aab': 6}
+        automaton = Automaton(terms)
+        rng = random.Random(11)
+        for _ in range(200):
+            text = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 30)))
+            expected = sorted(
+                (start, len(term), pattern_id) for term, pattern_id in terms.items()
+                for start in range(len(text)) if text.startswith(term, start)
+            )
+            self.assertEqual(sorted(automaton.find_all(text)), expected)
+            self.assertEqual(automaton.find(text), [
+                (start, length, pattern_id) for start, length, pattern_id in expected
+                if not any(s <= start and start + length <= s + n and n > length for s, n, _ in expected)
+            ])
+
+    def test_doctor_patterns_registered(self):
+        doctor_index.invalidate()
+        doctor_index.snapshot()
+        builds = doctor_index.stats()['builds']
+        with self.captureOnCommitCallbacks(execute=True):
+            Doctor.objects.create(
+                name='医生', title='主治医师', years_of_experience=5, hospital='医院', department='中医科',
+                specialty='专长', tcm_patterns='湿热下注,肾阴不足',
+            )
+            # 事务提交前不写证型词典，回滚时不留下证型
+            self.assertFalse(TCMPattern.objects.filter(name='湿热下注').exists())
+        self.assertTrue(TCMPattern.objects.filter(name='湿热下注').exists())
+        self.assertFalse(TCMPattern.objects.filter(name='肾阴不足').exists())
+        self.assertEqual(pattern_matcher.extract_names('湿热下注，肾阴不足'), ['湿热下注', '肾阴虚'])
+        # 新增的证型不改变其他医生的证型，推荐索引增量更新而不是全量重建
+        entry = next(e for e in doctor_index.snapshot().entries if e.info['name'] == '医生')
+        self.assertEqual(entry.patterns, {'湿热下注', '肾阴虚'})
+        self.assertEqual(doctor_index.stats()['builds'], builds)
+
+
+class ParallelTranscriptionTest(SimpleTestCase):
+    """分段并行识别：各段音频互不重叠，识别结果直接拼接"""
+
+    def test_chunks_do_not_share_audio(self):
+        segments = [[0, 800], [900, 1600], [3000, 3500], [3550, 4000]]
+        chunks = stt_parallel.plan_chunks(segments, 5 * 16000, chunk_ms=500)
+        self.assertEqual(len(chunks), 4)
+        for (_, stop), (start, _) in zip(chunks, chunks[1:]):
+            self.assertLessEqual(stop, start)
+        # 静音足够长时两端保留完整的余量
+        self.assertEqual(chunks[2], ((3000 - 200) * 16, (3500 + 25) * 16))
+        self.assertEqual(chunks[0][0], 0)
+
+    def test_repeated_words_are_kept(self):
+        data = np.zeros(4 * 16000, dtype=np.float32)
+        # 后一段开头与前一段结尾相同的字是说话人真实的重复，不能当作重叠去掉
+        texts = iter(['头疼疼', '疼疼得厉害'])
+        recognize = lambda pcm, ncpu: next(texts)
+        with mock.patch.object(stt_parallel, 'parallel_workers', 2), \
+                mock.patch.object(stt_parallel, 'run_vad', return_value=[{'value': [[0, 1500], [1700, 3500]]}]), \
+                mock.patch.object(stt_parallel, 'get_pool', return_value=ThreadPoolExecutor(1)), \
+                mock.patch.object(stt_parallel, '_recognize', recognize):
+            self.assertEqual(stt_parallel.transcribe_parallel(data), '头疼疼疼疼得厉害')
+
+
+class ParseCombinedTest(SimpleTestCase):
+    """combined 模式的回复按分隔标记或 JSON 拆分为诊断报告和治疗方案，无法确定两部分时返回 None"""
+
+    expected = {'report': '报告内容', 'treatment': '方案内容'}
+
+    def test_markers(self):
+        self.assertEqual(parse_combined('===诊断报告===\n报告内容\n===治疗方案===\n方案内容\n'), self.expected)
+        # 标记前的说明文字不属于任何一部分
+        self.assertEqual(parse_combined('好的。\n===诊断报告===\n报告内容\n===治疗方案===\n方案内容'), self.expected)
+
+    def test_marker_variants(self):
+        for report_marker, treatment_marker in [
+            ('## ===诊断报告===', '## ===治疗方案==='),
+            ('**【诊断报告】**', '**【治疗方案】**'),
+            ('＝＝＝诊断报告＝＝＝', '＝＝ 治疗方案 ＝＝'),
+        ]:
+            text = f'{report_marker}\n报告内容\n{treatment_marker}\n方案内容'
+            self.assertEqual(parse_combined(text), self.expected, text)
+
+    def test_json(self):
+        self.assertEqual(parse_combined('{"report": "报告内容", "treatment": "方案内容"}'), self.expected)
+        self.assertEqual(
+            parse_combined('```json\n{"诊断报告": "报告内容", "treatment_plan": "方案内容"}\n```'), self.expected
+        )
+
+    def test_incomplete(self):
+        for text in [
+            '',
+            '报告内容和方案内容',
+            '===诊断报告===\n报告内容',
+            '===诊断报告===\n报告内容\n===治疗方案===\n',
+            '===诊断报告===\n报告内容\n===治疗方案===\n方案内容\n===诊断报告===\n又一份报告',
+            '{"report": "报告内容"}',
+            '["报告内容", "方案内容"]',
+        ]:
+            self.assertIsNone(parse_combined(text), text)
+        # 正文中提到标记文字（不单独成行）不算分隔
+        self.assertIsNone(parse_combined('===诊断报告===\n见下文===治疗方案===\n方案内容'))
+
+
+class ReportGenerationClaimTest(TestCase):
+    """报告生成的领取与释放：同一时间只有一个请求或后台任务生成报告"""
+
+    def setUp(self):
+        self.report = PreDiagnosisReport.objects.create()
+        UserDescription.objects.create(report=self.report, text_content='头痛三天', processed=True)
+        self.question = DiagnosisQuestion.objects.create(report=self.report, question_number=1, content='是否发热？')
+
+    def generate(self, results=None, error=None):
+        with mock.patch('diagnosis.tasks.ReportGenerationService') as service:
+            method = service.return_value.generate_report_and_treatment
+            method.return_value = results
+            method.side_effect = error
+            retry_required = generate_report_task(self.report.id)
+        self.report.refresh_from_db()
+        return retry_required, method
+
+    def test_claim_is_exclusive(self):
+        self.assertTrue(claim_report_generation(self.report.id))
+        self.assertFalse(claim_report_generation(self.report.id))
+        # 超过期限仍未释放的标记视为失效
+        PreDiagnosisReport.objects.filter(pk=self.report.pk).update(updated_at=timezone.now() - timedelta(days=1))
+        self.assertTrue(claim_report_generation(self.report.id))
+
+    def test_task_releases_claim(self):
+        DiagnosisAnswer.objects.create(question=self.question, content='没有')
+        retry_required, _ = self.generate({'report': '报告', 'treatment': '方案'})
+        self.assertEqual(retry_required, [])
+        self.assertEqual((self.report.status, self.report.report_content), ('completed', '报告'))
+        self.assertTrue(claim_report_generation(self.report.id))
+
+    def test_task_releases_claim_on_error(self):
+        DiagnosisAnswer.objects.create(question=self.question, content='没有')
+        retry_required, _ = self.generate(error=RuntimeError('provider down'))
+        self.assertEqual(retry_required, ['report_content', 'treatment_plan'])
+        self.assertEqual(self.report.status, 'error')
+        self.assertTrue(claim_report_generation(self.report.id))
+
+    def test_task_skips_claimed_report(self):
+        DiagnosisAnswer.objects.create(question=self.question, content='没有')
+        claim_report_generation(self.report.id)
+        retry_required, method = self.generate({'report': '报告', 'treatment': '方案'})
+        self.assertIsNone(retry_required)
+        method.assert_not_called()
+        self.assertEqual(self.report.status, 'generating')
+
+    def test_unanswered_report_is_released(self):
+        retry_required, method = self.generate()
+        self.assertIsNone(retry_required)
+        method.assert_not_called()
+        self.assertEqual(self.report.status, 'processing')
+
+    def test_batch_answer_keeps_generation_claim(self):
+        claim_report_generation(self.report.id)
+        with mock.patch('diagnosis.views.pregeneration_enabled', False):
+            response = APIClient().post('/api/questions/batch-answer/', {
+                'report_id': self.report.id,
+                'answers': [{'question_number': 1, 'content': '没有'}],
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.status, 'generating')
+
+
+def llm_response(status_code, data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = json.dumps(data or {}).encode()
+    response.headers.update(headers or {})
+    return response
+
+
+class LLMGatewayTest(SimpleTestCase):
+    """网关对 429、5xx 和连接失败退避重试，其他错误直接失败"""
+
+    def setUp(self):
+        self.gateway = LLMGateway()
+        # 不等待退避时间；限流使用进程内令牌桶（服务商默认不限制）
+        for patcher in [
+            mock.patch('diagnosis.services.llm_gateway._backoff', return_value=0),
+            mock.patch('diagnosis.services.rate_limiter.get_redis', return_value=None),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def call(self, *responses):
+        with mock.patch.object(self.gateway, '_post', side_effect=responses) as post:
+            try:
+                return self.gateway.call('dashscope', '提示词')
+            finally:
+                self.post_count = post.call_count
+
+    def test_retries_server_errors(self):
+        ok = llm_response(200, {'output': {'text': ' 回复 '}, 'usage': {'input_tokens': 3, 'output_tokens': 2}})
+        result = self.call(llm_response(503), requests.ConnectionError('reset'), ok)
+        self.assertEqual((result.text, result.input_tokens, result.output_tokens), ('回复', 3, 2))
+        self.assertEqual(self.post_count, 3)
+        self.assertEqual(self.gateway.stats()['dashscope']['retries'], 2)
+
+    def test_client_error_is_not_retried(self):
+        with self.assertRaises(LLMError) as cm:
+            self.call(llm_response(400), llm_response(200))
+        self.assertEqual(cm.exception.status_code, 400)
+        self.assertEqual(self.post_count, 1)
+
+    def test_retries_exhausted(self):
+        with mock.patch('diagnosis.services.llm_gateway.max_retries', 1):
+            with self.assertRaises(LLMError) as cm:
+                self.call(llm_response(429, headers={'Retry-After': '0'}), llm_response(502), llm_response(200))
+        self.assertEqual(cm.exception.status_code, 502)
+        self.assertEqual(self.post_count, 2)
+
+
+class LLMRouterTest(SimpleTestCase):
+    """服务商路由：失败时改用下一个服务商，超过 p95 延迟时对冲，连续失败后熔断"""
+
+    def setUp(self):
+        self.router = LLMRouter(['primary', 'backup'])
+        self.behaviour = {}
+        self.calls = []
+        self.cancelled = threading.Event()
+        patcher = mock.patch('diagnosis.services.llm_router.llm_gateway')
+        patcher.start().call.side_effect = self.fake_call
+        self.addCleanup(patcher.stop)
+
+    def fake_call(self, provider, prompt, call_type, timeout, cancel, **params):
+        self.calls.append(provider)
+        behaviour = self.behaviour.get(provider, 'ok')
+        if behaviour == 'slow':
+            # 直到被对冲的另一方取消
+            if cancel.wait(5):
+                self.cancelled.set()
+                raise LLMCancelled('cancelled')
+        elif isinstance(behaviour, Exception):
+            raise behaviour
+        return LLMResult(f'{provider} 回复', provider, 'model', 1, 1, 0.01)
+
+    def test_primary(self):
+        self.assertEqual(self.router.call('提示词').provider, 'primary')
+        self.assertEqual(self.calls, ['primary'])
+
+    def test_failover(self):
+        self.behaviour['primary'] = LLMError('服务不可用', 503)
+        self.assertEqual(self.router.call('提示词').provider, 'backup')
+        self.assertEqual(self.calls, ['primary', 'backup'])
+
+    def test_all_providers_fail(self):
+        self.behaviour = {'primary': LLMError('服务不可用', 503), 'backup': LLMError('服务不可用', 503)}
+        with self.assertRaises(LLMError):
+            self.router.call('提示词')
+
+    def test_hedge_cancels_slow_primary(self):
+        self.behaviour['primary'] = 'slow'
+        with mock.patch('diagnosis.services.llm_router.hedge_default_delay', 0.05):
+            result = self.router.call('提示词')
+        self.assertEqual(result.provider, 'backup')
+        self.assertEqual(self.router.health['primary'].hedges, 1)
+        self.assertTrue(self.cancelled.wait(1))
+        self.assertEqual(self.router.health['primary'].consecutive_failures, 0)
+
+    def test_circuit_breaker(self):
+        self.behaviour['primary'] = LLMError('服务不可用', 503)
+        with mock.patch('diagnosis.services.llm_router.breaker_failures', 2):
+            self.router.call('提示词')
+            self.router.call('提示词')
+            self.assertEqual(self.router.health['primary'].state, 'open')
+            self.calls.clear()
+            self.assertEqual(self.router.call('提示词').provider, 'backup')
+            self.assertEqual(self.calls, ['backup'])
+
+            # 冷却结束后放行一个探测请求，成功则恢复
+            del self.behaviour['primary']
+            with mock.patch('diagnosis.services.llm_router.breaker_cooldown', 0):
+                self.assertEqual(self.router.call('提示词').provider, 'primary')
+            self.assertEqual(self.router.health['primary'].state, 'closed')
+
+    def test_rate_limit_does_not_open_circuit(self):
+        self.behaviour['primary'] = LLMError('限流', 429)
+        with mock.patch('diagnosis.services.llm_router.breaker_failures', 1):
+            self.assertEqual(self.router.call('提示词').provider, 'backup')
+        self.assertEqual(self.router.health['primary'].state, 'closed')
+        self.assertEqual(self.router.health['primary'].rate_limited, 1)
+
+
+@skipUnless(fakeredis, '需要 fakeredis[lua]')
+class STTQueueTest(SimpleTestCase):
+    """语音转文字任务队列：租约过期重新投递，取出后未登记租约的任务补登租约，超过最大尝试次数进入死信队列"""
+
+    def setUp(self):
+        self.client = fakeredis.FakeRedis()
+        self.client.flushall()
+
+    def test_ack(self):
+        job_id = stt_queue.enqueue(1, self.client)
+        job = stt_queue.reserve(self.client, timeout=1)
+        self.assertEqual((job['id'], job['description_id'], job['attempts']), (job_id, 1, 1))
+        stt_queue.ack(self.client, job_id)
+        self.assertEqual(stt_queue.get_job(job_id, self.client)['status'], 'completed')
+        self.assertEqual(stt_queue.stats(self.client), {'queued': 0, 'processing': 0, 'dead': 0})
+        self.assertEqual(self.client.zcard(stt_queue.LEASES_KEY), 0)
+
+    def test_unexpired_lease_is_kept(self):
+        job_id = stt_queue.enqueue(1, self.client)
+        stt_queue.reserve(self.client, timeout=1)
+        self.assertEqual(stt_queue.requeue_expired(self.client), 0)
+        self.assertEqual(stt_queue.get_job(job_id, self.client)['status'], 'running')
+        self.assertEqual(stt_queue.stats(self.client)['processing'], 1)
+
+    def test_expired_lease_is_requeued(self):
+        job_id = stt_queue.enqueue(1, self.client)
+        with mock.patch.object(stt_queue, 'visibility_timeout', -1):
+            stt_queue.reserve(self.client, timeout=1)
+        self.assertEqual(stt_queue.requeue_expired(self.client), 1)
+        self.assertEqual(stt_queue.get_job(job_id, self.client)['status'], 'retrying')
+        self.assertEqual(stt_queue.stats(self.client), {'queued': 1, 'processing': 0, 'dead': 0})
+        # 重新取出时计入第二次尝试
+        self.assertEqual(stt_queue.reserve(self.client, timeout=1)['attempts'], 2)
+
+    def test_job_without_lease_is_adopted(self):
+        # 工作进程在 BLMOVE 之后、登记租约之前崩溃
+        job_id = stt_queue.enqueue(1, self.client)
+        self.client.lmove(stt_queue.QUEUE_KEY, stt_queue.PROCESSING_KEY, 'RIGHT', 'LEFT')
+        self.assertEqual(stt_queue.requeue_expired(self.client), 0)
+        self.assertIsNotNone(self.client.zscore(stt_queue.LEASES_KEY, job_id))
+        # 补登的租约同样会过期并重新投递
+        self.client.zadd(stt_queue.LEASES_KEY, {job_id: 0})
+        self.assertEqual(stt_queue.requeue_expired(self.client), 1)
+        self.assertEqual(stt_queue.stats(self.client), {'queued': 1, 'processing': 0, 'dead': 0})
+
+    def test_dead_letter(self):
+        job_id = stt_queue.enqueue(1, self.client)
+        dead = []
+        with mock.patch.object(stt_queue, 'visibility_timeout', -1):
+            for attempt in range(1, stt_queue.max_attempts + 1):
+                self.assertEqual(stt_queue.reserve(self.client, timeout=1)['attempts'], attempt)
+                self.assertEqual(stt_queue.requeue_expired(self.client, on_dead=dead.append), 1)
+        self.assertEqual([job['id'] for job in dead], [job_id])
+        self.assertEqual(stt_queue.get_job(job_id, self.client)['status'], 'dead')
+        self.assertEqual(stt_queue.stats(self.client), {'queued': 0, 'processing': 0, 'dead': 1})
+
+    def test_fail_requeues_until_max_attempts(self):
+        job_id = stt_queue.enqueue(1, self.client)
+        for attempt in range(1, stt_queue.max_attempts + 1):
+            stt_queue.reserve(self.client, timeout=1)
+            self.assertEqual(stt_queue.fail(self.client, job_id, '识别失败'), attempt >= stt_queue.max_attempts)
+        self.assertEqual(stt_queue.get_job(job_id, self.client)['error'], '识别失败')
+        self.assertEqual(stt_queue.stats(self.client), {'queued': 0, 'processing': 0, 'dead': 1})
+
+
+class RateLimiterTest(SimpleTestCase):
+    """令牌桶限流：突发容量用完后按速率放行，按实际用量修正，429 后暂停，排队有上限和期限"""
+
+    def redis_client(self):
+        return None
+
+    def setUp(self):
+        patcher = mock.patch('diagnosis.services.rate_limiter.get_redis', return_value=self.redis_client())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = RateLimiter()
+
+    def test_request_bucket(self):
+        # 每秒1个请求，桶容量为10秒的配额
+        for _ in range(10):
+            self.assertEqual(self.limiter._take('p', 60, 0, 0), 0)
+        self.assertAlmostEqual(self.limiter._take('p', 60, 0, 0), 1, delta=0.1)
+
+    def test_token_bucket_and_settle(self):
+        # 每秒10个 token，桶容量100
+        self.assertEqual(self.limiter._take('p', 0, 600, 100), 0)
+        self.assertAlmostEqual(self.limiter._take('p', 0, 600, 50), 5, delta=0.1)
+        # 实际只用了20个 token，退还其余的配额
+        self.limiter.settle('p', 600, 100, 20)
+        self.assertEqual(self.limiter._take('p', 0, 600, 50), 0)
+
+    def test_throttle(self):
+        self.limiter.throttle('p', 5)
+        self.assertAlmostEqual(self.limiter._take('p', 0, 0, 0), 5, delta=0.1)
+        self.assertEqual(self.limiter._take('other', 0, 0, 0), 0)
+
+    def test_acquire_waits_for_refill(self):
+        for _ in range(100):
+            self.limiter.acquire('p', rpm=600)
+        self.assertTrue(self.limiter.acquire('p', rpm=600, timeout=1))
+        stats = self.limiter.stats()['providers']['p']
+        self.assertEqual((stats['admitted'], stats['waited'], stats['waiting']), (101, 1, 0))
+
+    def test_acquire_timeout(self):
+        for _ in range(10):
+            self.limiter.acquire('p', rpm=60)
+        with self.assertRaises(RateLimitTimeout):
+            self.limiter.acquire('p', rpm=60, timeout=0.1)
+        with mock.patch('diagnosis.services.rate_limiter.queue_size', 0):
+            with self.assertRaises(RateLimitTimeout):
+                self.limiter.acquire('p', rpm=60)
+        stats = self.limiter.stats()['providers']['p']
+        self.assertEqual((stats['timeouts'], stats['rejected'], stats['waiting']), (1, 1, 0))
+
+    def test_acquire_cancelled(self):
+        for _ in range(10):
+            self.limiter.acquire('p', rpm=60)
+        cancel = threading.Event()
+        cancel.set()
+        self.assertFalse(self.limiter.acquire('p', rpm=60, cancel=cancel))
+        self.assertEqual(self.limiter.stats()['providers']['p']['cancelled'], 1)
+
+
+@skipUnless(fakeredis, '需要 fakeredis[lua]')
+class RedisRateLimiterTest(RateLimiterTest):
+    """同样的行为，桶状态保存在 Redis 中"""
+
+    def redis_client(self):
+        client = fakeredis.FakeRedis()
+        client.flushall()
+        return client
@@ -5,6 +5,7 @@ from .views import (
     DiagnosisQuestionViewSet, DiagnosisAnswerViewSet,
     PreDiagnosisReportViewSet, DoctorViewSet
 )
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'images', DiagnosisImageViewSet)
@@ -15,5 +16,10 @@ router.register(r'reports', PreDiagnosisReportViewSet)
 router.register(r'doctors', DoctorViewSet)
 
 urlpatterns = [
+    path('reports/<int:pk>/generate_report/stream/', async_views.stream_report, name='report-generate-stream'),
+    # 异步版本，需通过 ASGI 服务器部署
+    path('async/questions/generate-questions/', async_views.generate_questions, name='async-generate-questions'),
+    path('async/reports/<int:pk>/generate_report/', async_views.generate_report, name='async-generate-report'),
+    path('async/doctors/recommend/', async_views.recommend, name='async-recommend'),
     path('', include(router.urls)),
 ]
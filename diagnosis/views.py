@@ -1,7 +1,12 @@
 import logging
+import redis
 from rest_framework import viewsets, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from django.db import transaction
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.core.files.base import ContentFile
 import base64
@@ -14,10 +19,19 @@ from .serializers import (
     DiagnosisQuestionSerializer, DiagnosisAnswerSerializer,
     PreDiagnosisReportSerializer, DoctorSerializer, DoctorRecommendationSerializer
 )
-from .services.stt import transcribe_audio
+from .services.stt import transcribe_audio, transcription_cache, model_registry
+from .services import stt_queue
 from .services.ai_service import AIService
-from .services.report_service import ReportGenerationService
-from .services.doctor_recommendation import DoctorRecommendationService
+from .services.report_service import ReportGenerationService, generation_stats, pregeneration_enabled
+from .services import llm_cache, metrics
+from .services.llm_gateway import llm_gateway
+from .services.llm_router import llm_router
+from .services.rate_limiter import rate_limiter
+from .services.doctor_recommendation import DoctorRecommendationService, parse_page_params
+from .tasks import (
+    generate_report_task, create_questions, wait_for_question_generation
+)
+from . import background
 
 # 获取logger实例
 logger = logging.getLogger('diagnosis')
@@ -129,13 +143,27 @@ class UserDescriptionViewSet(viewsets.ModelViewSet):
     queryset = UserDescription.objects.all()
     serializer_class = UserDescriptionSerializer
 
+    def _enqueue_transcription(self, instance):
+        """提交到语音转文字任务队列，队列不可用时返回 False（由调用方同步处理）"""
+        if not stt_queue.is_available():
+            return False
+        try:
+            instance.job_id = stt_queue.enqueue(instance.id)
+        except redis.RedisError as e:
+            logger.warning(f'Failed to enqueue audio for description ID {instance.id}, processing inline: {str(e)}')
+            return False
+        # 只更新 job_id，避免覆盖工作进程可能已经写入的结果
+        UserDescription.objects.filter(pk=instance.pk).update(job_id=instance.job_id)
+        logger.info(f'Queued transcription job {instance.job_id} for description ID {instance.id}')
+        return True
+
     def perform_create(self, serializer):
         """创建用户描述"""
         instance = serializer.save()
         logger.info(f'Created new user description with ID: {instance.id}')
         
-        # 如果上传了音频文件，直接进行语音转文字
-        if instance.audio:
+        # 如果上传了音频文件，提交任务队列或直接进行语音转文字
+        if instance.audio and not self._enqueue_transcription(instance):
             logger.info(f'Processing audio file for description ID: {instance.id}')
             try:
                 result = transcribe_audio(instance.audio.path)
@@ -145,8 +173,12 @@ class UserDescriptionViewSet(viewsets.ModelViewSet):
                     logger.error(f'Failed to transcribe audio for description ID {instance.id}: {result["error"]}')
                 else:
                     instance.text_content = result['text']
+                    instance.status = 'completed'
                     instance.processed = True
-                    logger.info(f'Successfully transcribed audio for description ID {instance.id}')
+                    logger.info(
+                        f'Successfully transcribed audio for description ID {instance.id}'
+                        f'{" (cached)" if result.get("cached") else ""}'
+                    )
                 instance.save()
             except Exception as e:
                 logger.error(f'Exception during audio transcription for description ID {instance.id}: {str(e)}')
@@ -176,6 +208,14 @@ class UserDescriptionViewSet(viewsets.ModelViewSet):
             serializer.is_valid(raise_exception=True)
             instance = serializer.save()
 
+            # 有任务队列时异步处理，客户端通过状态接口查询结果
+            if instance.audio and self._enqueue_transcription(instance):
+                data = self.get_serializer(instance).data
+                data['status_url'] = request.build_absolute_uri(
+                    reverse('userdescription-transcription-status', args=[instance.id])
+                )
+                return Response(data, status=status.HTTP_202_ACCEPTED)
+
             # 等待语音转文字处理完成
             if instance.audio:
                 logger.info(f'Processing audio file for description ID: {instance.id}')
@@ -187,8 +227,12 @@ class UserDescriptionViewSet(viewsets.ModelViewSet):
                         logger.error(f'Failed to transcribe audio for description ID {instance.id}: {result["error"]}')
                     else:
                         instance.text_content = result['text']
+                        instance.status = 'completed'
                         instance.processed = True
-                        logger.info(f'Successfully transcribed audio for description ID {instance.id}')
+                        logger.info(
+                            f'Successfully transcribed audio for description ID {instance.id}'
+                            f'{" (cached)" if result.get("cached") else ""}'
+                        )
                     instance.save()
                 except Exception as e:
                     logger.error(f'Exception during audio transcription for description ID {instance.id}: {str(e)}')
@@ -211,6 +255,28 @@ class UserDescriptionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['GET'], url_path='stt-stats')
+    def stt_stats(self, request):
+        """语音识别运行状态：识别结果缓存命中率和已加载模型"""
+        return Response({
+            'cache': transcription_cache.stats(),
+            'models': model_registry.stats(),
+            'queue': stt_queue.stats(),
+        })
+
+    @action(detail=True, methods=['GET'], url_path='status')
+    def transcription_status(self, request, pk=None):
+        """查询语音转文字进度"""
+        instance = self.get_object()
+        return Response({
+            'id': instance.id,
+            'status': instance.status,
+            'processed': instance.processed,
+            'text_content': instance.text_content,
+            'error_message': instance.error_message,
+            'job': stt_queue.get_job(instance.job_id),
+        })
+
 class DiagnosisQuestionViewSet(viewsets.ModelViewSet):
     queryset = DiagnosisQuestion.objects.all()
     serializer_class = DiagnosisQuestionSerializer
@@ -232,6 +298,12 @@ class DiagnosisQuestionViewSet(viewsets.ModelViewSet):
                 logger.warning(f'Report {report_id} has no description or text content')
                 return Response({'error': '报告尚未添加症状描述或症状描述未处理完成'}, status=status.HTTP_400_BAD_REQUEST)
 
+            # 用户自述保存后问题已在后台生成（本进程或 stt_worker）：等待进行中的预生成，避免重复调用大模型
+            try:
+                wait_for_question_generation(report.id)
+            except Exception as e:
+                logger.warning(f'Waiting for pre-generated questions of report {report_id} failed: {str(e)}')
+
             # 检查是否有问题
             if report.has_questions:
                 logger.warning(f'Report {report_id} already has questions')
@@ -241,15 +313,11 @@ class DiagnosisQuestionViewSet(viewsets.ModelViewSet):
             # 生成问题
             questions = self.ai_service.generate_questions(report.description.text_content)
             
-            # 创建问题记录
-            created_questions = []
-            for i, question_content in enumerate(questions, 1):
-                question = DiagnosisQuestion.objects.create(
-                    report=report,
-                    question_number=i,
-                    content=question_content
-                )
-                created_questions.append(question)
+            # 创建问题记录（后台预生成同时完成时返回已保存的问题）
+            created_questions, created = create_questions(report, questions)
+            if not created:
+                serializer = self.get_serializer(created_questions, many=True)
+                return Response(serializer.data, status=status.HTTP_200_OK)
             
             # 更新报告状态
             report.status = 'processing'
@@ -312,13 +380,21 @@ class DiagnosisQuestionViewSet(viewsets.ModelViewSet):
                         status=status.HTTP_400_BAD_REQUEST
                     )
             
-            # 更新报告状态
-            report.status = 'processing'
-            report.save()
+            # 更新报告状态：只更新状态字段，且不覆盖后台或流式生成持有的 generating 标记
+            PreDiagnosisReport.objects.filter(pk=report.pk).exclude(status='generating').update(
+                status='processing', updated_at=timezone.now()
+            )
+
+            # 最后一个回答保存后在后台生成报告，大模型调用与用户的页面跳转同时进行
+            report_generating = pregeneration_enabled and report.all_questions_answered
+            if report_generating:
+                transaction.on_commit(lambda: background.submit(generate_report_task, report.id))
+                logger.info(f'All questions answered for report {report_id}, report generation queued')
             
             return Response({
                 'message': '回答已保存',
-                'report_id': report_id
+                'report_id': report_id,
+                'report_generating': report_generating,
             })
 
         except PreDiagnosisReport.DoesNotExist:
@@ -354,7 +430,10 @@ class DoctorViewSet(viewsets.ModelViewSet):
         
         请求体格式：
         {
-            "report_id": 123
+            "report_id": 123,
+            "k": 10,            // 可选，返回数量
+            "offset": 0,        // 可选，上一页返回的 next_offset
+            "min_score": 0.6    // 可选，最低匹配分数
         }
         """
         try:
@@ -365,6 +444,11 @@ class DoctorViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
+            try:
+                k, offset, min_score = parse_page_params(request.data)
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
             try:
                 report = PreDiagnosisReport.objects.get(id=report_id)
             except PreDiagnosisReport.DoesNotExist:
@@ -381,11 +465,13 @@ class DoctorViewSet(viewsets.ModelViewSet):
 
             # 获取推荐
             recommendation_service = DoctorRecommendationService()
-            recommendations = recommendation_service.get_recommendations(report)
+            page = recommendation_service.recommend(report, k, offset, min_score)
 
             return Response({
                 'report_id': report_id,
-                'recommendations': recommendations
+                'recommendations': page.recommendations,
+                'total': page.total,
+                'next_offset': page.next_offset
             })
 
         except Exception as e:
@@ -494,39 +580,28 @@ class PreDiagnosisReportViewSet(viewsets.ModelViewSet):
                     'treatment_plan': report.treatment_plan,
                 })
 
-            # 获取问答对
-            qa_pairs = []
-            for question in report.questions.all():
-                if question.answer:
-                    qa_pairs.append({
-                        'question': question.content,
-                        'answer': question.answer.content
-                    })
-
-            # 生成报告内容
-            report_content = self.report_service.generate_report(
-                report.description.text_content, 
-                qa_pairs,
-                treatment=False
-            )
+            # 回答完毕后报告已在后台生成，或有其他请求正在生成：返回当前进度，客户端稍后再查询
+            retry_required = generate_report_task(report.id)
+            report.refresh_from_db()
+            if retry_required is None:
+                return Response({
+                    'message': '报告正在生成中，请稍后查询',
+                    'status': report.status,
+                    'report_content': report.report_content,
+                    'treatment_plan': report.treatment_plan,
+                }, status=status.HTTP_202_ACCEPTED)
+
+            if len(retry_required) == 2:
+                return Response({
+                    'error': '生成报告失败，请重试',
+                    'retry_required': retry_required,
+                }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-            # 生成治疗方案
-            treatment_report_content = self.report_service.generate_report(
-                report.description.text_content, 
-                qa_pairs,
-                treatment=True
-            )
-            
-            # 更新报告
-            report.report_content = report_content
-            report.treatment_plan = treatment_report_content
-            report.status = 'completed'
-            report.save()
-            
             return Response({
-                'message': '报告生成成功',
+                'message': '报告生成成功' if not retry_required else '报告部分生成成功，请重试未完成的部分',
                 'report_content': report.report_content,
                 'treatment_plan': report.treatment_plan,
+                'retry_required': retry_required,
             })
 
         except Exception as e:
@@ -539,6 +614,17 @@ class PreDiagnosisReportViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=False, methods=['GET'], url_path='llm-stats')
+    def llm_stats(self, request):
+        """大模型调用运行状态：各服务商调用次数、延迟和熔断状态，限流排队情况，回复缓存命中率，以及各生成模式的 token 用量和耗时"""
+        return Response({
+            'providers': llm_gateway.stats(),
+            'routing': llm_router.stats(),
+            'rate_limits': rate_limiter.stats(),
+            'cache': llm_cache.stats(),
+            'report_generation': generation_stats(),
+        })
+
     @action(detail=False, methods=['post'])
     def create_from_components(self, request):
         """从组件创建预诊断报告"""
@@ -556,3 +642,8 @@ class PreDiagnosisReportViewSet(viewsets.ModelViewSet):
         except Exception as e:
             logger.error(f'Failed to create pre-diagnosis report: {str(e)}')
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def prometheus_metrics(request):
+    """Prometheus 抓取接口：大模型调用次数、延迟分布、token 用量、切换率等（本进程的统计）"""
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
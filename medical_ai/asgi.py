@@ -2,6 +2,8 @@
 ASGI config for medical_ai project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests are served by Django; WebSocket connections (streaming audio
+upload) are dispatched to ``diagnosis.streaming``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'medical_ai.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# 需在 Django 初始化之后导入
+from diagnosis.streaming import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
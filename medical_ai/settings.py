@@ -137,6 +137,12 @@ REST_FRAMEWORK = {
 MODEL_PATH = os.path.join(BASE_DIR, 'models/SenseVoiceSmall')
 VAD_PATH = os.path.join(BASE_DIR, 'models/speech_fsmn_vad_zh-cn-16k-common-pytorch')
 
+# 服务启动时预加载语音模型
+STT_WARMUP = os.getenv('STT_WARMUP', 'true').lower() == 'true'
+
+# Redis（缓存等跨进程共享数据），未配置时退化为进程内实现
+REDIS_URL = os.getenv('REDIS_URL')
+
 
 # Logging Configuration
 LOGGING = {
@@ -151,6 +157,10 @@ LOGGING = {
             'format': '{levelname} {asctime} {message}',
             'style': '{',
         },
+        'json': {  # 每行一条 JSON 记录
+            'format': '{message}',
+            'style': '{',
+        },
     },
     'handlers': {
         'file': {
@@ -159,6 +169,12 @@ LOGGING = {
             'filename': 'logs/medical_ai.log',
             'formatter': 'verbose',
         },
+        'llm_calls': {
+            'level': 'INFO',
+            'class': 'logging.FileHandler',
+            'filename': 'logs/llm_calls.log',
+            'formatter': 'json',
+        },
         'console': {
             'level': 'INFO',
             'class': 'logging.StreamHandler',
@@ -171,6 +187,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': True,
         },
+        'diagnosis.llm_calls': {  # 大模型调用的结构化日志
+            'handlers': ['llm_calls'],
+            'level': 'INFO',
+            'propagate': False,
+        },
         'django': {  # Django自带的logger
             'handlers': ['file', 'console'],
             'level': 'INFO',